@@ -1,14 +1,33 @@
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import itertools
+import json
+import subprocess
 import time
+import uuid
+from dataclasses import dataclass, field
 import logging
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from typing import Any, Dict, List, Optional
-from runners.base import BaseRunner
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Literal, Optional
+from runners.base import BaseRunner, InstanceExistsError, InsufficientResourcesError
+from runners.reaper import IdleReaper
+from environments.files import DEFAULT_READ_MAX_BYTES
+from environments.process import tag_command
+from codec import DEFAULT_COMPRESS_MIN_BYTES, CompressionMiddleware, NegotiatedResponse, NegotiatingRoute
+from metrics import ServiceMetrics
+from output import OutputPolicy, OutputStore, collect_limited, parse_byte_range
+
+logger = logging.getLogger(__name__)
 
 
 class EndpointFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
-        return record.getMessage().find("GET /stats") == -1
+        message = record.getMessage()
+        return message.find("GET /stats") == -1 and message.find("GET /metrics") == -1
 
 
 class StartInstanceRequest(BaseModel):
@@ -17,98 +36,921 @@ class StartInstanceRequest(BaseModel):
     container_type: str
     timeout: int = 300
     resources: Dict[str, Any] = {"instances": 1}
+    wait: bool = True
+    """If false, return 202 immediately and start in the background (see `/wait_instance`)."""
+    queue_timeout: Optional[float] = 0
+    """Seconds to wait in the admission queue if resources are exhausted (None: no limit)."""
+    priority: Literal["high", "normal", "low"] = "normal"
+    """Admission priority class while waiting in the queue."""
+    idle_timeout: Optional[float] = Field(None, ge=0)
+    """Seconds without commands or heartbeats before the instance is reaped (None: server default, 0: never)."""
+
+class StartInstancesRequest(BaseModel):
+    instances: List[StartInstanceRequest]
+    all_or_nothing: bool = False
+    """Reserve the combined resources in one step and start every instance or none."""
+    queue_timeout: Optional[float] = 0
+    """With `all_or_nothing`: seconds to wait for the combined resources (None: no limit).
+    Otherwise each instance waits per its own `queue_timeout`."""
+    priority: Literal["high", "normal", "low"] = "normal"
+    """With `all_or_nothing`: admission priority class of the group."""
 
 class ExecuteCommandRequest(BaseModel):
     run_id: str
     cmd: str
+    timeout: Optional[int] = None
+    """Seconds before the command is killed (None: the environment's default)."""
+    command_id: Optional[str] = None
+    """Client-chosen id under which the command can be cancelled with `/cancel_command`."""
+    output: Optional[OutputPolicy] = None
+    """Output size limits for this command (capped by the server's limits)."""
+
+class WebSocketCommand(BaseModel):
+    id: Optional[str] = None
+    """Correlation id echoed back on every message belonging to this command."""
+    cmd: str
+    timeout: Optional[int] = None
+    stream: bool = False
+    """Send `output` messages as the command produces them instead of one `result`."""
+    output: Optional[OutputPolicy] = None
+    """Output size limits for a non-streamed command."""
+
+class BatchCommand(BaseModel):
+    run_id: str
+    cmd: str
+    timeout: Optional[int] = None
+    command_id: Optional[str] = None
+    output: Optional[OutputPolicy] = None
+
+class ExecuteBatchRequest(BaseModel):
+    commands: List[BatchCommand]
+    max_concurrency: int = Field(64, ge=1)
+
+class ReadFilesRequest(BaseModel):
+    run_id: str
+    paths: List[str]
+    max_bytes: int = Field(DEFAULT_READ_MAX_BYTES, ge=0)
+    """Maximum bytes returned per file; longer files are marked `truncated`."""
+
+class CancelCommandRequest(BaseModel):
+    command_id: str
 
 class CloseInstanceRequest(BaseModel):
     run_id: str
 
+class CloseInstancesRequest(BaseModel):
+    run_ids: List[str]
+
+class HeartbeatRequest(BaseModel):
+    run_id: str
+
+
+START_JOB_RETENTION_S = 600
+"""How long the outcome of a failed background start stays queryable."""
+
+
+@dataclass
+class StartJob:
+    """Background instance start: pending -> pulling -> starting -> ready / failed."""
+
+    run_id: str
+    state: str = "pending"
+    error: Optional[str] = None
+    updated_at: float = field(default_factory=time.time)
+    task: Optional["asyncio.Task[None]"] = None
+
+    def set_state(self, state: str, error: Optional[str] = None) -> None:
+        self.state = state
+        self.error = error
+        self.updated_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"run_id": self.run_id, "state": self.state, "error": self.error, "updated_at": self.updated_at}
+
+
+CANCEL_GRACE_S = 5.0
+"""How long a cancellation waits for the killed command to end before abandoning it."""
+
+
+@dataclass
+class RunningCommand:
+    """A command in flight; those started with a `command_id` can be cancelled."""
+
+    run_id: str
+    command_id: Optional[str] = None
+    tag: str = field(default_factory=lambda: uuid.uuid4().hex)
+    """Marks the command's processes inside the instance (see `tag_command`)."""
+    cancelled: bool = False
+    task: Optional["asyncio.Task[Dict[str, Any]]"] = None
+    """Runs a non-streamed command; cancelled if killing its processes does not end it."""
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def _sse_frame(event: str, data: Dict[str, Any]) -> str:
+    """Format one Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+OUTPUT_CHARS_HEADER = "X-Output-Chars"
+"""Length of the output in an `/execute_command` response, for metrics of a process relaying it."""
+RELAYED_HEADERS = ("content-type", "content-encoding", "vary", OUTPUT_CHARS_HEADER.lower())
+
 
-def create_app(runner: BaseRunner) -> FastAPI:
-    app = FastAPI()
+def _forwarded_headers(request: Request) -> Dict[str, str]:
+    """Headers of a command request relayed to another service, which then encodes the body
+    for this request's client."""
+    # httpx would otherwise ask for gzip, leaving a body this process cannot relay as-is
+    return {
+        "Accept": request.headers.get("accept", "*/*"),
+        "Accept-Encoding": request.headers.get("accept-encoding", "identity"),
+    }
+
+
+def _transfer_error(e: Exception) -> HTTPException:
+    """Map a file transfer failure to an HTTP error."""
+    if isinstance(e, KeyError):
+        return HTTPException(status_code=404, detail="Instance not found")
+    if isinstance(e, NotImplementedError):
+        return HTTPException(status_code=501, detail=str(e))
+    if isinstance(e, PermissionError):
+        return HTTPException(status_code=403, detail=str(e))
+    if isinstance(e, FileNotFoundError):
+        return HTTPException(status_code=404, detail=str(e))
+    if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+        return HTTPException(status_code=500, detail=e.stderr.strip())
+    return HTTPException(status_code=500, detail=str(e))
+
+
+def create_app(
+    runner: BaseRunner,
+    output_policy: Optional[OutputPolicy] = None,
+    output_store: Optional[OutputStore] = None,
+    idle_ttl: Optional[float] = None,
+    compress_min_bytes: Optional[int] = DEFAULT_COMPRESS_MIN_BYTES,
+    keep_instances: bool = False,
+) -> FastAPI:
+    """
+    - **output_policy**: default output limits for non-streamed commands; per-request
+      policies can only lower them
+    - **output_store**: where truncated outputs are spilled (a temporary directory by default)
+    - **idle_ttl**: default seconds of inactivity after which instances are reaped (None: never)
+    - **compress_min_bytes**: compress responses of at least this size if the client accepts
+      zstd or gzip (None: never)
+    - **keep_instances**: leave the instances recorded in the runner's store running at
+      shutdown, for the next start to re-adopt; otherwise they are torn down as usual
+    """
     started_at = time.time()
+    metrics = ServiceMetrics(runner)
+    output_store = output_store or OutputStore()
 
-    @app.post("/start_instance")
-    def start_instance(request: StartInstanceRequest):
+    async def close(run_id: str) -> None:
+        """Closes an instance through the runner, recording metrics."""
+        labels = metrics.instance_labels(run_id)
+        started = time.perf_counter()
+        await runner.aclose_instance(run_id)
+        metrics.record_close(labels, time.perf_counter() - started)
+
+    reaper = IdleReaper(runner, close, default_ttl=idle_ttl)
+    metrics.register_reaper(reaper)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI):
+        task = asyncio.create_task(reaper.run())
         try:
-            # Convert request to dictionary
-            request_params = request.model_dump()
-            
-            instance_id = runner.start_instance(request_params)
-            return {"status": "success", "instance_id": instance_id}
+            yield
+        finally:
+            task.cancel()
+            if keep_instances:
+                runner.detach()
+
+    app = FastAPI(lifespan=lifespan, default_response_class=NegotiatedResponse)
+    # JSON or MessagePack bodies, as the client asks (see `codec`)
+    app.router.route_class = NegotiatingRoute
+    if compress_min_bytes is not None:
+        app.add_middleware(CompressionMiddleware, minimum_size=compress_min_bytes)
+
+    running_commands: Dict[str, RunningCommand] = {}
+
+    def register_command(run_id: str, command_id: Optional[str]) -> RunningCommand:
+        """Tracks a command about to run; raises 409 if `command_id` is already running."""
+        if command_id is not None and command_id in running_commands:
+            raise HTTPException(status_code=409, detail=f"Command {command_id} is already running")
+        command = RunningCommand(run_id, command_id)
+        if command_id is not None:
+            running_commands[command_id] = command
+        return command
+
+    def release_command(command: RunningCommand) -> None:
+        if command.command_id is not None and running_commands.get(command.command_id) is command:
+            del running_commands[command.command_id]
+        command.finished.set()
+
+    async def kill(command: RunningCommand) -> None:
+        """Kills the processes of a command inside its instance."""
+        try:
+            await runner.akill_command(command.run_id, command.tag)
+        except (KeyError, NotImplementedError):
+            # Closed meanwhile, or only the local client process can be killed
+            pass
         except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+            logger.warning(f"Failed to kill command {command.tag} of {command.run_id}: {e}")
+
+    async def cancel(command: RunningCommand) -> bool:
+        """Kills a running command; returns whether it ended within `CANCEL_GRACE_S`.
+
+        Its request then completes with `"cancelled": true`. A non-streamed command that
+        outlives the kill is abandoned, which kills its local client process.
+        """
+        if not command.cancelled:
+            command.cancelled = True
+            metrics.record_cancel(metrics.instance_labels(command.run_id))
+        await kill(command)
+        try:
+            await asyncio.wait_for(command.finished.wait(), CANCEL_GRACE_S)
+            return True
+        except asyncio.TimeoutError:
+            if command.task is not None:
+                command.task.cancel()
+            return False
+
+    async def run_command(
+        run_id: str,
+        cmd: str,
+        timeout: Optional[int] = None,
+        output: Optional[OutputPolicy] = None,
+        command: Optional[RunningCommand] = None,
+    ) -> Dict[str, Any]:
+        """Executes a command through the runner, applying output limits and recording metrics."""
+        labels = metrics.instance_labels(run_id)
+        policy = output.capped(output_policy) if output is not None else output_policy
+        command = command or register_command(run_id, None)
+        cmd = tag_command(cmd, command.tag)
+        started = time.perf_counter()
+        try:
+            with runner.activity(run_id):
+                if policy is None or policy.unlimited:
+                    execution = runner.aexecute_command(run_id, cmd, timeout=timeout)
+                else:
+                    # Fold the output as it is read so only the kept part is held in memory
+                    execution = collect_limited(runner.astream_command(run_id, cmd, timeout=timeout), policy, output_store)
+                # A task of its own, so a cancellation can abandon it without failing the request
+                command.task = asyncio.ensure_future(execution)
+                result = await command.task
+        except asyncio.CancelledError:
+            if not command.cancelled:
+                # Client or service going away: do not leave the processes running
+                await asyncio.shield(kill(command))
+                raise
+            result = {"output": "", "returncode": None}
+        except Exception as e:
+            if isinstance(e, subprocess.TimeoutExpired):
+                # Only the local client process (`docker exec`, `srun`) was killed
+                await kill(command)
+            metrics.record_command(labels, time.perf_counter() - started, error=e)
+            raise
+        finally:
+            release_command(command)
+        if command.cancelled:
+            result["cancelled"] = True
+        metrics.record_command(labels, time.perf_counter() - started, output_chars=len(result.get("output") or ""))
+        return result
+
+    async def stream_command(
+        run_id: str, cmd: str, timeout: Optional[int] = None, command_id: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Streams a command through the runner, recording metrics."""
+        labels = metrics.instance_labels(run_id)
+        command = register_command(run_id, command_id)
+        started = time.perf_counter()
+        output_chars = 0
+        try:
+            with runner.activity(run_id):
+                async for event in runner.astream_command(run_id, tag_command(cmd, command.tag), timeout=timeout):
+                    if "output" in event:
+                        output_chars += len(event["output"])
+                    elif command.cancelled:
+                        event = dict(event, cancelled=True)
+                    yield event
+        except asyncio.CancelledError:
+            await asyncio.shield(kill(command))
+            raise
+        except Exception as e:
+            if isinstance(e, subprocess.TimeoutExpired):
+                await kill(command)
+            metrics.record_command(labels, time.perf_counter() - started, output_chars, error=e)
+            raise
+        finally:
+            release_command(command)
+        metrics.record_command(labels, time.perf_counter() - started, output_chars)
+
+    def forwarded_payload(request: ExecuteCommandRequest, command: RunningCommand) -> Dict[str, Any]:
+        # The node tags the command itself; `command.tag` is its ID there, for `kill`
+        return dict(request.model_dump(exclude_none=True), command_id=command.tag)
+
+    async def forward_command(
+        request: ExecuteCommandRequest, http_request: Request, command: RunningCommand
+    ) -> Response:
+        """Runs a command through a runner that forwards commands, relaying the response body
+        without decoding it; the node limits the output and encodes the result."""
+        labels = metrics.instance_labels(request.run_id)
+        payload = forwarded_payload(request, command)
+        started = time.perf_counter()
+
+        async def relay() -> Response:
+            async with runner.aforward_command(
+                request.run_id, "/execute_command", payload, _forwarded_headers(http_request)
+            ) as response:
+                body = b"".join([chunk async for chunk in response.aiter_raw()])
+                headers = {key: response.headers[key] for key in RELAYED_HEADERS if key in response.headers}
+                return Response(body, response.status_code, headers)
+
+        try:
+            with runner.activity(request.run_id):
+                command.task = asyncio.ensure_future(relay())
+                response = await command.task
+        except asyncio.CancelledError:
+            if not command.cancelled:
+                await asyncio.shield(kill(command))
+                raise
+            response = NegotiatedResponse({"status": "success", "result": {"output": "", "returncode": None, "cancelled": True}})
+        except Exception as e:
+            metrics.record_command(labels, time.perf_counter() - started, error=e)
+            raise
+        finally:
+            release_command(command)
+        metrics.record_command(
+            labels,
+            time.perf_counter() - started,
+            output_chars=int(response.headers.get(OUTPUT_CHARS_HEADER, 0)),
+            error=HTTPException(response.status_code) if response.status_code >= 500 else None,
+        )
+        return response
+
+    async def forward_stream(request: ExecuteCommandRequest, http_request: Request) -> AsyncIterator[bytes]:
+        """Streams a command through a runner that forwards commands, relaying the node's
+        Server-Sent Events without decoding them."""
+        labels = metrics.instance_labels(request.run_id)
+        command = register_command(request.run_id, request.command_id)
+        payload = forwarded_payload(request, command)
+        started = time.perf_counter()
+        try:
+            with runner.activity(request.run_id):
+                async with runner.aforward_command(
+                    request.run_id, "/execute_command_stream", payload, _forwarded_headers(http_request)
+                ) as response:
+                    async for chunk in response.aiter_raw():
+                        yield chunk
+        except asyncio.CancelledError:
+            await asyncio.shield(kill(command))
+            raise
+        except Exception as e:
+            metrics.record_command(labels, time.perf_counter() - started, error=e)
+            message = "Instance not found" if isinstance(e, KeyError) else str(e)
+            yield _sse_frame("error", {"error": message}).encode()
+            return
+        finally:
+            release_command(command)
+        metrics.record_command(labels, time.perf_counter() - started)
+
+    async def cancel_on_disconnect(request: Request, command: RunningCommand) -> None:
+        """Cancels `command` if the client disconnects before its result is sent."""
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        await cancel(command)
+
+    start_jobs: Dict[str, StartJob] = {}
+
+    async def start(request_params: Dict[str, Any], on_state: Optional[Callable[[str], None]] = None) -> str:
+        """Starts an instance through the runner, recording metrics."""
+        labels = metrics.request_labels(request_params)
+        started = time.perf_counter()
+        try:
+            instance_id = await runner.astart_instance(request_params, on_state=on_state)
+        except Exception as e:
+            metrics.record_start(labels, time.perf_counter() - started, error=e)
+            raise
+        metrics.record_start(labels, time.perf_counter() - started)
+        return instance_id
+
+    async def start_group(
+        requests: List[Dict[str, Any]], queue_timeout: Optional[float], priority: str
+    ) -> List[str]:
+        """Starts instances all-or-nothing through the runner, recording metrics."""
+        labels = [metrics.request_labels(request_params) for request_params in requests]
+        started = time.perf_counter()
+        try:
+            run_ids = await runner.astart_instances(requests, queue_timeout=queue_timeout, priority=priority)
+        except (ValueError, NotImplementedError):
+            # Invalid group: nothing was attempted
+            raise
+        except Exception as e:
+            for instance_labels in labels:
+                metrics.record_start(instance_labels, time.perf_counter() - started, error=e)
+            raise
+        for instance_labels in labels:
+            metrics.record_start(instance_labels, time.perf_counter() - started)
+        return run_ids
+
+    async def start_in_background(job: StartJob, request_params: Dict[str, Any]) -> None:
+        try:
+            await start(request_params, on_state=job.set_state)
+        except Exception as e:
+            job.set_state("failed", str(e))
+        else:
+            job.set_state("ready")
+            # A started instance's state is implied by `running_instances`
+            start_jobs.pop(job.run_id, None)
+
+    def prune_start_jobs() -> None:
+        cutoff = time.time() - START_JOB_RETENTION_S
+        for run_id in [rid for rid, job in start_jobs.items() if job.state == "failed" and job.updated_at < cutoff]:
+            del start_jobs[run_id]
+
+    @app.post("/start_instance")
+    async def start_instance(request: StartInstanceRequest):
+        # Convert request to dictionary
+        request_params = request.model_dump(exclude={"wait"})
+        if request.wait:
+            try:
+                instance_id = await start(request_params)
+            except InsufficientResourcesError as e:
+                # Nothing was started; clients may retry later
+                raise HTTPException(status_code=503, detail=str(e))
+            except InstanceExistsError as e:
+                raise HTTPException(status_code=409, detail=str(e))
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e))
+            return {"status": "success", "instance_id": instance_id}
+
+        prune_start_jobs()
+        job = start_jobs.get(request.run_id)
+        if request.run_id in runner.running_instances:
+            # Retried request for an instance that already started
+            return {"status": "success", "instance_id": request.run_id, "state": "ready"}
+        if job is None or job.state == "failed":
+            job = start_jobs[request.run_id] = StartJob(request.run_id)
+            job.task = asyncio.create_task(start_in_background(job, request_params))
+        return NegotiatedResponse(
+            {"status": "accepted", "instance_id": request.run_id, "state": job.state}, status_code=202
+        )
+
+    @app.post("/start_instances")
+    async def start_instances(request: StartInstancesRequest):
+        """
+        Start several instances in one call; results are returned in request order.
+
+        By default each instance is admitted and started on its own, concurrently, and a
+        failing start yields an error entry. With `all_or_nothing`, the combined resources
+        are reserved atomically and either every instance starts or none does: `503` if the
+        group cannot be admitted, `500` if an instance fails to start (those that started
+        are closed again).
+        """
+        requests = [item.model_dump(exclude={"wait"}) for item in request.instances]
+        if request.all_or_nothing:
+            try:
+                run_ids = await start_group(requests, request.queue_timeout, request.priority)
+            except InsufficientResourcesError as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            except (ValueError, NotImplementedError) as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e))
+            return {
+                "status": "success",
+                "results": [{"run_id": run_id, "status": "success", "instance_id": run_id} for run_id in run_ids],
+            }
+
+        async def start_one(request_params: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                instance_id = await start(request_params)
+                return {"run_id": request_params["run_id"], "status": "success", "instance_id": instance_id}
+            except Exception as e:
+                return {"run_id": request_params["run_id"], "status": "error", "error": str(e)}
+
+        results = await asyncio.gather(*(start_one(request_params) for request_params in requests))
+        return {"status": "success", "results": results}
+
+    @app.get("/wait_instance")
+    async def wait_instance(
+        run_id: str = Query(..., description="Run ID of the instance to wait for"),
+        timeout: float = Query(30.0, ge=0, le=300, description="Maximum seconds to wait"),
+    ):
+        """
+        Long-poll the start state of an instance.
+
+        Returns as soon as the instance is `ready` or `failed`, or after `timeout` seconds
+        with its current state (`pending`, `pulling` or `starting`).
+        """
+        job = start_jobs.get(run_id)
+        if job is not None and job.task is not None and not job.task.done():
+            await asyncio.wait({job.task}, timeout=timeout)
+        if job is not None and job.state != "ready":
+            return job.to_dict()
+        if run_id in runner.running_instances:
+            return {"run_id": run_id, "state": "ready", "error": None, "updated_at": runner.running_instances[run_id].get("created_at")}
+        raise HTTPException(status_code=404, detail="Instance not found")
 
     @app.post("/execute_command")
-    def execute_command(request: ExecuteCommandRequest):
+    async def execute_command(request: ExecuteCommandRequest, http_request: Request, response: Response):
+        """
+        Execute a command and return its output.
+
+        Disconnecting before the result arrives kills the command, as does `/cancel_command`
+        with its `command_id`; a cancelled command's result has `"cancelled": true`.
+        """
+        command = register_command(request.run_id, request.command_id)
+        watcher = asyncio.create_task(cancel_on_disconnect(http_request, command))
         try:
-            result = runner.execute_command(request.run_id, request.cmd)
+            if runner.forwards_commands:
+                return await forward_command(request, http_request, command)
+            result = await run_command(
+                request.run_id, request.cmd, timeout=request.timeout, output=request.output, command=command
+            )
+            response.headers[OUTPUT_CHARS_HEADER] = str(len(result.get("output") or ""))
             return {"status": "success", "result": result}
         except KeyError:
             raise HTTPException(status_code=404, detail="Instance not found")
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            watcher.cancel()
+
+    @app.post("/execute_command_stream")
+    async def execute_command_stream(request: ExecuteCommandRequest, http_request: Request):
+        """
+        Execute a command and stream its output as Server-Sent Events.
+
+        Emits `output` events (`{"output": ...}`) as the process writes, then a single
+        `result` event with the return code and timing, or an `error` event on failure.
+        Disconnecting early kills the command, as does `/cancel_command` with its `command_id`.
+        """
+        if request.run_id not in runner.running_instances:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        if request.command_id is not None and request.command_id in running_commands:
+            raise HTTPException(status_code=409, detail=f"Command {request.command_id} is already running")
+        if runner.forwards_commands:
+            return StreamingResponse(
+                forward_stream(request, http_request), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+            )
+
+        async def events() -> AsyncIterator[str]:
+            started = time.time()
+            try:
+                async for event in stream_command(request.run_id, request.cmd, request.timeout, request.command_id):
+                    if "output" in event:
+                        yield _sse_frame("output", event)
+                    else:
+                        yield _sse_frame("result", {
+                            "returncode": event["returncode"],
+                            "started_at": started,
+                            "duration_s": time.time() - started,
+                            **({"cancelled": True} if event.get("cancelled") else {}),
+                        })
+            except KeyError:
+                yield _sse_frame("error", {"error": "Instance not found"})
+            except HTTPException as e:
+                yield _sse_frame("error", {"error": e.detail})
+            except Exception as e:
+                yield _sse_frame("error", {"error": str(e)})
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    @app.post("/execute_batch")
+    async def execute_batch(request: ExecuteBatchRequest):
+        """
+        Execute many commands concurrently, at most `max_concurrency` at a time.
+
+        Results are returned in request order; a failing command yields an error entry
+        instead of failing the whole batch.
+        """
+        semaphore = asyncio.Semaphore(request.max_concurrency)
+
+        async def run_one(item: BatchCommand) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    command = register_command(item.run_id, item.command_id)
+                    result = await run_command(item.run_id, item.cmd, timeout=item.timeout, output=item.output, command=command)
+                    return {"run_id": item.run_id, "status": "success", "result": result}
+                except KeyError:
+                    return {"run_id": item.run_id, "status": "error", "error": "Instance not found"}
+                except HTTPException as e:
+                    return {"run_id": item.run_id, "status": "error", "error": e.detail}
+                except Exception as e:
+                    return {"run_id": item.run_id, "status": "error", "error": str(e)}
+
+        results = await asyncio.gather(*(run_one(item) for item in request.commands))
+        return {"status": "success", "results": results}
+
+    @app.websocket("/ws/{run_id}")
+    async def instance_channel(websocket: WebSocket, run_id: str):
+        """
+        Long-lived command channel for a single instance.
+
+        The client sends `{"id": ..., "cmd": ..., "timeout": ..., "stream": false}` messages;
+        commands run concurrently and each reply carries the request `id`:
+        `{"id": ..., "status": "success", "result": {...}}` or
+        `{"id": ..., "status": "error", "error": "..."}`. With `"stream": true`, the result is
+        preceded by `{"id": ..., "output": "..."}` messages as the command writes.
+        """
+        await websocket.accept()
+        if run_id not in runner.running_instances:
+            await websocket.close(code=4404, reason="Instance not found")
+            return
+
+        send_lock = asyncio.Lock()
+        pending: set[asyncio.Task] = set()
+
+        async def send(message: Dict[str, Any]) -> None:
+            async with send_lock:
+                await websocket.send_json(message)
+
+        async def run_one(command: WebSocketCommand) -> None:
+            try:
+                if command.stream:
+                    returncode = None
+                    async for event in stream_command(run_id, command.cmd, timeout=command.timeout):
+                        if "output" in event:
+                            await send({"id": command.id, "output": event["output"]})
+                        else:
+                            returncode = event["returncode"]
+                    result = {"returncode": returncode}
+                else:
+                    result = await run_command(run_id, command.cmd, timeout=command.timeout, output=command.output)
+                await send({"id": command.id, "status": "success", "result": result})
+            except KeyError:
+                await send({"id": command.id, "status": "error", "error": "Instance not found"})
+            except Exception as e:
+                await send({"id": command.id, "status": "error", "error": str(e)})
+
+        try:
+            while True:
+                message = await websocket.receive_json()
+                try:
+                    command = WebSocketCommand.model_validate(message)
+                except Exception as e:
+                    await send({"id": message.get("id") if isinstance(message, dict) else None, "status": "error", "error": str(e)})
+                    continue
+                task = asyncio.create_task(run_one(command))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @app.post("/cancel_command")
+    async def cancel_command(request: CancelCommandRequest):
+        """
+        Cancel a command started with a `command_id`, killing its whole process tree inside
+        the instance.
+
+        Returns once the command has ended (`"finished": true`), or after a few seconds if its
+        processes could not be killed; the command's own request then completes with
+        `"cancelled": true` in its result.
+        """
+        command = running_commands.get(request.command_id)
+        if command is None:
+            raise HTTPException(status_code=404, detail="Command not found")
+        finished = await cancel(command)
+        return {"status": "success", "run_id": command.run_id, "command_id": request.command_id, "finished": finished}
+
+    @app.post("/upload")
+    async def upload(
+        request: Request,
+        run_id: str = Query(..., description="Run ID of the instance"),
+        path: str = Query(..., description="Directory to extract the archive into (created if missing)"),
+    ):
+        """
+        Upload files as a tar archive (the raw request body), extracted into `path`.
+
+        The body is streamed into the instance, so binary files and large trees are fine.
+        """
+        try:
+            with runner.activity(run_id):
+                await runner.aupload(run_id, path, request.stream())
+        except Exception as e:
+            raise _transfer_error(e)
+        return {"status": "success"}
+
+    @app.get("/download")
+    async def download(
+        run_id: str = Query(..., description="Run ID of the instance"),
+        path: str = Query(..., description="File or directory to download"),
+    ):
+        """Download `path` as a tar archive, whose top-level entry is named after it."""
+        archive = runner.adownload(run_id, path)
+        try:
+            # Fail with a proper status code before the response starts
+            first = await anext(archive, b"")
+        except Exception as e:
+            raise _transfer_error(e)
+
+        async def body() -> AsyncIterator[bytes]:
+            with runner.activity(run_id):
+                yield first
+                async for chunk in archive:
+                    yield chunk
+
+        return StreamingResponse(body(), media_type="application/x-tar")
+
+    @app.post("/read_files")
+    async def read_files(request: ReadFilesRequest):
+        """
+        Read many files in one round trip.
+
+        Returns `files` keyed by path, each `{"content", "encoding", "size", "truncated"}` or
+        `{"error": ...}`. Content is UTF-8 text when possible and base64 otherwise.
+        """
+        try:
+            with runner.activity(request.run_id):
+                files = await runner.aread_files(request.run_id, request.paths, request.max_bytes)
+        except Exception as e:
+            raise _transfer_error(e)
+        return {"status": "success", "files": files}
+
+    @app.get("/output/{spill_id}")
+    async def get_output(request: Request, spill_id: str):
+        """
+        Fetch the full output of a truncated command (`spill_id` in its result).
+
+        Supports a single `Range: bytes=start-end` header, answered with `206 Partial Content`.
+        Outputs are kept for a limited time after the command finished.
+        """
+        try:
+            size = output_store.size(spill_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Output not found")
+        start, end = 0, size
+        status_code = 200
+        headers = {"Accept-Ranges": "bytes"}
+        if "range" in request.headers:
+            byte_range = parse_byte_range(request.headers["range"], size)
+            if byte_range is None:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["Content-Length"] = str(end - start)
+        return StreamingResponse(
+            output_store.iter_range(spill_id, start, end),
+            status_code=status_code,
+            media_type="text/plain; charset=utf-8",
+            headers=headers,
+        )
 
     @app.get("/get_available_resources")
-    def get_available_resources():
+    async def get_available_resources():
         return runner.get_available_resources()
 
+    @app.get("/images")
+    async def images():
+        """Images this service has started instances from, i.e. that start without a pull."""
+        return {"images": sorted(runner.warm_images)}
+
     @app.post("/close_instance")
-    def close_instance(request: CloseInstanceRequest):
+    async def close_instance(request: CloseInstanceRequest):
         try:
-            runner.close_instance(request.run_id)
+            await close(request.run_id)
             return {"status": "success"}
         except KeyError:
              raise HTTPException(status_code=404, detail="Instance not found")
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    @app.post("/close_instances")
+    async def close_instances(request: CloseInstancesRequest):
+        """
+        Close several instances concurrently, e.g. a group started with `/start_instances`.
+
+        Results are returned in request order; unknown run IDs yield an error entry.
+        """
+        async def close_one(run_id: str) -> Dict[str, Any]:
+            try:
+                await close(run_id)
+                return {"run_id": run_id, "status": "success"}
+            except KeyError:
+                return {"run_id": run_id, "status": "error", "error": "Instance not found"}
+            except Exception as e:
+                return {"run_id": run_id, "status": "error", "error": str(e)}
+
+        results = await asyncio.gather(*(close_one(run_id) for run_id in request.run_ids))
+        return {"status": "success", "results": results}
+
+    @app.post("/heartbeat")
+    async def heartbeat(request: HeartbeatRequest):
+        """Renew the idle lease of an instance; returns when it expires if no activity follows."""
+        try:
+            instance_data = runner.touch_instance(request.run_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        return {"status": "success", "expires_at": reaper.expires_at(instance_data)}
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        """Prometheus metrics: start/execute/close latency, output volume, timeouts and resources."""
+        return PlainTextResponse(metrics.render(), media_type=ServiceMetrics.CONTENT_TYPE)
+
     @app.get("/stats")
-    def stats(
+    async def stats(
+        request: Request,
         run_id: Optional[str] = Query(None, description="Filter by run ID"),
         container_name: Optional[str] = Query(None, description="Filter by container name"),
+        prefix: str = Query("", description="Filter by run ID prefix"),
+        container_image: Optional[str] = Query(None, description="Filter by exact container image"),
+        cursor: Optional[str] = Query(None, description="Return instances after this run ID"),
+        limit: Optional[int] = Query(None, ge=0, description="Maximum number of instances to return"),
+        fields: Optional[str] = Query(None, description="Comma-separated instance fields to return"),
     ):
         """
         Get server statistics with optional filtering.
         
         - **run_id**: Filter instances by run ID (partial match supported)
         - **container_name**: Filter instances by container name (partial match supported)
+        - **prefix** / **container_image**: Indexed filters by run ID prefix / exact image
+        - **cursor** / **limit**: Page through instances in run ID order; follow `next_cursor`
+        - **fields**: Only include these instance fields (`run_id` is always included)
+
+        Responses carry an `ETag`; sending it back in `If-None-Match` returns `304 Not Modified`
+        while nothing but time-derived fields (`server_time`, `uptime_s`, wait times, ...) changed.
         """
+        registry = runner.running_instances
+        pending_starts = sum(1 for job in start_jobs.values() if job.state != "failed")
+        # Built from counters only, so an unchanged snapshot is answered without building it
+        version = (
+            started_at, runner.stats_version(), metrics.totals(), reaper.reaped, reaper.failed, pending_starts,
+            request.url.query,
+        )
+        etag = f'W/"{hashlib.blake2b(repr(version).encode(), digest_size=8).hexdigest()}"'
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        if run_id or container_name or prefix or container_image:
+            matched = [
+                rid for rid in registry.run_ids(prefix, container_image=container_image)
+                if (not run_id or run_id in rid)
+                and (not container_name or container_name in registry[rid].get("container_image", ""))
+            ]
+            container_counts: Dict[str, int] = {}
+            for rid in matched:
+                container = registry[rid].get("container_image", "unknown")
+                container_counts[container] = container_counts.get(container, 0) + 1
+            active_instances = len(matched)
+            page_ids: Iterable[str] = matched[bisect.bisect_right(matched, cursor):] if cursor is not None else matched
+        else:
+            container_counts = registry.container_counts()
+            active_instances = len(registry)
+            page_ids = registry.run_ids(after=cursor)
+
+        page = list(itertools.islice(page_ids, None if limit is None else limit + 1))
+        next_cursor = None
+        if limit is not None and len(page) > limit:
+            page = page[:limit]
+            next_cursor = page[-1] if page else cursor
+        selected = None if fields is None else {field.strip() for field in fields.split(",")} | {"run_id"}
+
         instances: List[Dict[str, Any]] = []
-        container_counts: Dict[str, int] = {}
-        
-        for rid, instance_data in runner.running_instances.items():
-            # Apply filters
-            if run_id and run_id not in rid:
-                continue
-            if container_name:
-                instance_container = instance_data.get("container_image", "")
-                if container_name not in instance_container:
-                    continue
-            
-            container = instance_data.get("container_image", "unknown")
-            container_counts[container] = container_counts.get(container, 0) + 1
-            instances.append({
+        for rid in page:
+            instance_data = registry[rid]
+            instance = {
                 "run_id": rid,
-                "container_image": container,
+                "container_image": instance_data.get("container_image", "unknown"),
                 "created_at": instance_data.get("created_at"),
                 "updated_at": instance_data.get("updated_at"),
                 "num_cmd": instance_data.get("num_cmd"),
+                "last_active_at": instance_data.get("last_active_at"),
+                "busy_s": instance_data.get("busy_s", 0.0),
+                "expires_at": reaper.expires_at(instance_data),
                 "environment_config": instance_data.get("environment_config", {}),
-            })
+            }
+            if "node" in instance_data:
+                instance["node"] = instance_data["node"]
+            if selected is not None:
+                instance = {key: value for key, value in instance.items() if key in selected}
+            instances.append(instance)
         
-        return {
-            "server_time": time.time(),
-            "uptime_s": time.time() - started_at,
-            "active_instances": len(instances),
-            "total_instances": len(runner.running_instances),
+        now = time.time()
+        content = {
+            "server_time": now,
+            "uptime_s": now - started_at,
+            "active_instances": active_instances,
+            "total_instances": len(registry),
             "max_resources": runner.max_resources,
             "allocated_resources": runner.allocated_resources,
             "available_resources": runner.get_available_resources(),
             "container_counts": container_counts,
+            "pending_starts": pending_starts,
+            "admission_queue": runner.admission_queue.stats(),
+            "start_limits": runner.start_limits.stats(),
+            "workers": runner.workers.sizes,
+            "tenants": runner.get_tenant_stats(),
+            "recovery": runner.recovery,
+            "reaper": reaper.stats(),
+            "totals": metrics.totals(),
             "instances": instances,
+            "next_cursor": next_cursor,
+            **runner.extra_stats(),
         }
+        return NegotiatedResponse(content, headers={"ETag": etag})
 
     return app
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Compare the per-command round-trip latency of the API over TCP loopback and over a Unix
+domain socket.
+
+Commands go to a trivial in-process environment that answers immediately, so the numbers
+are the cost of the service and its transport rather than of running a shell.
+Usage:
+    python benchmarks/transport_latency.py --commands 5000
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import Client, RetryPolicy
+from environments.base import Environment
+
+ECHO_ENVIRONMENT = "benchmarks.transport_latency.EchoEnvironment"
+
+
+class EchoEnvironment(Environment):
+    """Returns the command as its output without running anything."""
+
+    def __init__(self, **kwargs: Any):
+        pass
+
+    def execute(self, command: str, cwd: str = "", *, timeout: Optional[int] = None) -> Dict[str, Any]:
+        return {"output": command, "returncode": 0}
+
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: Optional[int] = None) -> Dict[str, Any]:
+        return self.execute(command, cwd, timeout=timeout)
+
+
+def run_server(port: int, uds: str) -> None:
+    from api import create_app
+    from cli import serve
+    from runners.local import LocalRunner
+
+    serve(create_app(LocalRunner({"instances": 1})), host="127.0.0.1", port=port, uds=uds)
+
+
+def wait_until_up(service: Client, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            service.stats(limit=0)
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def measure(service: Client, run_id: str, commands: int, warmup: int) -> List[float]:
+    """Seconds per round trip of `commands` sequential `execute_command` calls."""
+    for _ in range(warmup):
+        service.execute_command(run_id, "true")
+    latencies = []
+    for i in range(commands):
+        started = time.perf_counter()
+        service.execute_command(run_id, f"echo {i}")
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def report(name: str, latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    summary = {
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p90": ordered[int(len(ordered) * 0.9)],
+        "p99": ordered[int(len(ordered) * 0.99)],
+    }
+    print(f"{name:<5} " + "  ".join(f"{key} {value * 1e6:8.1f}us" for key, value in summary.items()))
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-command latency over TCP vs. Unix domain socket")
+    parser.add_argument("--commands", type=int, default=2000, help="Measured commands per transport (default: 2000)")
+    parser.add_argument("--warmup", type=int, default=200, help="Unmeasured commands per transport (default: 200)")
+    parser.add_argument("--port", type=int, default=18008, help="TCP port of the benchmark server (default: 18008)")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--uds", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.port, args.uds)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uds = os.path.join(tmp, "arservice.sock")
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port), "--uds", uds],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        no_retry = RetryPolicy(attempts=1)
+        try:
+            with Client(f"http://127.0.0.1:{args.port}", max_concurrency=1, retry=no_retry) as tcp, \
+                 Client("http://localhost", uds=uds, max_concurrency=1, retry=no_retry) as unix:
+                wait_until_up(tcp)
+                wait_until_up(unix)
+                tcp.start_instance("bench", "none", ECHO_ENVIRONMENT)
+                print(f"{args.commands} sequential commands per transport, keep-alive connection")
+                # Interleave the runs so drift (CPU frequency, caches) affects both alike
+                results: Dict[str, List[float]] = {"tcp": [], "uds": []}
+                for _ in range(4):
+                    results["tcp"] += measure(tcp, "bench", args.commands // 4, args.warmup // 4)
+                    results["uds"] += measure(unix, "bench", args.commands // 4, args.warmup // 4)
+                tcp_summary = report("tcp", results["tcp"])
+                uds_summary = report("uds", results["uds"])
+                print(f"uds/tcp mean latency: {uds_summary['mean'] / tcp_summary['mean']:.2f}x")
+                tcp.close_instance("bench")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
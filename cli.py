@@ -2,44 +2,185 @@ import argparse
 import uvicorn
 import json
 import logging
+import os
+import shlex
+import socket
+from typing import List, Optional
+from runners.federated import DEFAULT_NODE_CONCURRENCY, FederatedRunner
 from runners.local import LocalRunner
-from runners.slurm import SlurmRunner
+from runners.sharded import ShardedRunner
+from runners.slurm import DEFAULT_AGENT_DIR, SlurmRunner
+from runners.workers import (
+    DEFAULT_CLOSE_WORKERS,
+    DEFAULT_EXECUTE_WORKERS,
+    DEFAULT_MAX_CONCURRENT_STARTS,
+    DEFAULT_START_WORKERS,
+    StartLimits,
+    WorkerPools,
+)
 from api import create_app
+from codec import DEFAULT_COMPRESS_MIN_BYTES
+from output import OutputPolicy, OutputStore
+
+def bind_unix_socket(path: str) -> socket.socket:
+    """Binds a Unix domain socket at `path`, replacing a stale socket file left by a dead server."""
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+        else:
+            raise OSError(f"{path} is in use by another server")
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o666)
+    return sock
+
+
+def serve(app, host: str = "0.0.0.0", port: Optional[int] = 8008, uds: Optional[str] = None) -> None:
+    """Runs the API on TCP `host:port` and/or the Unix domain socket `uds`, in one server process."""
+    config = uvicorn.Config(app, host=host, port=port or 0)
+    sockets: List[socket.socket] = []
+    try:
+        if port is not None:
+            sock = config.bind_socket()
+            # asyncio only disables Nagle on accepted sockets created with an explicit TCP proto;
+            # accepted sockets inherit the option from the listener instead
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sockets.append(sock)
+        if uds is not None:
+            sockets.append(bind_unix_socket(uds))
+        # One server for all listeners, so the lifespan (e.g. the idle reaper) runs once
+        uvicorn.Server(config).run(sockets=sockets)
+    finally:
+        for sock in sockets:
+            sock.close()
+        if uds is not None and os.path.exists(uds):
+            os.unlink(uds)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Agent Rollout Service CLI")
-    parser.add_argument("--runner", choices=["local", "slurm"], required=True, help="Runner type")
+    parser.add_argument("--runner", choices=["local", "slurm", "federated"], required=True, help="Runner type")
+    parser.add_argument("--nodes", type=str, default="", help="Comma-separated URLs of the arservice nodes a federated runner places instances on")
+    parser.add_argument("--node-concurrency", type=int, default=DEFAULT_NODE_CONCURRENCY, help="Commands a federated runner (or --shards) sends to each node (shard) at once; starts, heartbeats and closes have slots of their own")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to run the TCP API on")
     parser.add_argument("--port", type=int, default=8008, help="Port to run the API on")
-    parser.add_argument("--resources", type=str, default='{"instances": 10}', help="JSON string for available resources")
+    parser.add_argument("--uds", type=str, default=None, help="Also serve the API on this Unix domain socket, for clients on the same node")
+    parser.add_argument("--no-tcp", action="store_true", help="Only serve on the Unix domain socket given by --uds")
+    parser.add_argument("--resources", type=str, default=None, help='JSON string for available resources (default: {"instances": 10}; federated: the sum of the nodes)')
+    parser.add_argument("--max-output-bytes", type=int, default=0, help="Maximum command output returned inline; the rest is spilled to disk (default 0: unlimited)")
+    parser.add_argument("--output-dir", type=str, default=None, help="Directory for spilled command output (default: a temporary directory)")
+    parser.add_argument("--state-db", type=str, default=None, help="SQLite database persisting running instances across restarts (default: ~/.arservice/<runner>-<port>.db, '' to disable)")
+    parser.add_argument("--keep-instances-on-exit", action="store_true", help="Leave instances running when the service stops, to be re-adopted from --state-db by the next start")
+    parser.add_argument("--reap-orphans", action="store_true", help="On startup, also remove containers/jobs the service started but never recorded")
+    parser.add_argument("--idle-ttl", type=float, default=0, help="Close instances idle (no commands or heartbeats) for this many seconds (default 0: never)")
+    parser.add_argument("--compress-min-bytes", type=int, default=DEFAULT_COMPRESS_MIN_BYTES, help="Compress responses of at least this many bytes for clients accepting zstd/gzip (0: never)")
+    parser.add_argument("--start-workers", type=int, default=DEFAULT_START_WORKERS, help="Threads for blocking instance starts (image pulls, sandbox builds)")
+    parser.add_argument("--execute-workers", type=int, default=DEFAULT_EXECUTE_WORKERS, help="Threads for commands of environments without native asyncio support")
+    parser.add_argument("--close-workers", type=int, default=DEFAULT_CLOSE_WORKERS, help="Threads for blocking instance teardowns")
+    parser.add_argument("--max-concurrent-starts", type=int, default=DEFAULT_MAX_CONCURRENT_STARTS, help="Upper bound of the adaptive limit on concurrent starts per container runtime")
+    parser.add_argument("--shards", type=int, default=1, help="Spread the instances of a local runner over this many worker processes, to use more than one core")
+    parser.add_argument("--slots-per-allocation", type=int, default=1, help="Pack this many instances of a Slurm runner into one sleeper job (1: a job per instance)")
+    parser.add_argument("--allocation-args", type=str, default="", help='sbatch arguments of packed Slurm allocations, as a JSON list or a shell string, e.g. "--nodes=1 --exclusive"')
+    parser.add_argument("--exec-agent", nargs="?", const=DEFAULT_AGENT_DIR, default=None, metavar="DIR", help=f"Run commands of a Slurm runner through an agent in each sleeper job instead of srun; the agents publish their address in DIR, shared with the compute nodes (default: {DEFAULT_AGENT_DIR})")
+    parser.add_argument("--tenants", type=str, default="{}", help='JSON string of tenant quotas/weights keyed by run ID prefix, e.g. {"eval-": {"quota": {"instances": 4}, "weight": 2}}')
     
     args = parser.parse_args()
+    if args.no_tcp and not args.uds:
+        parser.error("--no-tcp requires --uds")
+    if args.runner == "federated" and not args.nodes:
+        parser.error("--runner federated requires --nodes")
+    if args.shards < 1 or (args.shards > 1 and args.runner != "local"):
+        parser.error("--shards must be at least 1 and requires --runner local")
+    if args.slots_per_allocation < 1 or (args.slots_per_allocation > 1 and args.runner != "slurm"):
+        parser.error("--slots-per-allocation must be at least 1 and requires --runner slurm")
+    if args.exec_agent is not None and args.runner != "slurm":
+        parser.error("--exec-agent requires --runner slurm")
+    if args.keep_instances_on_exit and args.state_db == "":
+        parser.error("--keep-instances-on-exit requires --state-db")
 
     # Configure logging
     logging.basicConfig(level=logging.INFO)
 
     try:
-        resources = json.loads(args.resources)
+        resources = json.loads(args.resources) if args.resources else None
     except json.JSONDecodeError:
         print("Error: Invalid JSON for --resources")
         return
 
-    if args.runner == "local":
-        runner = LocalRunner(resources)
+    try:
+        tenants = json.loads(args.tenants)
+    except json.JSONDecodeError:
+        print("Error: Invalid JSON for --tenants")
+        return
+
+    state_path = args.state_db
+    if state_path is None:
+        state_path = os.path.expanduser(f"~/.arservice/{args.runner}-{args.port}.db")
+
+    output_policy = OutputPolicy(max_bytes=args.max_output_bytes) if args.max_output_bytes > 0 else None
+    output_store = OutputStore(args.output_dir)
+    workers = WorkerPools(start=args.start_workers, execute=args.execute_workers, close=args.close_workers)
+    start_limits = StartLimits(args.max_concurrent_starts)
+    if args.runner == "federated":
+        nodes = [url.strip() for url in args.nodes.split(",") if url.strip()]
+        runner = FederatedRunner(
+            nodes, resources, tenants, state_path or None, workers, start_limits, node_concurrency=args.node_concurrency
+        )
+    elif args.runner == "local" and args.shards > 1:
+        runner = ShardedRunner(
+            resources or {"instances": 10}, args.shards, tenants, state_path or None, workers, start_limits,
+            max_output_bytes=args.max_output_bytes,
+            output_dir=output_store.directory,
+            compress_min_bytes=args.compress_min_bytes,
+            keep_instances=args.keep_instances_on_exit,
+            node_concurrency=args.node_concurrency,
+        )
+        # The shards limit the output, spilling it where this process serves `/output` from
+        output_policy = None
+    elif args.runner == "local":
+        runner = LocalRunner(resources or {"instances": 10}, tenants, state_path or None, workers, start_limits)
     elif args.runner == "slurm":
-        runner = SlurmRunner(resources)
+        allocation_args = args.allocation_args.strip()
+        allocation_args = json.loads(allocation_args) if allocation_args.startswith("[") else shlex.split(allocation_args)
+        runner = SlurmRunner(
+            resources or {"instances": 10},
+            tenants,
+            state_path or None,
+            workers,
+            start_limits,
+            slots_per_allocation=args.slots_per_allocation,
+            allocation_args=allocation_args,
+            agent_dir=args.exec_agent,
+        )
     else:
         # Should be caught by argparse choices
         print("Invalid runner type")
         return
 
-    app = create_app(runner)
+    # Re-adopt instances that survived a previous run of the service
+    runner.recover(reap_orphans=args.reap_orphans)
+
+    app = create_app(
+        runner,
+        output_policy=output_policy,
+        output_store=output_store,
+        idle_ttl=args.idle_ttl or None,
+        compress_min_bytes=args.compress_min_bytes or None,
+        keep_instances=args.keep_instances_on_exit,
+    )
     
     # Suppress /stats logging
     from api import EndpointFilter
     logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
-    print(f"Starting {args.runner} runner API on port {args.port}...")
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
+    listeners = ([] if args.no_tcp else [f"{args.host}:{args.port}"]) + ([f"unix:{args.uds}"] if args.uds else [])
+    print(f"Starting {args.runner} runner API on {', '.join(listeners)}...")
+    serve(app, host=args.host, port=None if args.no_tcp else args.port, uds=args.uds)
 
 if __name__ == "__main__":
     main()
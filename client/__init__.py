@@ -0,0 +1,32 @@
+"""Python client for the Agent Rollout Service.
+
+    from client import Client
+
+    with Client("http://127.0.0.1:8008") as service:
+        with service.instance("run-1", "python:3.11", "docker") as instance:
+            print(instance.execute("python --version").output)
+"""
+
+from client.aio import AsyncClient, AsyncInstance
+from client.base import (
+    AdmissionRejectedError,
+    CommandResult,
+    InstanceNotFoundError,
+    RetryPolicy,
+    ServiceError,
+    Stats,
+)
+from client.sync import Client, Instance
+
+__all__ = [
+    "AdmissionRejectedError",
+    "AsyncClient",
+    "AsyncInstance",
+    "Client",
+    "CommandResult",
+    "Instance",
+    "InstanceNotFoundError",
+    "RetryPolicy",
+    "ServiceError",
+    "Stats",
+]
@@ -0,0 +1,250 @@
+import asyncio
+import contextlib
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+import httpx
+from tenacity import AsyncRetrying
+
+from client.base import (
+    DEFAULT_CONTROL_CONCURRENCY,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_TIMEOUT,
+    DEFAULT_URL,
+    CommandResult,
+    InstanceNotFoundError,
+    RetryPolicy,
+    ServiceError,
+    Stats,
+    command_payload,
+    encode_request,
+    msgpack,
+    parse_response,
+    start_payload,
+)
+
+
+class AsyncClient:
+    """asyncio client for the Agent Rollout Service; the counterpart of `Client`.
+
+    Share one client between all tasks of an event loop: requests use a pool of
+    keep-alive connections, at most `max_concurrency` commands and `control_concurrency`
+    other requests are in flight at once, and failed requests are retried per `retry`.
+    """
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_URL,
+        *,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        control_concurrency: int = DEFAULT_CONTROL_CONCURRENCY,
+        retry: Optional[RetryPolicy] = None,
+        timeout: Union[float, httpx.Timeout] = DEFAULT_TIMEOUT,
+        use_msgpack: bool = False,
+        uds: Optional[str] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        """
+        - **max_concurrency** / **control_concurrency**: requests in flight at once running
+          commands / doing anything else, which thus never waits for commands to end
+        - **use_msgpack**: exchange MessagePack instead of JSON bodies (needs the `msgpack` package)
+        - **uds**: connect through this Unix domain socket (see `arservice --uds`) instead of TCP
+        - **http_client**: use this client instead of creating one (e.g. with an `httpx.ASGITransport`)
+        """
+        if use_msgpack and msgpack is None:
+            raise ImportError("The msgpack package is required for use_msgpack. Please install it with: pip install msgpack")
+        self.retry = retry or RetryPolicy()
+        self.use_msgpack = use_msgpack
+        self._owns_http = http_client is None
+        connections = max_concurrency + control_concurrency
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        self._http = http_client or httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            transport=httpx.AsyncHTTPTransport(limits=limits, uds=uds),
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._control_slots = asyncio.Semaphore(control_concurrency)
+
+    async def _request(
+        self, method: str, path: str, *, idempotent: bool = False, command: bool = False, **kwargs: Any
+    ) -> Any:
+        kwargs = encode_request(kwargs, self.use_msgpack)
+        async for attempt in AsyncRetrying(**self.retry.retrying_kwargs(idempotent)):
+            with attempt:
+                async with self._slots if command else self._control_slots:
+                    response = await self._http.request(method, path, **kwargs)
+                return parse_response(response)
+
+    async def start_instance(self, run_id: str, container_image: str, container_type: str, **config: Any) -> str:
+        """Starts an instance and returns its ID; `config` holds the other `/start_instance` fields."""
+        payload = start_payload(run_id, container_image, container_type, config)
+        return (await self._request("POST", "/start_instance", json=payload))["instance_id"]
+
+    async def start_instances(
+        self, instances: List[Dict[str, Any]], all_or_nothing: bool = False, **group: Any
+    ) -> List[Dict[str, Any]]:
+        """Starts several instances, returning a result per instance; `instances` hold
+        `/start_instance` bodies and `group` the group's `queue_timeout` / `priority`.
+
+        With `all_or_nothing`, either all start or none does (`AdmissionRejectedError` if the
+        group does not fit, `ServiceError` if one failed to start).
+        """
+        payload = {"instances": instances, "all_or_nothing": all_or_nothing, **group}
+        return (await self._request("POST", "/start_instances", json=payload))["results"]
+
+    async def execute_command(
+        self,
+        run_id: str,
+        cmd: str,
+        output: Optional[Dict[str, Any]] = None,
+        *,
+        timeout: Optional[int] = None,
+        command_id: Optional[str] = None,
+    ) -> CommandResult:
+        """Runs a command; `output` sets per-command output limits (see `OutputPolicy`), `timeout`
+        overrides the environment's default and `command_id` makes it cancellable."""
+        payload = command_payload(run_id, cmd, output, timeout, command_id)
+        data = await self._request("POST", "/execute_command", json=payload, command=True)
+        return CommandResult(**data["result"])
+
+    async def stream_command(
+        self, run_id: str, cmd: str, *, timeout: Optional[int] = None, command_id: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Runs a command, yielding `{"output": ...}` chunks as it writes them and then its result
+        (`returncode`, `duration_s`, ...). An `error` event raises `ServiceError`; leaving the
+        loop early kills the command."""
+        payload = command_payload(run_id, cmd, None, timeout, command_id)
+        async with self._slots:
+            async with self._http.stream("POST", "/execute_command_stream", json=payload) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    parse_response(response)
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[len("data: "):])
+                        if event == "error":
+                            raise ServiceError(500, data["error"])
+                        yield data
+
+    async def upload(self, run_id: str, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Extracts a tar archive, streamed from `archive`, into the directory `path` of the instance."""
+        # A streamed body cannot be sent twice, so this is not retried
+        async with self._slots:
+            response = await self._http.post("/upload", params={"run_id": run_id, "path": path}, content=archive)
+        parse_response(response)
+
+    async def download(self, run_id: str, path: str) -> AsyncIterator[bytes]:
+        """Yields a tar archive of `path` (a file or directory) in the instance."""
+        async with self._slots:
+            async with self._http.stream("GET", "/download", params={"run_id": run_id, "path": path}) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    parse_response(response)
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+
+    async def read_files(
+        self, run_id: str, paths: List[str], max_bytes: Optional[int] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """Reads many files of the instance in one round trip (see `POST /read_files`)."""
+        payload: Dict[str, Any] = {"run_id": run_id, "paths": list(paths)}
+        if max_bytes is not None:
+            payload["max_bytes"] = max_bytes
+        return (await self._request("POST", "/read_files", json=payload, idempotent=True, command=True))["files"]
+
+    async def cancel_command(self, command_id: str) -> bool:
+        """Kills a command started with `command_id`; returns whether it has ended."""
+        return (await self._request("POST", "/cancel_command", json={"command_id": command_id}))["finished"]
+
+    async def close_instance(self, run_id: str) -> None:
+        await self._request("POST", "/close_instance", json={"run_id": run_id}, idempotent=True)
+
+    async def close_instances(self, run_ids: List[str]) -> List[Dict[str, Any]]:
+        payload = {"run_ids": list(run_ids)}
+        return (await self._request("POST", "/close_instances", json=payload, idempotent=True))["results"]
+
+    async def available_resources(self) -> Dict[str, Any]:
+        return await self._request("GET", "/get_available_resources", idempotent=True)
+
+    async def images(self) -> List[str]:
+        """Images the service has started instances from (cached on its node)."""
+        return (await self._request("GET", "/images", idempotent=True))["images"]
+
+    async def heartbeat(self, run_id: str) -> Optional[float]:
+        """Renews the idle lease of an instance, returning when it expires."""
+        return (await self._request("POST", "/heartbeat", json={"run_id": run_id}, idempotent=True))["expires_at"]
+
+    async def stats(self, **params: Any) -> Stats:
+        """Server statistics; `params` are the `/stats` query parameters (`limit`, `prefix`, ...)."""
+        params = {key: value for key, value in params.items() if value is not None}
+        return Stats(**await self._request("GET", "/stats", params=params, idempotent=True))
+
+    @contextlib.asynccontextmanager
+    async def instance(
+        self, run_id: str, container_image: str, container_type: str, **config: Any
+    ) -> AsyncIterator["AsyncInstance"]:
+        """Starts an instance for the duration of an `async with` block, closing it however the
+        block exits (including cancellation)."""
+        try:
+            await self.start_instance(run_id, container_image, container_type, **config)
+        except (httpx.TransportError, asyncio.CancelledError):
+            # The service may have started it before the connection failed
+            with contextlib.suppress(Exception):
+                await asyncio.shield(self.close_instance(run_id))
+            raise
+        try:
+            yield AsyncInstance(self, run_id)
+        finally:
+            # Shielded so a cancelled task still releases its instance
+            with contextlib.suppress(InstanceNotFoundError):
+                await asyncio.shield(self.close_instance(run_id))
+
+    @contextlib.asynccontextmanager
+    async def forward(
+        self, method: str, path: str, *, json: Dict[str, Any], headers: Dict[str, str]
+    ) -> AsyncIterator[httpx.Response]:
+        """Sends a request as-is, yielding the response with its body unread so a proxy can relay
+        it with `aiter_raw` (neither decoded nor decompressed). Error statuses are not raised and
+        the request is not retried."""
+        async with self._slots:
+            request = self._http.build_request(method, path, json=json, headers=headers)
+            response = await self._http.send(request, stream=True)
+            try:
+                yield response
+            finally:
+                await response.aclose()
+
+    async def aclose(self) -> None:
+        if self._owns_http:
+            await self._http.aclose()
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+
+class AsyncInstance:
+    """A started instance, bound to the client that started it."""
+
+    def __init__(self, client: AsyncClient, run_id: str):
+        self.client = client
+        self.run_id = run_id
+
+    async def execute(
+        self,
+        cmd: str,
+        output: Optional[Dict[str, Any]] = None,
+        *,
+        timeout: Optional[int] = None,
+        command_id: Optional[str] = None,
+    ) -> CommandResult:
+        return await self.client.execute_command(self.run_id, cmd, output, timeout=timeout, command_id=command_id)
+
+    async def heartbeat(self) -> Optional[float]:
+        return await self.client.heartbeat(self.run_id)
@@ -0,0 +1,164 @@
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+from pydantic import BaseModel, ConfigDict
+from tenacity import (
+    before_sleep_log,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("arservice.client")
+
+DEFAULT_URL = "http://127.0.0.1:8008"
+DEFAULT_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+"""Commands can run for minutes, connecting should not."""
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_CONTROL_CONCURRENCY = 16
+"""Slots of the requests other than commands (starts, heartbeats, closes, ...), so that
+these are not queued behind long-running commands."""
+MSGPACK = "application/msgpack"
+
+
+class ServiceError(Exception):
+    """The service answered with an error status."""
+
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class InstanceNotFoundError(ServiceError, KeyError):
+    """The run ID is unknown to the service (never started, closed or reaped)."""
+
+    def __str__(self) -> str:
+        return Exception.__str__(self)
+
+
+class AdmissionRejectedError(ServiceError):
+    """A start (or an all-or-nothing group start) was rejected because the service has no
+    free resources (503)."""
+
+
+class CommandResult(BaseModel):
+    output: str
+    returncode: Optional[int] = None
+    truncated: bool = False
+    output_bytes: Optional[int] = None
+    output_lines: Optional[int] = None
+    spill_id: Optional[str] = None
+    """Fetch the full output with `get_output` when `truncated`."""
+    cancelled: bool = False
+    """Killed by `cancel_command` (or a disconnect) before it finished."""
+
+
+class Stats(BaseModel):
+    """Response of `GET /stats`; fields not listed here are kept as extras."""
+
+    model_config = ConfigDict(extra="allow")
+
+    server_time: float
+    uptime_s: float
+    active_instances: int
+    total_instances: int
+    max_resources: Dict[str, Any] = {}
+    allocated_resources: Dict[str, Any] = {}
+    available_resources: Dict[str, Any] = {}
+    container_counts: Dict[str, int] = {}
+    instances: List[Dict[str, Any]] = []
+    next_cursor: Optional[str] = None
+
+
+class RetryPolicy(BaseModel):
+    """When and how requests are retried.
+
+    Waits are drawn uniformly from [0, min(max_wait, multiplier * 2^attempt)] ("full jitter"),
+    so clients rejected together do not come back together.
+    """
+
+    attempts: int = 5
+    multiplier: float = 0.5
+    max_wait: float = 30.0
+    retry_admission: bool = True
+    """Retry starts rejected for lack of resources (set `queue_timeout` to wait server-side instead)."""
+
+    def should_retry(self, exc: BaseException, idempotent: bool) -> bool:
+        if isinstance(exc, AdmissionRejectedError):
+            return self.retry_admission
+        # The request never reached the service
+        if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return True
+        if not idempotent:
+            # The service may have acted on it; running a command twice is not safe
+            return False
+        if isinstance(exc, ServiceError):
+            return exc.status_code in (502, 503, 504)
+        return isinstance(exc, httpx.TransportError)
+
+    def retrying_kwargs(self, idempotent: bool) -> Dict[str, Any]:
+        """Arguments for `tenacity.Retrying` / `tenacity.AsyncRetrying`."""
+        return dict(
+            reraise=True,
+            stop=stop_after_attempt(max(self.attempts, 1)),
+            wait=wait_random_exponential(multiplier=self.multiplier, max=self.max_wait),
+            retry=retry_if_exception(lambda exc: self.should_retry(exc, idempotent)),
+            before_sleep=before_sleep_log(logger, logging.WARNING),
+        )
+
+
+def encode_request(kwargs: Dict[str, Any], use_msgpack: bool) -> Dict[str, Any]:
+    """Request arguments for httpx, sending the `json` body as MessagePack if `use_msgpack`."""
+    if not use_msgpack:
+        return kwargs
+    kwargs = dict(kwargs, headers={**kwargs.get("headers", {}), "Accept": MSGPACK})
+    if "json" in kwargs:
+        kwargs["content"] = msgpack.packb(kwargs.pop("json"), use_bin_type=True)
+        kwargs["headers"]["Content-Type"] = MSGPACK
+    return kwargs
+
+
+def decode_body(response: httpx.Response) -> Any:
+    if response.headers.get("content-type", "").startswith(MSGPACK):
+        return msgpack.unpackb(response.content, raw=False)
+    return response.json()
+
+
+def parse_response(response: httpx.Response) -> Any:
+    """Returns the decoded body of a successful response, raising `ServiceError` otherwise."""
+    if response.status_code < 400:
+        return decode_body(response)
+    try:
+        detail = decode_body(response).get("detail", response.text)
+    except ValueError:
+        detail = response.text
+    if response.status_code == 404 and detail == "Instance not found":
+        raise InstanceNotFoundError(response.status_code, detail)
+    if response.status_code == 503 and response.request.url.path.endswith(("/start_instance", "/start_instances")):
+        raise AdmissionRejectedError(response.status_code, detail)
+    raise ServiceError(response.status_code, detail)
+
+
+def start_payload(run_id: str, container_image: str, container_type: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    return {"run_id": run_id, "container_image": container_image, "container_type": container_type, **config}
+
+
+def command_payload(
+    run_id: str,
+    cmd: str,
+    output: Optional[Dict[str, Any]],
+    timeout: Optional[int] = None,
+    command_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"run_id": run_id, "cmd": cmd}
+    for key, value in (("output", output), ("timeout", timeout), ("command_id", command_id)):
+        if value is not None:
+            payload[key] = value
+    return payload
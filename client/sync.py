@@ -0,0 +1,182 @@
+import contextlib
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import httpx
+from tenacity import Retrying
+
+from client.base import (
+    DEFAULT_CONTROL_CONCURRENCY,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_TIMEOUT,
+    DEFAULT_URL,
+    CommandResult,
+    InstanceNotFoundError,
+    RetryPolicy,
+    Stats,
+    command_payload,
+    encode_request,
+    msgpack,
+    parse_response,
+    start_payload,
+)
+
+
+class Client:
+    """Blocking client for the Agent Rollout Service.
+
+    Requests share a pool of keep-alive connections, at most `max_concurrency` commands and
+    `control_concurrency` other requests are in flight at once (across threads), and failed
+    requests are retried per `retry`.
+    """
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_URL,
+        *,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        control_concurrency: int = DEFAULT_CONTROL_CONCURRENCY,
+        retry: Optional[RetryPolicy] = None,
+        timeout: Union[float, httpx.Timeout] = DEFAULT_TIMEOUT,
+        use_msgpack: bool = False,
+        uds: Optional[str] = None,
+        http_client: Optional[httpx.Client] = None,
+    ):
+        """
+        - **max_concurrency** / **control_concurrency**: requests in flight at once running
+          commands / doing anything else, which thus never waits for commands to end
+        - **use_msgpack**: exchange MessagePack instead of JSON bodies (needs the `msgpack` package)
+        - **uds**: connect through this Unix domain socket (see `arservice --uds`) instead of TCP
+        - **http_client**: use this client instead of creating one (e.g. a FastAPI `TestClient`)
+        """
+        if use_msgpack and msgpack is None:
+            raise ImportError("The msgpack package is required for use_msgpack. Please install it with: pip install msgpack")
+        self.retry = retry or RetryPolicy()
+        self.use_msgpack = use_msgpack
+        self._owns_http = http_client is None
+        connections = max_concurrency + control_concurrency
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        self._http = http_client or httpx.Client(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            transport=httpx.HTTPTransport(limits=limits, uds=uds),
+        )
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._control_slots = threading.BoundedSemaphore(control_concurrency)
+
+    def _request(
+        self, method: str, path: str, *, idempotent: bool = False, command: bool = False, **kwargs: Any
+    ) -> Any:
+        kwargs = encode_request(kwargs, self.use_msgpack)
+        for attempt in Retrying(**self.retry.retrying_kwargs(idempotent)):
+            with attempt:
+                with self._slots if command else self._control_slots:
+                    response = self._http.request(method, path, **kwargs)
+                return parse_response(response)
+
+    def start_instance(self, run_id: str, container_image: str, container_type: str, **config: Any) -> str:
+        """Starts an instance and returns its ID; `config` holds the other `/start_instance` fields."""
+        payload = start_payload(run_id, container_image, container_type, config)
+        return self._request("POST", "/start_instance", json=payload)["instance_id"]
+
+    def start_instances(
+        self, instances: List[Dict[str, Any]], all_or_nothing: bool = False, **group: Any
+    ) -> List[Dict[str, Any]]:
+        """Starts several instances, returning a result per instance; `instances` hold
+        `/start_instance` bodies and `group` the group's `queue_timeout` / `priority`.
+
+        With `all_or_nothing`, either all start or none does (`AdmissionRejectedError` if the
+        group does not fit, `ServiceError` if one failed to start).
+        """
+        payload = {"instances": instances, "all_or_nothing": all_or_nothing, **group}
+        return self._request("POST", "/start_instances", json=payload)["results"]
+
+    def execute_command(
+        self,
+        run_id: str,
+        cmd: str,
+        output: Optional[Dict[str, Any]] = None,
+        *,
+        timeout: Optional[int] = None,
+        command_id: Optional[str] = None,
+    ) -> CommandResult:
+        """Runs a command; `output` sets per-command output limits (see `OutputPolicy`), `timeout`
+        overrides the environment's default and `command_id` makes it cancellable."""
+        payload = command_payload(run_id, cmd, output, timeout, command_id)
+        data = self._request("POST", "/execute_command", json=payload, command=True)
+        return CommandResult(**data["result"])
+
+    def cancel_command(self, command_id: str) -> bool:
+        """Kills a command started with `command_id`; returns whether it has ended."""
+        return self._request("POST", "/cancel_command", json={"command_id": command_id})["finished"]
+
+    def close_instance(self, run_id: str) -> None:
+        self._request("POST", "/close_instance", json={"run_id": run_id}, idempotent=True)
+
+    def close_instances(self, run_ids: List[str]) -> List[Dict[str, Any]]:
+        payload = {"run_ids": list(run_ids)}
+        return self._request("POST", "/close_instances", json=payload, idempotent=True)["results"]
+
+    def available_resources(self) -> Dict[str, Any]:
+        return self._request("GET", "/get_available_resources", idempotent=True)
+
+    def images(self) -> List[str]:
+        """Images the service has started instances from (cached on its node)."""
+        return self._request("GET", "/images", idempotent=True)["images"]
+
+    def heartbeat(self, run_id: str) -> Optional[float]:
+        """Renews the idle lease of an instance, returning when it expires."""
+        return self._request("POST", "/heartbeat", json={"run_id": run_id}, idempotent=True)["expires_at"]
+
+    def stats(self, **params: Any) -> Stats:
+        """Server statistics; `params` are the `/stats` query parameters (`limit`, `prefix`, ...)."""
+        params = {key: value for key, value in params.items() if value is not None}
+        return Stats(**self._request("GET", "/stats", params=params, idempotent=True))
+
+    @contextlib.contextmanager
+    def instance(self, run_id: str, container_image: str, container_type: str, **config: Any) -> Iterator["Instance"]:
+        """Starts an instance for the duration of a `with` block, closing it however the block exits."""
+        try:
+            self.start_instance(run_id, container_image, container_type, **config)
+        except httpx.TransportError:
+            # The service may have started it before the connection failed
+            with contextlib.suppress(Exception):
+                self.close_instance(run_id)
+            raise
+        try:
+            yield Instance(self, run_id)
+        finally:
+            # Already gone if it was reaped or closed through another client
+            with contextlib.suppress(InstanceNotFoundError):
+                self.close_instance(run_id)
+
+    def close(self) -> None:
+        if self._owns_http:
+            self._http.close()
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class Instance:
+    """A started instance, bound to the client that started it."""
+
+    def __init__(self, client: Client, run_id: str):
+        self.client = client
+        self.run_id = run_id
+
+    def execute(
+        self,
+        cmd: str,
+        output: Optional[Dict[str, Any]] = None,
+        *,
+        timeout: Optional[int] = None,
+        command_id: Optional[str] = None,
+    ) -> CommandResult:
+        return self.client.execute_command(self.run_id, cmd, output, timeout=timeout, command_id=command_id)
+
+    def heartbeat(self) -> Optional[float]:
+        return self.client.heartbeat(self.run_id)
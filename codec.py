@@ -0,0 +1,203 @@
+"""Content negotiation for the API: MessagePack bodies and response compression.
+
+JSON stays the default, so existing clients are unaffected. Clients opt in with
+`Content-Type: application/msgpack` (request bodies), `Accept: application/msgpack`
+(responses) and `Accept-Encoding: zstd` / `gzip`. `msgpack` and `zstandard` are optional;
+without them the service only negotiates JSON and gzip.
+"""
+
+import asyncio
+import contextvars
+import gzip
+from typing import Any, Callable, Coroutine, List, Mapping, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack", "application/vnd.msgpack")
+
+DEFAULT_COMPRESS_MIN_BYTES = 1024
+"""Smaller responses are sent uncompressed; compressing them costs more than it saves."""
+COMPRESS_IN_THREAD_BYTES = 256 * 1024
+"""Larger bodies are compressed in a worker thread to keep the event loop responsive."""
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_response_format: contextvars.ContextVar[str] = contextvars.ContextVar("response_format", default=JSON)
+
+
+def _parse_header(value: str) -> List[Tuple[str, float]]:
+    """Parses an `Accept` / `Accept-Encoding` header into (token, q) pairs."""
+    items = []
+    for part in value.split(","):
+        token, *params = [piece.strip() for piece in part.split(";")]
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, number = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        items.append((token.lower(), q))
+    return items
+
+
+def is_msgpack(content_type: str) -> bool:
+    return content_type.partition(";")[0].strip().lower() in MSGPACK_TYPES
+
+
+def accepts_msgpack(accept: str) -> bool:
+    """Whether the client prefers MessagePack over JSON (and the service can produce it)."""
+    if msgpack is None or not accept:
+        return False
+    preferences = dict(_parse_header(accept))
+    msgpack_q = max(preferences.get(media_type, 0.0) for media_type in MSGPACK_TYPES)
+    return msgpack_q > 0 and msgpack_q >= preferences.get(JSON, 0.0)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred content coding the service supports (`zstd` on ties), or None."""
+    preferences = _parse_header(accept_encoding)
+    wildcard = next((q for token, q in preferences if token == "*"), 0.0)
+    quality = dict(preferences)
+    best, best_q = None, 0.0
+    for encoding in (["zstd"] if zstandard is not None else []) + ["gzip"]:
+        q = quality.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class NegotiatedResponse(JSONResponse):
+    """JSON response, or MessagePack when the request asked for it (see `NegotiatingRoute`)."""
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        media_type: Optional[str] = None,
+        background: Optional[BackgroundTask] = None,
+    ):
+        if media_type is None and _response_format.get() == MSGPACK:
+            media_type = MSGPACK
+        super().__init__(content, status_code, headers, media_type, background)
+        if msgpack is not None:
+            self.headers.add_vary_header("Accept")
+
+    def render(self, content: Any) -> bytes:
+        if self.media_type == MSGPACK:
+            return msgpack.packb(content, use_bin_type=True)
+        return super().render(content)
+
+
+class _MessagePackRequest(Request):
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            try:
+                self._json = msgpack.unpackb(await self.body(), raw=False)
+            except (ValueError, msgpack.UnpackException) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid MessagePack body: {e}")
+        return self._json
+
+
+class NegotiatingRoute(APIRoute):
+    """Route that accepts MessagePack request bodies and picks the response format from `Accept`."""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def negotiated_handler(request: Request) -> Response:
+            if is_msgpack(request.headers.get("content-type", "")):
+                if msgpack is None:
+                    raise HTTPException(status_code=415, detail="MessagePack is not supported by this server")
+                # FastAPI only decodes bodies it considers JSON, through `Request.json()`
+                headers = [(k, v) for k, v in request.scope["headers"] if k != b"content-type"]
+                scope = dict(request.scope, headers=headers + [(b"content-type", JSON.encode())])
+                request = _MessagePackRequest(scope, request.receive)
+            fmt = MSGPACK if accepts_msgpack(request.headers.get("accept", "")) else JSON
+            token = _response_format.set(fmt)
+            try:
+                return await handler(request)
+            finally:
+                _response_format.reset(token)
+
+        return negotiated_handler
+
+
+class CompressionMiddleware:
+    """Compresses complete response bodies of at least `minimum_size` bytes with zstd or gzip.
+
+    Streamed responses (SSE, tar downloads, ranged output) are passed through untouched so
+    their chunks reach the client as soon as they are produced.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = DEFAULT_COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        start: Optional[Message] = None
+        started = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, started
+            if started:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                # Held back until the first body message shows whether it is complete
+                start = message
+                return
+            started = True
+            assert start is not None
+            headers = MutableHeaders(raw=start["headers"])
+            body = message.get("body", b"")
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                headers.add_vary_header("Accept-Encoding")
+                if (
+                    encoding is not None
+                    and len(body) >= self.minimum_size
+                    and start["status"] not in (206, 304)
+                    and "content-encoding" not in headers
+                ):
+                    if len(body) >= COMPRESS_IN_THREAD_BYTES:
+                        body = await asyncio.to_thread(compress, body, encoding)
+                    else:
+                        body = compress(body, encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    message = dict(message, body=body)
+            await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
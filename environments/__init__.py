@@ -27,7 +27,19 @@ def get_environment_class(spec: str) -> type[Environment]:
         raise ValueError(msg)
 
 
-def get_environment(config: dict, *, default_type: str = "") -> Environment:
+def reattach_environment(config: dict) -> Environment:
+    """Re-create the environment of an instance that survived a restart (see `Environment.reattach`)."""
+    config = copy.deepcopy(config)
+    container_type = config.pop("container_type", "")
+    return get_environment_class(container_type).reattach(config)
+
+
+def get_environment(config: dict, *, default_type: str = "", **kwargs) -> Environment:
+    """Instantiate the environment described by `config`.
+
+    Extra keyword arguments (e.g. `logger`, `state_callback`) are passed to the environment
+    class as-is instead of being deep-copied with the config.
+    """
     config = copy.deepcopy(config)
     container_type = config.pop("container_type", default_type)
-    return get_environment_class(container_type)(**config)
+    return get_environment_class(container_type)(**config, **kwargs)
@@ -1,14 +1,99 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set
+
+from environments.files import DEFAULT_READ_MAX_BYTES, archive_host_path, extract_to_host_path, read_host_files
+from environments.process import kill_tagged_processes
 
 class Environment(ABC):
     """Abstract base class for environments."""
 
+    state_callback: Optional[Callable[[str], None]] = None
+    """Called with `"pulling"` / `"starting"` as the environment progresses through its setup."""
+
+    detached: bool = False
+    """Set by `detach`: the container outlives this object instead of being cleaned up with it."""
+
+    def _report_state(self, state: str) -> None:
+        if self.state_callback is not None:
+            self.state_callback(state)
+
     @abstractmethod
     def execute(self, command: str, cwd: str = "", *, timeout: Optional[int] = None) -> Dict[str, Any]:
         """Execute a command in the environment."""
         pass
 
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Execute a command without blocking the event loop.
+
+        Falls back to running `execute` in a worker thread. Subprocess-based environments
+        override this with a native `asyncio` implementation.
+        """
+        return await asyncio.to_thread(self.execute, command, cwd, timeout=timeout)
+
+    async def astream(self, command: str, cwd: str = "", *, timeout: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Execute a command, yielding `{"output": ...}` chunks and a final `{"returncode": ...}`.
+
+        The default implementation yields the whole output of `aexecute` as a single chunk.
+        """
+        result = await self.aexecute(command, cwd, timeout=timeout)
+        if result.get("output"):
+            yield {"output": result["output"]}
+        yield {"returncode": result.get("returncode")}
+
+    async def akill(self, tag: str) -> None:
+        """Kill the processes of a command run with `tag_command(command, tag)`.
+
+        The default looks for them among the host's processes, which covers environments
+        whose commands run as host processes (local shell, Singularity, Enroot, bubblewrap).
+        """
+        await asyncio.to_thread(kill_tagged_processes, tag)
+
+    def host_path(self, path: str) -> Path:
+        """Map `path` inside the environment to the host, for environments whose filesystem is
+        a host directory (sandbox, rootfs). Relative paths are resolved against the working
+        directory.
+
+        The file transfer methods below work on top of this; environments without a
+        host-visible filesystem override them instead.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support file transfer")
+
+    async def aupload(self, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Extract a streamed tar archive into the directory `path`, creating it if needed."""
+        await extract_to_host_path(archive, self.host_path(path))
+
+    async def adownload(self, path: str) -> AsyncIterator[bytes]:
+        """Yield a tar archive of `path` (a file or directory), named after its last component."""
+        async for chunk in archive_host_path(self.host_path(path)):
+            yield chunk
+
+    async def aread_files(self, paths: List[str], max_bytes: int = DEFAULT_READ_MAX_BYTES) -> Dict[str, Dict[str, Any]]:
+        """Read up to `max_bytes` of each of `paths`.
+
+        Returns, per path, `{"content", "encoding": "utf-8" | "base64", "size", "truncated"}`
+        or `{"error": ...}`.
+        """
+        self.host_path("/")  # Fail as a whole if file transfer is unsupported
+        return await asyncio.to_thread(read_host_files, self.host_path, paths, max_bytes)
+
+    @classmethod
+    def reconcile(cls, configs: Dict[str, Dict[str, Any]], reap_orphans: bool = False) -> Set[str]:
+        """Called after a restart of the service with the recorded configs of this environment
+        type, by run ID. Returns the run IDs whose container / sandbox still exists and can be
+        re-adopted with `reattach`.
+
+        With `reap_orphans`, containers the service started but has no record of are removed,
+        if the environment can tell them apart. The default re-adopts nothing.
+        """
+        return set()
+
+    @classmethod
+    def reattach(cls, config: Dict[str, Any]) -> "Environment":
+        """Re-creates the environment object of an existing container without starting a new one."""
+        raise NotImplementedError(f"{cls.__name__} cannot re-attach to existing instances")
+
     def get_template_vars(self) -> Dict[str, Any]:
         """Get template variables for this environment."""
         return {}
@@ -20,3 +105,8 @@ class Environment(ABC):
     def cleanup(self):
         """Cleanup resources."""
         pass
+
+    def detach(self):
+        """Leave the container running when this object is destroyed, e.g. at a shutdown of a
+        service that re-adopts it after the restart. `cleanup` still removes it."""
+        self.detached = True
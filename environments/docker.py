@@ -3,10 +3,16 @@ import os
 import shlex
 import subprocess
 import uuid
-from typing import Any
+from typing import Any, AsyncIterator, Callable, Dict, List
 
 from pydantic import BaseModel
 from environments.base import Environment
+from environments.files import DEFAULT_READ_MAX_BYTES, environment_path, read_archived_files
+from environments.process import kill_tagged_script, pipe_process, run_process, stream_process
+
+
+RUN_ID_LABEL = "arservice.run_id"
+"""Label marking containers started by the service, used to find orphans after a restart."""
 
 
 class DockerEnvironmentConfig(BaseModel):
@@ -42,12 +48,14 @@ class DockerEnvironment(Environment):
         *,
         config_class: type = DockerEnvironmentConfig,
         logger: logging.Logger | None = None,
+        state_callback: Callable[[str], None] | None = None,
         **kwargs,
     ):
         """This class executes bash commands in a Docker container using direct docker commands.
         See `DockerEnvironmentConfig` for keyword arguments.
         """
         self.logger = logger or logging.getLogger("agent_rollout_service.environment")
+        self.state_callback = state_callback
         self.container_id: str | None = None
         self.config = config_class(**kwargs)
         self._start_container()
@@ -55,15 +63,55 @@ class DockerEnvironment(Environment):
     def get_template_vars(self) -> dict[str, Any]:
         return self.config.model_dump()
 
+    @classmethod
+    def reconcile(cls, configs: dict[str, dict[str, Any]], reap_orphans: bool = False) -> set[str]:
+        """Finds surviving containers by name (the run ID) in `docker ps`."""
+        executable = next(
+            (config["executable"] for config in configs.values() if config.get("executable")),
+            DockerEnvironmentConfig.model_fields["executable"].default,
+        )
+        result = subprocess.run(
+            [executable, "ps", "--format", f'{{{{.Names}}}}\t{{{{.Label "{RUN_ID_LABEL}"}}}}'],
+            capture_output=True,
+            text=True,
+            timeout=60,
+            check=True,
+        )
+        alive = set()
+        for line in result.stdout.splitlines():
+            name, _, label = line.partition("\t")
+            if name in configs:
+                alive.add(name)
+            elif label and reap_orphans:
+                logging.getLogger("agent_rollout_service.environment").warning(f"Removing orphaned container {name}")
+                subprocess.Popen([executable, "rm", "-f", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return alive
+
+    @classmethod
+    def reattach(cls, config: dict[str, Any]) -> "DockerEnvironment":
+        env = cls.__new__(cls)
+        env.logger = logging.getLogger("agent_rollout_service.environment")
+        env.state_callback = None
+        env.config = DockerEnvironmentConfig(**config)
+        # The container name works wherever the ID does
+        env.container_id = env.config.run_id
+        return env
+
     def _start_container(self):
         """Start the Docker container and return the container ID."""
         container_name = self.config.run_id
+        if self.state_callback is not None:
+            # Only probe for the image when someone is listening for progress
+            self._pull_image()
+        self._report_state("starting")
         cmd = [
             self.config.executable,
             "run",
             "-d",
             "--name",
             container_name,
+            "--label",
+            f"{RUN_ID_LABEL}={self.config.run_id}",
             "-w",
             self.config.cwd,
             *self.config.run_args,
@@ -82,8 +130,27 @@ class DockerEnvironment(Environment):
         self.logger.info(f"Started container {container_name} with ID {result.stdout.strip()}")
         self.container_id = result.stdout.strip()
 
-    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
-        """Execute a command in the Docker container and return the result as a dict."""
+    def _pull_image(self):
+        """Pull the image ahead of `docker run` if it is not available locally."""
+        inspect = subprocess.run(
+            [self.config.executable, "image", "inspect", self.config.container_image],
+            capture_output=True,
+            timeout=60,
+        )
+        if inspect.returncode == 0:
+            return
+        self._report_state("pulling")
+        self.logger.info(f"Pulling image {self.config.container_image}")
+        subprocess.run(
+            [self.config.executable, "pull", self.config.container_image],
+            capture_output=True,
+            text=True,
+            timeout=self.config.pull_timeout,
+            check=True,
+        )
+
+    def _exec_cmd(self, command: str, cwd: str = "") -> list[str]:
+        """Build the `docker exec` command line for `command`."""
         cwd = cwd or self.config.cwd
         assert self.container_id, "Container not started"
 
@@ -94,9 +161,12 @@ class DockerEnvironment(Environment):
         for key, value in self.config.env.items():
             cmd.extend(["-e", f"{key}={value}"])
         cmd.extend([self.container_id, "bash", "-lc", command])
+        return cmd
 
+    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the Docker container and return the result as a dict."""
         result = subprocess.run(
-            cmd,
+            self._exec_cmd(command, cwd),
             text=True,
             timeout=timeout or self.config.timeout,
             encoding="utf-8",
@@ -106,6 +176,42 @@ class DockerEnvironment(Environment):
         )
         return {"output": result.stdout, "returncode": result.returncode}
 
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the Docker container without blocking the event loop."""
+        return await run_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout)
+
+    async def astream(self, command: str, cwd: str = "", *, timeout: int | None = None) -> AsyncIterator[dict[str, Any]]:
+        """Execute a command in the Docker container, yielding output as it is produced."""
+        async for event in stream_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout):
+            yield event
+
+    async def akill(self, tag: str) -> None:
+        """Kill the processes of a tagged command inside the container; killing the local
+        `docker exec` client leaves them running."""
+        assert self.container_id, "Container not started"
+        await run_process([self.config.executable, "exec", self.container_id, "sh", "-c", kill_tagged_script(tag)], timeout=60)
+
+    async def aupload(self, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Extract a streamed tar archive into the directory `path` using `docker cp`."""
+        assert self.container_id, "Container not started"
+        path = environment_path(path, self.config.cwd)
+        # `docker cp` needs an existing destination directory
+        async for _ in pipe_process([self.config.executable, "exec", self.container_id, "mkdir", "-p", path]):
+            pass
+        async for _ in pipe_process([self.config.executable, "cp", "-", f"{self.container_id}:{path}"], stdin=archive):
+            pass
+
+    async def adownload(self, path: str) -> AsyncIterator[bytes]:
+        """Yield a tar archive of `path` streamed by `docker cp`."""
+        assert self.container_id, "Container not started"
+        path = environment_path(path, self.config.cwd)
+        async for chunk in pipe_process([self.config.executable, "cp", f"{self.container_id}:{path}", "-"]):
+            yield chunk
+
+    async def aread_files(self, paths: List[str], max_bytes: int = DEFAULT_READ_MAX_BYTES) -> Dict[str, Dict[str, Any]]:
+        """Read many files through concurrent `docker cp` archive streams."""
+        return await read_archived_files(self.adownload, paths, max_bytes)
+
     def cleanup(self):
         """Stop and remove the Docker container."""
         if getattr(self, "container_id", None) is not None:  # if init fails early, container_id might not be set
@@ -114,4 +220,5 @@ class DockerEnvironment(Environment):
 
     def __del__(self):
         """Cleanup container when object is destroyed."""
-        self.cleanup()
+        if not self.detached:
+            self.cleanup()
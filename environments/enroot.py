@@ -3,10 +3,13 @@ import os
 import shlex
 import subprocess
 import uuid
-from typing import Any
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable
 
 from pydantic import BaseModel
 from environments.base import Environment
+from environments.files import resolve_path
+from environments.process import run_process, stream_process
 
 
 class EnrootEnvironmentConfig(BaseModel):
@@ -26,16 +29,26 @@ class EnrootEnvironmentConfig(BaseModel):
     """Path to the enroot executable."""
     start_args: list[str] = []
     """Additional arguments to pass to the `enroot start` command."""
+    data_path: str = os.getenv(
+        "ENROOT_DATA_PATH", os.path.join(os.getenv("XDG_DATA_HOME", os.path.expanduser("~/.local/share")), "enroot")
+    )
+    """Directory holding the container root filesystems (enroot's `ENROOT_DATA_PATH`)."""
 
 
 class EnrootEnvironment(Environment):
     def __init__(
-        self, *, config_class: type = EnrootEnvironmentConfig, logger: logging.Logger | None = None, **kwargs
+        self,
+        *,
+        config_class: type = EnrootEnvironmentConfig,
+        logger: logging.Logger | None = None,
+        state_callback: Callable[[str], None] | None = None,
+        **kwargs,
     ):
         """This class executes bash commands in an Enroot container.
         See `EnrootEnvironmentConfig` for keyword arguments.
         """
         self.logger = logger or logging.getLogger("agent_rollout_service.environment")
+        self.state_callback = state_callback
         self.config = config_class(**kwargs)
         self.container_name: str | None = None
         self._setup_container()
@@ -43,12 +56,32 @@ class EnrootEnvironment(Environment):
     def get_template_vars(self) -> dict[str, Any]:
         return self.config.model_dump()
 
+    @classmethod
+    def reconcile(cls, configs: dict[str, dict[str, Any]], reap_orphans: bool = False) -> set[str]:
+        """Finds surviving containers in `enroot list`; other users' containers look the same, so nothing is reaped."""
+        executable = next(
+            (config["executable"] for config in configs.values() if config.get("executable")),
+            EnrootEnvironmentConfig.model_fields["executable"].default,
+        )
+        result = subprocess.run([executable, "list"], capture_output=True, text=True, timeout=60, check=True)
+        return set(result.stdout.split()) & set(configs)
+
+    @classmethod
+    def reattach(cls, config: dict[str, Any]) -> "EnrootEnvironment":
+        env = cls.__new__(cls)
+        env.logger = logging.getLogger("agent_rollout_service.environment")
+        env.state_callback = None
+        env.config = EnrootEnvironmentConfig(**config)
+        env.container_name = env.config.run_id
+        return env
+
     def _setup_container(self):
         """Imports the enroot image and creates the container filesystem."""
         container_dir = os.environ["ENROOT_CACHE_PATH"]
         container_output_path = os.path.join(container_dir, f"{self.config.container_image}.sqsh".replace("/", "_"))
         
         if not os.path.exists(container_output_path):
+            self._report_state("pulling")
             import_cmd = [self.config.executable, "import", "-o", container_output_path, self.config.container_image]
             self.logger.info(f"Importing image with command: {shlex.join(import_cmd)}")
             try:
@@ -66,6 +99,7 @@ class EnrootEnvironment(Environment):
         else:
             self.logger.info(f"Image already present '{self.config.container_image}'")
 
+        self._report_state("starting")
         self.container_name = self.config.run_id
         create_cmd = [
             self.config.executable,
@@ -88,8 +122,8 @@ class EnrootEnvironment(Environment):
             raise
         self.logger.info(f"Created container '{self.container_name}'")
 
-    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
-        """Execute a command in the Enroot container and return the result as a dict."""
+    def _exec_cmd(self, command: str, cwd: str = "") -> list[str]:
+        """Build the `enroot start` command line for `command`."""
         cwd = cwd or self.config.cwd
         assert self.container_name, "Container not created"
 
@@ -107,9 +141,12 @@ class EnrootEnvironment(Environment):
             cmd.extend(["--env", f"{key}={value}"])
         
         cmd.extend([self.container_name, "bash", "-lc", command])
-        
+        return cmd
+
+    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the Enroot container and return the result as a dict."""
         result = subprocess.run(
-            cmd,
+            self._exec_cmd(command, cwd),
             text=True,
             timeout=timeout or self.config.timeout,
             encoding="utf-8",
@@ -119,6 +156,20 @@ class EnrootEnvironment(Environment):
         )
         return {"output": result.stdout, "returncode": result.returncode}
 
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the Enroot container without blocking the event loop."""
+        return await run_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout)
+
+    async def astream(self, command: str, cwd: str = "", *, timeout: int | None = None) -> AsyncIterator[dict[str, Any]]:
+        """Execute a command in the Enroot container, yielding output as it is produced."""
+        async for event in stream_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout):
+            yield event
+
+    def host_path(self, path: str) -> Path:
+        """Files live in the container's root filesystem under `data_path`."""
+        assert self.container_name, "Container not created"
+        return resolve_path(Path(self.config.data_path) / self.container_name, path, cwd=self.config.cwd)
+
     def cleanup(self):
         """Removes the Enroot container and its filesystem."""
         if getattr(self, "container_name", None) is not None:
@@ -128,4 +179,5 @@ class EnrootEnvironment(Environment):
 
     def __del__(self):
         """Cleanup container when object is destroyed."""
-        self.cleanup()
+        if not self.detached:
+            self.cleanup()
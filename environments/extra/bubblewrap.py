@@ -18,10 +18,12 @@ import subprocess
 import tempfile
 import uuid
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator
 
 from pydantic import BaseModel
 from environments.base import Environment
+from environments.files import resolve_path
+from environments.process import run_process, stream_process
 
 
 class BubblewrapEnvironmentConfig(BaseModel):
@@ -78,8 +80,21 @@ class BubblewrapEnvironment(Environment):
         self.working_dir = Path(tempfile.gettempdir()) / self.config.run_id
         self.working_dir.mkdir(parents=True)
 
-    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
-        """Execute a command in the bubblewrap environment and return the result as a dict."""
+    @classmethod
+    def reconcile(cls, configs: dict[str, dict[str, Any]], reap_orphans: bool = False) -> set[str]:
+        """Sandboxes survive as long as their working directory does."""
+        return {run_id for run_id in configs if (Path(tempfile.gettempdir()) / run_id).is_dir()}
+
+    @classmethod
+    def reattach(cls, config: dict[str, Any]) -> "BubblewrapEnvironment":
+        env = cls.__new__(cls)
+        env.logger = logging.getLogger("agent_rollout_service.environment")
+        env.config = BubblewrapEnvironmentConfig(**config)
+        env.working_dir = Path(tempfile.gettempdir()) / env.config.run_id
+        return env
+
+    def _exec_cmd(self, command: str, cwd: str = "") -> list[str]:
+        """Build the `bwrap` command line for `command`."""
         cwd = cwd or self.config.cwd or str(self.working_dir)
 
         cmd = [self.config.executable] + self.config.wrapper_args + ["--bind", cwd, cwd, "--chdir", cwd]
@@ -89,9 +104,12 @@ class BubblewrapEnvironment(Environment):
             cmd.extend(["--setenv", key, value])
 
         cmd.extend(["bash", "-c", command])
+        return cmd
 
+    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the bubblewrap environment and return the result as a dict."""
         result = subprocess.run(
-            cmd,
+            self._exec_cmd(command, cwd),
             text=True,
             timeout=timeout or self.config.timeout,
             encoding="utf-8",
@@ -101,13 +119,28 @@ class BubblewrapEnvironment(Environment):
         )
         return {"output": result.stdout, "returncode": result.returncode}
 
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the bubblewrap environment without blocking the event loop."""
+        return await run_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout)
+
+    async def astream(self, command: str, cwd: str = "", *, timeout: int | None = None) -> AsyncIterator[dict[str, Any]]:
+        """Execute a command in the bubblewrap environment, yielding output as it is produced."""
+        async for event in stream_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout):
+            yield event
+
+    def host_path(self, path: str) -> Path:
+        """Only the bind-mounted working directory is writable, and it has the same path on the host."""
+        bound = self.config.cwd or str(self.working_dir)
+        return resolve_path(Path(bound), path, cwd=bound, mount=bound)
+
     def cleanup(self):
         if self.working_dir.exists():
             shutil.rmtree(self.working_dir)
 
     def __del__(self):
         """Cleanup working_dir when object is destroyed."""
-        self.cleanup()
+        if not self.detached:
+            self.cleanup()
 
     def get_template_vars(self) -> dict[str, Any]:
         return self.config.model_dump() | platform.uname()._asdict()
@@ -58,21 +58,24 @@ class SwerexModalEnvironment(Environment):
         )
         asyncio.run(self.deployment.start())
 
+    def _rex_command(self, command: str, cwd: str = "", *, timeout: int | None = None) -> RexCommand:
+        return RexCommand(
+            command=command,
+            shell=True,
+            check=False,
+            cwd=cwd or self.config.cwd,
+            timeout=timeout or self.config.timeout,
+            merge_output_streams=True,
+            env=self.config.env if self.config.env else None,
+        )
+
     def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
         """Execute a command in the environment and return the raw output."""
-        output = asyncio.run(
-            self.deployment.runtime.execute(
-                RexCommand(
-                    command=command,
-                    shell=True,
-                    check=False,
-                    cwd=cwd or self.config.cwd,
-                    timeout=timeout or self.config.timeout,
-                    merge_output_streams=True,
-                    env=self.config.env if self.config.env else None,
-                )
-            )
-        )
+        return asyncio.run(self.aexecute(command, cwd, timeout=timeout))
+
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in the environment on the caller's event loop."""
+        output = await self.deployment.runtime.execute(self._rex_command(command, cwd, timeout=timeout))
         return {
             "output": output.stdout,
             "returncode": output.exit_code,
@@ -0,0 +1,180 @@
+"""Tar-based file transfer helpers shared by the environments.
+
+Files move in and out of environments as tar archives, so binary content, permissions and
+whole directory trees survive the trip unchanged.
+"""
+
+import asyncio
+import base64
+import io
+import os
+import posixpath
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import IO, Any, AsyncIterator, Callable, Dict, List
+
+TRANSFER_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+"""Archives up to this size are buffered in memory, larger ones in a temporary file."""
+DEFAULT_READ_MAX_BYTES = 1024 * 1024
+"""Default per-file limit of `aread_files`."""
+READ_CONCURRENCY = 16
+"""Maximum number of concurrent archive downloads in `read_archived_files`."""
+
+
+def environment_path(path: str, cwd: str = "/") -> str:
+    """Normalizes `path` inside an environment, resolving relative paths against `cwd`."""
+    return posixpath.normpath(posixpath.join(cwd or "/", path))
+
+
+def resolve_path(root: Path, path: str, cwd: str = "/", mount: str = "/") -> Path:
+    """Maps `path` inside an environment to the host, for environments whose filesystem
+    (or part of it, mounted at `mount`) is the host directory `root`.
+
+    Raises `PermissionError` for paths that leave `root`, including through symlinks.
+    """
+    env_path = environment_path(path, cwd)
+    relative = posixpath.relpath(env_path, mount)
+    if relative == ".." or relative.startswith("../"):
+        raise PermissionError(f"Path {path} is outside of {mount}")
+    real_root = os.path.realpath(root)
+    host_path = os.path.realpath(os.path.join(real_root, relative))
+    if os.path.commonpath([real_root, host_path]) != real_root:
+        raise PermissionError(f"Path {path} resolves outside of the environment")
+    return Path(host_path)
+
+
+def write_archive(src: Path, fileobj: IO[bytes]) -> None:
+    """Writes a tar archive of `src` (a file or directory) named after its last component."""
+    if not src.exists():
+        raise FileNotFoundError(f"No such file or directory: {src}")
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        tar.add(src, arcname=src.name or ".")
+
+
+def extract_archive(fileobj: IO[bytes], dest: Path) -> None:
+    """Extracts a tar archive into the directory `dest`, creating it if needed.
+
+    Members that would land outside `dest` (absolute paths, `..`, links) are rejected.
+    """
+    dest.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(dest, filter="data")
+            return
+        real_dest = os.path.realpath(dest)
+        for member in tar:
+            target = os.path.realpath(os.path.join(real_dest, member.name))
+            if member.issym() or member.islnk() or not target.startswith(real_dest + os.sep):
+                raise PermissionError(f"Refusing to extract {member.name}")
+            tar.extract(member, dest)
+
+
+async def spool(chunks: AsyncIterator[bytes]) -> IO[bytes]:
+    """Buffers a byte stream in memory, or on disk once it gets large, and rewinds it."""
+    fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        async for chunk in chunks:
+            fileobj.write(chunk)
+    except BaseException:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+    return fileobj
+
+
+async def iter_file(fileobj: IO[bytes]) -> AsyncIterator[bytes]:
+    """Yields the content of `fileobj` in chunks and closes it."""
+    try:
+        while chunk := fileobj.read(TRANSFER_CHUNK_SIZE):
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+async def archive_host_path(src: Path) -> AsyncIterator[bytes]:
+    """Yields a tar archive of the host path `src`, built in a worker thread."""
+    fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        await asyncio.to_thread(write_archive, src, fileobj)
+    except BaseException:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+    async for chunk in iter_file(fileobj):
+        yield chunk
+
+
+async def extract_to_host_path(archive: AsyncIterator[bytes], dest: Path) -> None:
+    """Extracts a streamed tar archive into the host directory `dest`."""
+    with await spool(archive) as fileobj:
+        await asyncio.to_thread(extract_archive, fileobj, dest)
+
+
+def file_entry(content: bytes, size: int) -> Dict[str, Any]:
+    """Result entry of `aread_files`: UTF-8 text when possible, base64 otherwise."""
+    truncated = len(content) < size
+    try:
+        text = content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if truncated and e.reason == "unexpected end of data":
+            # The cut split a multi-byte character
+            text = content[:e.start].decode("utf-8", errors="strict") if e.start else ""
+        else:
+            return {"content": base64.b64encode(content).decode("ascii"), "encoding": "base64", "size": size, "truncated": truncated}
+    return {"content": text, "encoding": "utf-8", "size": size, "truncated": truncated}
+
+
+def read_host_file(path: Path, max_bytes: int) -> Dict[str, Any]:
+    """Reads up to `max_bytes` of a host file into an `aread_files` entry."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        return file_entry(f.read(max_bytes), size)
+
+
+def read_host_files(resolve: Callable[[str], Path], paths: List[str], max_bytes: int) -> Dict[str, Dict[str, Any]]:
+    """Reads many files of an environment with a host-visible filesystem."""
+    files = {}
+    for path in paths:
+        try:
+            files[path] = read_host_file(resolve(path), max_bytes)
+        except (OSError, ValueError) as e:
+            files[path] = {"error": str(e)}
+    return files
+
+
+async def read_archived_files(
+    download: Callable[[str], AsyncIterator[bytes]], paths: List[str], max_bytes: int
+) -> Dict[str, Dict[str, Any]]:
+    """Reads many files through `download` (which yields a tar archive of a path) concurrently."""
+    semaphore = asyncio.Semaphore(READ_CONCURRENCY)
+    # Enough for the tar headers of one file plus `max_bytes` of its content
+    limit = max_bytes + TRANSFER_CHUNK_SIZE
+
+    async def read_one(path: str) -> Dict[str, Any]:
+        async with semaphore:
+            data = bytearray()
+            archive = download(path)
+            try:
+                async for chunk in archive:
+                    data += chunk
+                    if len(data) >= limit:
+                        break
+            except Exception as e:
+                return {"error": getattr(e, "stderr", None) or str(e)}
+            finally:
+                await archive.aclose()
+        try:
+            with tarfile.open(fileobj=io.BytesIO(bytes(data)), mode="r|") as tar:
+                member = tar.next()
+                if member is None or not member.isfile():
+                    return {"error": f"Not a regular file: {path}"}
+                extracted = tar.extractfile(member)
+                assert extracted is not None
+                return file_entry(extracted.read(max_bytes), member.size)
+        except tarfile.TarError as e:
+            return {"error": f"Could not read {path}: {e}"}
+
+    results = await asyncio.gather(*(read_one(path) for path in paths))
+    return dict(zip(paths, results))
@@ -1,9 +1,12 @@
 import os
 import platform
 import subprocess
-from typing import Any
+from pathlib import Path
+from typing import Any, AsyncIterator
 
 from environments.base import Environment
+from environments.files import resolve_path
+from environments.process import run_process, stream_process
 from pydantic import BaseModel
 
 
@@ -35,5 +38,34 @@ class LocalEnvironment(Environment):
         )
         return {"output": result.stdout, "returncode": result.returncode}
 
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None):
+        """Execute a command in the local environment without blocking the event loop."""
+        return await run_process(["/bin/sh", "-c", command], **self._process_kwargs(cwd, timeout))
+
+    async def astream(self, command: str, cwd: str = "", *, timeout: int | None = None) -> AsyncIterator[dict[str, Any]]:
+        """Execute a command in the local environment, yielding output as it is produced."""
+        async for event in stream_process(["/bin/sh", "-c", command], **self._process_kwargs(cwd, timeout)):
+            yield event
+
+    @classmethod
+    def reconcile(cls, configs: dict[str, dict[str, Any]], reap_orphans: bool = False) -> set[str]:
+        """Local instances have no state of their own and always survive."""
+        return set(configs)
+
+    @classmethod
+    def reattach(cls, config: dict[str, Any]) -> "LocalEnvironment":
+        return cls(**config)
+
+    def host_path(self, path: str) -> Path:
+        """Paths are host paths; relative ones are resolved against the working directory."""
+        return resolve_path(Path("/"), path, cwd=self.config.cwd or os.getcwd())
+
+    def _process_kwargs(self, cwd: str, timeout: int | None) -> dict[str, Any]:
+        return {
+            "timeout": timeout or self.config.timeout,
+            "cwd": cwd or self.config.cwd or os.getcwd(),
+            "env": os.environ | self.config.env,
+        }
+
     def get_template_vars(self) -> dict[str, Any]:
         return self.config.model_dump() | platform.uname()._asdict() | os.environ
@@ -0,0 +1,215 @@
+"""Async subprocess helpers shared by the subprocess-based environments."""
+
+import asyncio
+import codecs
+import os
+import shlex
+import signal
+import subprocess
+from typing import Any, AsyncIterator, Optional
+
+READ_CHUNK_SIZE = 64 * 1024
+"""Maximum number of bytes read from the child's pipe at once."""
+
+COMMAND_TAG_VAR = "ARSERVICE_COMMAND"
+"""Environment variable marking the processes of a command (see `tag_command`)."""
+
+
+def _kill_process_group(proc: asyncio.subprocess.Process) -> None:
+    """Kill the process and everything it spawned (it runs in its own session)."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def tag_command(command: str, tag: str, var: str = COMMAND_TAG_VAR) -> str:
+    """Mark `command` and everything it spawns with `tag`, so they can be killed later even
+    when they run inside a container or job step (see `kill_tagged_script`).
+
+    The shell running `command` carries the tag on its command line, its descendants in
+    their environment. Tags must be distinct and of equal length (e.g. uuid hex strings).
+    Tags in different variables `var` can be combined.
+    """
+    return f"export {var}={tag}\n{command}"
+
+
+def command_tag(command: str) -> Optional[str]:
+    """The tag `tag_command` put on `command`, or None if it is untagged."""
+    prefix = f"export {COMMAND_TAG_VAR}="
+    if not command.startswith(prefix) or "\n" not in command:
+        return None
+    return command[len(prefix):command.index("\n")]
+
+
+def kill_tagged_script(tag: str, var: str = COMMAND_TAG_VAR) -> str:
+    """Shell script that SIGKILLs every process tagged with `tag` (in `var`) it can see.
+
+    Runs wherever the command ran (`docker exec`, `srun`), so it reaches processes that
+    outlive the local client process. The pattern is assembled at run time so the script
+    does not match itself.
+    """
+    return (
+        f"tag={shlex.quote(tag)}; "
+        f'for f in $(grep -ls "{var}=$tag" /proc/[0-9]*/cmdline /proc/[0-9]*/environ); do '
+        'p=${f#/proc/}; p=${p%%/*}; [ "$p" = "$$" ] || kill -9 "$p" 2>/dev/null; '
+        "done; true"
+    )
+
+
+def _read_proc(pid: int, name: str) -> bytes:
+    try:
+        with open(f"/proc/{pid}/{name}", "rb") as f:
+            return f.read()
+    except OSError:
+        # Exited meanwhile, or not ours to read
+        return b""
+
+
+def kill_tagged_processes(tag: str) -> int:
+    """Host-side `kill_tagged_script`: SIGKILL every process of this user tagged with `tag`,
+    returning how many were killed. Does nothing where there is no `/proc`."""
+    needle = f"{COMMAND_TAG_VAR}={tag}".encode()
+    try:
+        pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return 0
+    killed = 0
+    for pid in pids:
+        if pid != os.getpid() and any(needle in _read_proc(pid, name) for name in ("cmdline", "environ")):
+            try:
+                os.kill(pid, signal.SIGKILL)
+                killed += 1
+            except OSError:
+                pass
+    return killed
+
+
+async def stream_process(
+    cmd: list[str],
+    *,
+    timeout: float | None,
+    cwd: str | None = None,
+    env: dict[str, str] | None = None,
+) -> AsyncIterator[dict[str, Any]]:
+    """Run `cmd` and yield its merged stdout/stderr as it arrives.
+
+    Yields `{"output": str}` chunks followed by a single `{"returncode": int}`.
+    `subprocess.TimeoutExpired` is raised on timeout just like the synchronous `execute`
+    implementations do; `timeout=None` waits indefinitely. If the consumer stops iterating
+    early, the whole process group is killed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=cwd,
+        env=env,
+        start_new_session=True,
+    )
+    assert proc.stdout is not None
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def remaining() -> float | None:
+        return None if deadline is None else max(deadline - loop.time(), 0)
+
+    try:
+        while chunk := await asyncio.wait_for(proc.stdout.read(READ_CHUNK_SIZE), remaining()):
+            if text := decoder.decode(chunk):
+                yield {"output": text}
+        if text := decoder.decode(b"", final=True):
+            yield {"output": text}
+        yield {"returncode": await asyncio.wait_for(proc.wait(), remaining())}
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    finally:
+        if proc.returncode is None:
+            _kill_process_group(proc)
+            await proc.wait()
+
+
+async def collect_output(events: AsyncIterator[dict[str, Any]]) -> dict[str, Any]:
+    """Fold a stream of output events back into an environment result dict."""
+    output: list[str] = []
+    returncode = None
+    async for event in events:
+        if "output" in event:
+            output.append(event["output"])
+        else:
+            returncode = event["returncode"]
+    return {"output": "".join(output), "returncode": returncode}
+
+
+async def run_process(
+    cmd: list[str],
+    *,
+    timeout: float | None,
+    cwd: str | None = None,
+    env: dict[str, str] | None = None,
+) -> dict[str, Any]:
+    """Async counterpart of `subprocess.run` returning the environment result dict."""
+    return await collect_output(stream_process(cmd, timeout=timeout, cwd=cwd, env=env))
+
+
+async def pipe_process(
+    cmd: list[str],
+    *,
+    stdin: AsyncIterator[bytes] | None = None,
+    timeout: float | None = None,
+) -> AsyncIterator[bytes]:
+    """Run `cmd`, feeding it `stdin`, and yield its raw stdout.
+
+    Binary-safe counterpart of `stream_process` for file transfers: stdout is not decoded
+    and stderr is kept apart. A non-zero exit raises `subprocess.CalledProcessError` with
+    the decoded stderr.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    assert proc.stdout is not None and proc.stderr is not None
+
+    async def feed() -> None:
+        assert stdin is not None and proc.stdin is not None
+        try:
+            async for chunk in stdin:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # The process exited early; its return code tells why
+            pass
+        finally:
+            proc.stdin.close()
+
+    def remaining() -> float | None:
+        return None if deadline is None else max(deadline - loop.time(), 0)
+
+    feeder = asyncio.create_task(feed()) if stdin is not None else None
+    stderr = asyncio.create_task(proc.stderr.read())
+    try:
+        while chunk := await asyncio.wait_for(proc.stdout.read(READ_CHUNK_SIZE), remaining()):
+            yield chunk
+        if feeder is not None:
+            await asyncio.wait_for(feeder, remaining())
+        returncode = await asyncio.wait_for(proc.wait(), remaining())
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, cmd, stderr=(await stderr).decode("utf-8", errors="replace")
+            )
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    finally:
+        if proc.returncode is None:
+            _kill_process_group(proc)
+            await proc.wait()
+        for task in (feeder, stderr):
+            if task is not None and not task.done():
+                task.cancel()
@@ -7,10 +7,12 @@ import subprocess
 import tempfile
 import uuid
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, Callable
 
 from pydantic import BaseModel
 from environments.base import Environment
+from environments.files import resolve_path
+from environments.process import run_process, stream_process
 
 
 class SingularityEnvironmentConfig(BaseModel):
@@ -32,18 +34,26 @@ class SingularityEnvironmentConfig(BaseModel):
 
 class SingularityEnvironment(Environment):
     def __init__(
-        self, *, config_class: type = SingularityEnvironmentConfig, logger: logging.Logger | None = None, **kwargs
+        self,
+        *,
+        config_class: type = SingularityEnvironmentConfig,
+        logger: logging.Logger | None = None,
+        state_callback: Callable[[str], None] | None = None,
+        **kwargs,
     ):
         """Singularity environment. See `SingularityEnvironmentConfig` for kwargs."""
         self.logger = logger or logging.getLogger("agent_rollout_service.environment")
+        self.state_callback = state_callback
         self.config = config_class(**kwargs)
         self.sandbox_dir = self._build_sandbox()
 
     def _build_sandbox(self) -> Path:
+        # Building the sandbox pulls the image and unpacks it, there is no separate start step
+        self._report_state("pulling")
         # Building the sandbox can fail (very rarely), so we retry it
         max_retries = self.config.sandbox_build_retries
         for attempt in range(max_retries):
-            sandbox_dir = Path(tempfile.gettempdir()) / self.config.run_id
+            sandbox_dir = self._sandbox_path(self.config.run_id)
             try:
                 subprocess.run(
                     [self.config.executable, "build", "--sandbox", sandbox_dir, self.config.container_image],
@@ -60,11 +70,29 @@ class SingularityEnvironment(Environment):
                     raise
         return sandbox_dir
 
+    @staticmethod
+    def _sandbox_path(run_id: str) -> Path:
+        return Path(tempfile.gettempdir()) / run_id
+
+    @classmethod
+    def reconcile(cls, configs: dict[str, dict[str, Any]], reap_orphans: bool = False) -> set[str]:
+        """Sandboxes survive as long as their directory does."""
+        return {run_id for run_id in configs if cls._sandbox_path(run_id).is_dir()}
+
+    @classmethod
+    def reattach(cls, config: dict[str, Any]) -> "SingularityEnvironment":
+        env = cls.__new__(cls)
+        env.logger = logging.getLogger("agent_rollout_service.environment")
+        env.state_callback = None
+        env.config = SingularityEnvironmentConfig(**config)
+        env.sandbox_dir = cls._sandbox_path(env.config.run_id)
+        return env
+
     def get_template_vars(self) -> dict[str, Any]:
         return self.config.model_dump()
 
-    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
-        """Execute a command in a Singularity container and return the result as a dict."""
+    def _exec_cmd(self, command: str, cwd: str = "") -> list[str]:
+        """Build the `singularity exec` command line for `command`."""
         cmd = [self.config.executable, "exec"]
 
         # Do not inherit directories and env vars from host
@@ -81,8 +109,12 @@ class SingularityEnvironment(Environment):
             cmd.extend(["--env", f"{key}={value}"])
 
         cmd.extend(["--writable", str(self.sandbox_dir), "bash", "-c", command])
+        return cmd
+
+    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in a Singularity container and return the result as a dict."""
         result = subprocess.run(
-            cmd,
+            self._exec_cmd(command, cwd),
             text=True,
             timeout=timeout or self.config.timeout,
             encoding="utf-8",
@@ -92,9 +124,23 @@ class SingularityEnvironment(Environment):
         )
         return {"output": result.stdout, "returncode": result.returncode}
 
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in a Singularity container without blocking the event loop."""
+        return await run_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout)
+
+    async def astream(self, command: str, cwd: str = "", *, timeout: int | None = None) -> AsyncIterator[dict[str, Any]]:
+        """Execute a command in a Singularity container, yielding output as it is produced."""
+        async for event in stream_process(self._exec_cmd(command, cwd), timeout=timeout or self.config.timeout):
+            yield event
+
+    def host_path(self, path: str) -> Path:
+        """Files live in the writable sandbox directory."""
+        return resolve_path(self.sandbox_dir, path, cwd=self.config.cwd)
+
     def cleanup(self):
         shutil.rmtree(self.sandbox_dir, ignore_errors=True)
 
     def __del__(self):
         """Cleanup sandbox when object is destroyed."""
-        self.cleanup()
+        if not self.detached:
+            self.cleanup()
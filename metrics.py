@@ -0,0 +1,282 @@
+"""Minimal Prometheus metrics for the Agent Rollout Service.
+
+Implements just enough of the Prometheus text exposition format (counters, histograms and
+callback gauges) to avoid an extra dependency. Recording is a dict lookup and a few
+additions under a lock, so it is cheap enough to stay enabled in production.
+"""
+
+import bisect
+import math
+import subprocess
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from runners.base import BaseRunner, InsufficientResourcesError
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+"""Latency buckets in seconds, covering everything from `ls` to a cold image pull."""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value per label set."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        """Sum over all label sets."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram per label set."""
+
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts..., +Inf count], sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self._values[key]
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, **labels: Any) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def total_count(self) -> int:
+        """Number of observations over all label sets."""
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._values.values())
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge whose samples are computed by a callback at scrape time."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...],
+        callback: Callable[[], Iterable[Tuple[LabelValues, float]]],
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._callback = callback
+
+    def _render_samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._callback()
+        ]
+
+
+class CallbackCounter(Gauge):
+    """Counter whose samples are read by a callback at scrape time."""
+
+    type = "counter"
+
+
+class ServiceMetrics:
+    """The metrics exported on `/metrics`, plus helpers to record them."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, runner: BaseRunner):
+        self.runner = runner
+        labels = ("container_type", "image")
+        self.start_seconds = Histogram("arservice_instance_start_seconds", "Time to start an instance.", labels)
+        self.start_failures = Counter("arservice_instance_start_failures_total", "Instance starts that failed.", labels)
+        self.admission_rejections = Counter(
+            "arservice_admission_rejections_total", "Instance starts rejected for lack of resources.", labels
+        )
+        self.command_seconds = Histogram("arservice_command_seconds", "Command execution latency.", labels)
+        self.command_output_chars = Counter(
+            "arservice_command_output_chars_total", "Characters of command output returned to clients.", labels
+        )
+        self.command_timeouts = Counter("arservice_command_timeouts_total", "Commands that timed out.", labels)
+        self.command_failures = Counter(
+            "arservice_command_failures_total", "Commands that failed to run (excluding timeouts).", labels
+        )
+        self.command_cancellations = Counter(
+            "arservice_command_cancellations_total", "Commands cancelled by clients or on disconnect.", labels
+        )
+        self.close_seconds = Histogram("arservice_instance_close_seconds", "Time to tear down an instance.", labels)
+        self._metrics: List[_Metric] = [
+            self.start_seconds,
+            self.start_failures,
+            self.admission_rejections,
+            self.command_seconds,
+            self.command_output_chars,
+            self.command_timeouts,
+            self.command_failures,
+            self.command_cancellations,
+            self.close_seconds,
+            Gauge("arservice_instances", "Instances currently running.", (), lambda: [((), len(runner.running_instances))]),
+            Gauge(
+                "arservice_admission_queue_depth",
+                "Start requests waiting for resources.",
+                (),
+                lambda: [((), len(runner.admission_queue))],
+            ),
+            Gauge(
+                "arservice_resources_max",
+                "Maximum resources the runner admits.",
+                ("resource",),
+                lambda: [((key,), value) for key, value in runner.max_resources.items()],
+            ),
+            Gauge(
+                "arservice_resources_allocated",
+                "Resources currently allocated to instances.",
+                ("resource",),
+                lambda: [((key,), value) for key, value in runner.allocated_resources.items()],
+            ),
+        ]
+
+    def register_reaper(self, reaper: Any) -> None:
+        """Exports the counters of an `IdleReaper`."""
+        self.register(CallbackCounter(
+            "arservice_instances_reaped_total",
+            "Idle instances closed by the reaper.",
+            (),
+            lambda: [((), reaper.reaped)],
+        ))
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Adds another metric to the `/metrics` output."""
+        self._metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def request_labels(request_params: Dict[str, Any]) -> Dict[str, str]:
+        return {
+            "container_type": request_params.get("container_type", ""),
+            "image": request_params.get("container_image", ""),
+        }
+
+    def instance_labels(self, run_id: str) -> Dict[str, str]:
+        return self.request_labels(self.runner.running_instances.get(run_id, {}))
+
+    def record_start(self, labels: Dict[str, str], seconds: float, error: Optional[BaseException] = None) -> None:
+        if isinstance(error, InsufficientResourcesError):
+            self.admission_rejections.inc(**labels)
+            return
+        if error is not None:
+            self.start_failures.inc(**labels)
+        self.start_seconds.observe(seconds, **labels)
+
+    def record_command(
+        self, labels: Dict[str, str], seconds: float, output_chars: int = 0, error: Optional[BaseException] = None
+    ) -> None:
+        if isinstance(error, subprocess.TimeoutExpired):
+            self.command_timeouts.inc(**labels)
+        elif isinstance(error, KeyError):
+            return
+        elif error is not None:
+            self.command_failures.inc(**labels)
+        self.command_seconds.observe(seconds, **labels)
+        if output_chars:
+            self.command_output_chars.inc(output_chars, **labels)
+
+    def record_cancel(self, labels: Dict[str, str]) -> None:
+        self.command_cancellations.inc(**labels)
+
+    def record_close(self, labels: Dict[str, str], seconds: float) -> None:
+        self.close_seconds.observe(seconds, **labels)
+
+    def totals(self) -> Dict[str, int]:
+        """Cumulative event counts since the service started, for rates between two polls of `/stats`."""
+        return {
+            "starts": self.start_seconds.total_count() - int(self.start_failures.total()),
+            "closes": self.close_seconds.total_count(),
+            "commands": self.command_seconds.total_count(),
+        }
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
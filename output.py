@@ -0,0 +1,282 @@
+"""Output size policies for command results, with spill-to-disk of oversized output.
+
+A command's output is folded chunk by chunk as it is read from the pipe. Only the part a
+policy keeps (head and/or tail) stays in memory; once the limit is exceeded the full
+output goes to an on-disk blob that clients can fetch by byte range later.
+"""
+
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, Literal, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+SPILL_RETENTION_S = 3600
+"""How long spilled outputs are kept on disk."""
+
+_SPILL_ID = re.compile(r"[0-9a-f]{32}")
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class OutputPolicy(BaseModel):
+    max_bytes: Optional[int] = Field(None, ge=0)
+    """Maximum UTF-8 bytes of output returned inline (None: unlimited)."""
+    max_lines: Optional[int] = Field(None, ge=0)
+    """Maximum lines of output returned inline (None: unlimited)."""
+    keep: Literal["head", "tail", "head_tail"] = "head_tail"
+    """Which part of an oversized output is returned inline; `head_tail` splits the limits evenly."""
+    spill: bool = True
+    """Write the full output of a truncated command to disk (see `spill_id` in the result)."""
+
+    @property
+    def unlimited(self) -> bool:
+        return self.max_bytes is None and self.max_lines is None
+
+    def capped(self, limit: Optional["OutputPolicy"]) -> "OutputPolicy":
+        """Returns this policy with its limits lowered to those of `limit` (the server default)."""
+        if limit is None:
+            return self
+        return self.model_copy(update={
+            "max_bytes": _min_limit(self.max_bytes, limit.max_bytes),
+            "max_lines": _min_limit(self.max_lines, limit.max_lines),
+        })
+
+
+def _min_limit(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a, b)
+
+
+def _split(limit: Optional[int], keep: str) -> Tuple[Optional[int], Optional[int]]:
+    """Splits a limit into (head, tail) budgets."""
+    if limit is None:
+        return None, None
+    if keep == "head":
+        return limit, 0
+    if keep == "tail":
+        return 0, limit
+    return limit // 2, limit - limit // 2
+
+
+def _first_lines(data: bytes, n: Optional[int]) -> bytes:
+    if n is None:
+        return data
+    pos = -1
+    for _ in range(n):
+        pos = data.find(b"\n", pos + 1)
+        if pos == -1:
+            return data
+    return data[:pos + 1]
+
+
+def _last_lines(data: bytes, n: Optional[int]) -> bytes:
+    if n is None:
+        return data
+    if n == 0:
+        return b""
+    pos = len(data) - 1 if data.endswith(b"\n") else len(data)
+    for _ in range(n):
+        pos = data.rfind(b"\n", 0, pos)
+        if pos == -1:
+            return data
+    return data[pos + 1:]
+
+
+class OutputStore:
+    """Directory of spilled command outputs, each pruned `retention_s` after it was written.
+
+    The directory is created on first use (a fresh temporary directory if none is given).
+    """
+
+    def __init__(self, directory: Optional[str] = None, retention_s: float = SPILL_RETENTION_S):
+        self._directory = directory
+        self.retention_s = retention_s
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    @property
+    def directory(self) -> str:
+        with self._lock:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix="arservice-output-")
+            else:
+                os.makedirs(self._directory, exist_ok=True)
+            return self._directory
+
+    def path(self, spill_id: str) -> str:
+        """Returns the path of a spilled output, raising `KeyError` if the ID is malformed."""
+        if not _SPILL_ID.fullmatch(spill_id):
+            raise KeyError(f"Output {spill_id} not found.")
+        return os.path.join(self.directory, f"{spill_id}.out")
+
+    def create(self) -> Tuple[str, BinaryIO]:
+        """Creates a new blob, returning its ID and a file opened for writing."""
+        self.prune()
+        spill_id = uuid.uuid4().hex
+        return spill_id, open(self.path(spill_id), "wb")
+
+    def delete(self, spill_id: str) -> None:
+        try:
+            os.unlink(self.path(spill_id))
+        except (KeyError, FileNotFoundError):
+            pass
+
+    def size(self, spill_id: str) -> int:
+        """Returns the size of a spilled output, raising `KeyError` if it does not exist."""
+        try:
+            return os.path.getsize(self.path(spill_id))
+        except FileNotFoundError:
+            raise KeyError(f"Output {spill_id} not found.")
+
+    def iter_range(self, spill_id: str, start: int, end: int, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """Yields bytes `[start, end)` of a spilled output."""
+        with open(self.path(spill_id), "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0 and (chunk := f.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
+    def prune(self) -> None:
+        """Deletes expired outputs (at most once a minute)."""
+        now = time.time()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        directory = self.directory
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < now - self.retention_s:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parses a single-range `Range` header into `[start, end)`, or None if unsatisfiable."""
+    match = _RANGE.fullmatch(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = size if not last else min(int(last) + 1, size)
+    if start >= size or start >= end:
+        return None
+    return start, end
+
+
+class OutputCollector:
+    """Folds output chunks into a result dict according to an `OutputPolicy`.
+
+    Output is buffered as-is while it is within the policy's limits. When a limit is first
+    exceeded, the buffer is written to a spill blob (if a store is given), the head is
+    frozen and only a bounded tail is kept from then on.
+    """
+
+    def __init__(self, policy: OutputPolicy, store: Optional[OutputStore] = None):
+        self.policy = policy
+        self.store = store if policy.spill else None
+        self.head_bytes, self.tail_bytes = _split(policy.max_bytes, policy.keep)
+        self.head_lines, self.tail_lines = _split(policy.max_lines, policy.keep)
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.truncated = False
+        self.spill_id: Optional[str] = None
+        self._newlines = 0
+        self._buffer = bytearray()
+        self._head = b""
+        self._tail = bytearray()
+        self._spill: Optional[BinaryIO] = None
+
+    def feed(self, text: str) -> None:
+        data = text.encode("utf-8", errors="replace")
+        if not data:
+            return
+        self.total_bytes += len(data)
+        self._newlines += data.count(b"\n")
+        self.total_lines = self._newlines + (0 if data.endswith(b"\n") else 1)
+        if self.truncated:
+            self._write_spill(data)
+            self._tail += data
+            self._trim_tail()
+            return
+        self._buffer += data
+        if self._exceeded():
+            self.truncated = True
+            self._write_spill(self._buffer)
+            self._head = _first_lines(bytes(self._buffer[:self.head_bytes]), self.head_lines)
+            self._tail = self._buffer[len(self._head):]
+            self._trim_tail()
+            self._buffer = bytearray()
+
+    def _exceeded(self) -> bool:
+        return (self.policy.max_bytes is not None and self.total_bytes > self.policy.max_bytes) or (
+            self.policy.max_lines is not None and self.total_lines > self.policy.max_lines
+        )
+
+    def _trim_tail(self) -> None:
+        if self.tail_bytes is not None and len(self._tail) > self.tail_bytes:
+            del self._tail[:len(self._tail) - self.tail_bytes]
+        if self.tail_lines is not None:
+            self._tail = bytearray(_last_lines(bytes(self._tail), self.tail_lines))
+
+    def _write_spill(self, data: bytes) -> None:
+        if self.store is None:
+            return
+        if self._spill is None:
+            self.spill_id, self._spill = self.store.create()
+        self._spill.write(data)
+
+    def close(self, discard: bool = False) -> None:
+        """Closes the spill blob; `discard` deletes it (e.g. when the command failed)."""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if discard and self.spill_id is not None:
+            self.store.delete(self.spill_id)
+            self.spill_id = None
+
+    def result(self, returncode: Optional[int]) -> Dict[str, Any]:
+        if not self.truncated:
+            return {"output": self._buffer.decode("utf-8", errors="replace"), "returncode": returncode}
+        # Cuts may split a multi-byte character; drop the fragments
+        head = self._head.decode("utf-8", errors="ignore")
+        tail = bytes(self._tail).decode("utf-8", errors="ignore")
+        omitted = self.total_bytes - len(self._head) - len(self._tail)
+        return {
+            "output": f"{head}\n[... {omitted} bytes omitted ...]\n{tail}",
+            "returncode": returncode,
+            "truncated": True,
+            "output_bytes": self.total_bytes,
+            "output_lines": self.total_lines,
+            "spill_id": self.spill_id,
+        }
+
+
+async def collect_limited(
+    events: AsyncIterator[Dict[str, Any]], policy: OutputPolicy, store: Optional[OutputStore] = None
+) -> Dict[str, Any]:
+    """Like `environments.process.collect_output`, but applies `policy` while reading."""
+    collector = OutputCollector(policy, store)
+    returncode = None
+    try:
+        async for event in events:
+            if "output" in event:
+                collector.feed(event["output"])
+            else:
+                returncode = event["returncode"]
+    except BaseException:
+        collector.close(discard=True)
+        raise
+    collector.close()
+    return collector.result(returncode)
@@ -3,15 +3,24 @@
 Poll the AgentRolloutService for statistics.
 Usage:
     python poll.py --url http://127.0.0.1:8008 --list
+    python poll.py --url http://node1:8008 --url http://node2:8008   # combined dashboard
 """
 import argparse
+import asyncio
 import datetime as dt
+import heapq
 import json 
 import sys
 import time
+from dataclasses import dataclass
 from typing import Any
 
-import requests
+from client import AsyncClient, Client, RetryPolicy
+
+DEFAULT_URL = "http://127.0.0.1:8008"
+DASHBOARD_FIELDS = "container_image,num_cmd,busy_s,last_active_at"
+"""Instance fields the dashboard needs; the rest (e.g. `environment_config`) is not transferred."""
+RATE_KEYS = ("commands", "starts", "closes")
 
 
 def _fmt_ts(ts: float | None) -> str:
@@ -61,12 +70,11 @@ def _print_instances(stats: dict[str, Any]) -> None:
         print(f"{run_id}\t{container}\t{created_at}\t{updated_at}\t{num_cmd}")
 
 
-def fetch_and_display(url: str, list_instances: bool, raw: bool) -> None:
+def fetch_and_display(service: Client, list_instances: bool, raw: bool) -> None:
     try:
-        base = url.rstrip("/")
-        resp = requests.get(f"{base}/stats", timeout=5)
-        resp.raise_for_status()
-        stats = resp.json()
+        # Only the first 10 instances are shown, so don't transfer the rest
+        params = {} if raw else {"limit": 10 if list_instances else 0}
+        stats = service.stats(**params).model_dump()
     except Exception as e:
         print(f"Error fetching stats: {e}")
         return
@@ -80,25 +88,182 @@ def fetch_and_display(url: str, list_instances: bool, raw: bool) -> None:
         _print_instances(stats)
 
 
+@dataclass
+class NodeSample:
+    """Result of polling one server."""
+
+    url: str
+    stats: dict[str, Any] | None = None
+    error: str | None = None
+
+
+async def _poll_node(service: AsyncClient, url: str, timeout: float) -> NodeSample:
+    try:
+        stats = await asyncio.wait_for(service.stats(fields=DASHBOARD_FIELDS), timeout)
+    except Exception as e:
+        return NodeSample(url, error=str(e) or type(e).__name__)
+    return NodeSample(url, stats.model_dump())
+
+
+def _elapsed(current: dict[str, Any], previous: dict[str, Any] | None) -> float | None:
+    """Server seconds between two polls of the same server, or None if there is no usable previous poll."""
+    if previous is None or previous.get("uptime_s", 0) > current.get("uptime_s", 0):
+        # First poll, or the server restarted in between
+        return None
+    elapsed = current["server_time"] - previous["server_time"]
+    return elapsed if elapsed > 0 else None
+
+
+def _fmt_rate(rate: float | None) -> str:
+    return "-" if rate is None else f"{rate:.2f}"
+
+
+def _fmt_resources(max_res: dict[str, Any], alloc_res: dict[str, Any], available: dict[str, Any]) -> list[str]:
+    return [
+        f"  {key}: {alloc_res.get(key, 0):g}/{max_res[key]:g} allocated, {available.get(key, 0):g} available"
+        for key in sorted(max_res)
+    ]
+
+
+class Dashboard:
+    """Combined view of many servers; rates are computed between consecutive polls of each server."""
+
+    def __init__(self, top: int = 5):
+        self.top = top
+        self.previous: dict[str, dict[str, Any]] = {}
+
+    def render(self, samples: list[NodeSample]) -> list[str]:
+        up = [sample for sample in samples if sample.stats is not None]
+        max_res: dict[str, float] = {}
+        alloc_res: dict[str, float] = {}
+        available: dict[str, float] = {}
+        rates: dict[str, float | None] = {key: None for key in RATE_KEYS}
+        active = queued = 0
+        rows = []
+        # (node, instance, commands/s)
+        instances: list[tuple[str, dict[str, Any], float | None]] = []
+
+        for sample in samples:
+            stats = sample.stats
+            if stats is None:
+                rows.append(f"{sample.url:<32} {'DOWN':<6} {sample.error}")
+                continue
+            previous = self.previous.get(sample.url)
+            elapsed = _elapsed(stats, previous)
+            for total, key in ((max_res, "max_resources"), (alloc_res, "allocated_resources"), (available, "available_resources")):
+                for name, value in (stats.get(key) or {}).items():
+                    if isinstance(value, (int, float)):
+                        total[name] = total.get(name, 0) + value
+            node_rates = {}
+            for key in RATE_KEYS:
+                node_rates[key] = None
+                if elapsed is not None and key in stats.get("totals", {}):
+                    node_rates[key] = (stats["totals"][key] - previous["totals"].get(key, 0)) / elapsed
+                    rates[key] = (rates[key] or 0) + node_rates[key]
+            depth = (stats.get("admission_queue") or {}).get("depth", 0)
+            active += stats.get("active_instances", 0)
+            queued += depth
+            rows.append(
+                f"{sample.url:<32} {'up':<6} {stats.get('active_instances', 0):>9} {depth:>6} "
+                + " ".join(f"{_fmt_rate(node_rates[key]):>10}" for key in RATE_KEYS)
+            )
+
+            previous_cmds = {item["run_id"]: item.get("num_cmd") or 0 for item in (previous or {}).get("instances", [])}
+            for item in stats.get("instances", []):
+                cmd_rate = None
+                if elapsed is not None and item["run_id"] in previous_cmds:
+                    cmd_rate = ((item.get("num_cmd") or 0) - previous_cmds[item["run_id"]]) / elapsed
+                # Against the server's clock, in case the clocks of the nodes disagree
+                idle_s = stats["server_time"] - (item.get("last_active_at") or stats["server_time"])
+                instances.append((sample.url, item | {"idle_s": idle_s}, cmd_rate))
+            self.previous[sample.url] = stats
+
+        lines = [
+            f"Nodes: {len(up)}/{len(samples)} up   Active instances: {active}   Queued starts: {queued}",
+            "Rates: " + "   ".join(f"{_fmt_rate(rates[key])} {key}/s" for key in RATE_KEYS),
+            "Resources:",
+            *_fmt_resources(max_res, alloc_res, available),
+            "",
+            f"{'node':<32} {'status':<6} {'instances':>9} {'queued':>6} " + " ".join(f"{key + '/s':>10}" for key in RATE_KEYS),
+            *rows,
+        ]
+
+        def instance_row(url: str, item: dict[str, Any], cmd_rate: float | None, value: str) -> str:
+            return f"  {url:<32} {item['run_id']:<24} {str(item.get('container_image', '')):<32} {value:>10} {item.get('num_cmd') or 0:>6} {_fmt_rate(cmd_rate):>7}"
+
+        # Slowest: highest mean time per command
+        slowest = heapq.nlargest(
+            self.top,
+            (entry for entry in instances if entry[1].get("num_cmd")),
+            key=lambda entry: (entry[1].get("busy_s") or 0) / entry[1]["num_cmd"],
+        )
+        if slowest:
+            lines += ["", "Slowest instances:", f"  {'node':<32} {'run_id':<24} {'container':<32} {'s/cmd':>10} {'cmds':>6} {'cmd/s':>7}"]
+            for url, item, cmd_rate in slowest:
+                lines.append(instance_row(url, item, cmd_rate, f"{(item.get('busy_s') or 0) / item['num_cmd']:.2f}"))
+
+        idle = heapq.nlargest(self.top, instances, key=lambda entry: entry[1]["idle_s"])
+        if idle:
+            lines += ["", "Most idle instances:", f"  {'node':<32} {'run_id':<24} {'container':<32} {'idle':>10} {'cmds':>6} {'cmd/s':>7}"]
+            for url, item, cmd_rate in idle:
+                lines.append(instance_row(url, item, cmd_rate, f"{item['idle_s']:.0f}s"))
+        return lines
+
+
+async def run_dashboard(urls: list[str], interval: float, top: int) -> None:
+    """Polls all servers concurrently every `interval` seconds and redraws the combined view."""
+    # A slow or unreachable server times out before the next refresh is due
+    timeout = max(interval * 0.8, 0.1)
+    services = {url: AsyncClient(url, max_concurrency=1, retry=RetryPolicy(attempts=1), timeout=timeout) for url in urls}
+    dashboard = Dashboard(top)
+    try:
+        next_refresh = time.monotonic()
+        while True:
+            samples = await asyncio.gather(*(_poll_node(services[url], url, timeout) for url in urls))
+            sys.stdout.write("\033[H\033[J" + "\n".join(dashboard.render(list(samples))) + "\n")
+            sys.stdout.flush()
+            # Keep a fixed cadence; if a refresh overran, skip ahead rather than trying to catch up
+            next_refresh = max(next_refresh + interval, time.monotonic())
+            await asyncio.sleep(next_refresh - time.monotonic())
+    finally:
+        await asyncio.gather(*(service.aclose() for service in services.values()))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Query AgentRolloutService stats")
-    parser.add_argument("--url", default="http://127.0.0.1:8008", help="Service base URL, e.g. http://127.0.0.1:8008")
+    parser.add_argument(
+        "--url", action="append", help="Service base URL, e.g. http://127.0.0.1:8008 (repeat or comma-separate for several servers)"
+    )
     parser.add_argument("--list", action="store_true", help="List active instances")
     parser.add_argument("--raw", action="store_true", help="Print raw JSON response")
     parser.add_argument("--interval", type=float, default=1.0, help="Polling interval in seconds (default: 1.0)")
+    parser.add_argument("--dashboard", action="store_true", help="Combined dashboard view (default with several URLs)")
+    parser.add_argument("--top", type=int, default=5, help="Slowest / most idle instances shown in the dashboard (default: 5)")
     args = parser.parse_args()
+    urls = [url.strip() for value in args.url or [DEFAULT_URL] for url in value.split(",") if url.strip()]
+
+    if args.dashboard or len(urls) > 1:
+        try:
+            asyncio.run(run_dashboard(urls, args.interval, args.top))
+        except KeyboardInterrupt:
+            sys.exit(0)
+        return
 
+    # One keep-alive connection for all polls; a failed poll is simply shown until the next one
+    service = Client(urls[0], max_concurrency=1, retry=RetryPolicy(attempts=1), timeout=5)
     try:
         while True:
             # Clear screen (ANSI escape code)
             sys.stdout.write("\033[H\033[J")
             sys.stdout.flush()
             
-            fetch_and_display(args.url, args.list, args.raw)
+            fetch_and_display(service, args.list, args.raw)
             time.sleep(args.interval)
     except KeyboardInterrupt:
         # Graceful exit on Ctrl+C without showing traceback
         sys.exit(0)
+    finally:
+        service.close()
 
 
 if __name__ == "__main__":
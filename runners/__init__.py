@@ -1,5 +1,17 @@
-from runners.base import BaseRunner
+from runners.base import BaseRunner, InsufficientResourcesError, InstanceExistsError, Reservation
+from runners.federated import FederatedRunner, FederationNode
 from runners.local import LocalRunner
+from runners.sharded import ShardedRunner
 from runners.slurm import SlurmRunner
 
-__all__ = ["BaseRunner", "LocalRunner", "SlurmRunner"]
+__all__ = [
+    "BaseRunner",
+    "FederatedRunner",
+    "FederationNode",
+    "InsufficientResourcesError",
+    "InstanceExistsError",
+    "LocalRunner",
+    "Reservation",
+    "ShardedRunner",
+    "SlurmRunner",
+]
@@ -0,0 +1,136 @@
+import asyncio
+import itertools
+import time
+from typing import Any, Callable, Dict, List
+
+from pydantic import BaseModel
+
+DEFAULT_TENANT = "default"
+"""Tenant of run IDs that match no configured tenant prefix."""
+
+PRIORITY_CLASSES = {"high": 0, "normal": 1, "low": 2}
+"""Priority classes, mapped to their admission rank (lower is admitted first)."""
+
+
+class TenantConfig(BaseModel):
+    quota: Dict[str, float] = {}
+    """Maximum resources the tenant may hold at once. Resource keys not listed are only
+    limited by the runner's `max_resources`."""
+    weight: float = 1.0
+    """Share of contended capacity relative to other tenants."""
+
+
+class AdmissionTicket:
+    """A start request waiting in the admission queue for resources."""
+
+    _sequence = itertools.count()
+
+    def __init__(
+        self,
+        resources: Dict[str, Any],
+        loop: asyncio.AbstractEventLoop,
+        tenant: str = DEFAULT_TENANT,
+        priority: str = "normal",
+    ):
+        self.resources = resources
+        self.loop = loop
+        self.tenant = tenant
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES[priority]
+        self.seq = next(self._sequence)
+        self.event = asyncio.Event()
+        self.enqueued_at = time.time()
+        self.admitted = False
+
+    def admit(self) -> None:
+        """Marks the ticket admitted and wakes its waiter (safe to call from any thread)."""
+        self.admitted = True
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class AdmissionQueue:
+    """Queue of start requests waiting for resources, with wait-time statistics.
+
+    Tickets are admitted by priority class first, then from the tenant with the lowest
+    weighted share of the runner's resources, then in arrival order.
+
+    Not thread-safe on its own; the runner serializes access with its resource lock.
+    """
+
+    def __init__(self):
+        self._tickets: List[AdmissionTicket] = []
+        self.admitted = 0
+        self.timed_out = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+        self.version = 0
+        """Changes whenever the queue content changes."""
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def push(self, ticket: AdmissionTicket) -> None:
+        self._tickets.append(ticket)
+        self.version += 1
+
+    def remove(self, ticket: AdmissionTicket, timed_out: bool = True) -> None:
+        """Drops a ticket that gave up waiting (or was never willing to wait)."""
+        try:
+            self._tickets.remove(ticket)
+        except ValueError:
+            return
+        if timed_out:
+            self.timed_out += 1
+        self.version += 1
+
+    def admit_ready(
+        self,
+        fits: Callable[[AdmissionTicket], bool],
+        within_quota: Callable[[AdmissionTicket], bool],
+        share: Callable[[str], float],
+        allocate: Callable[[AdmissionTicket], None],
+    ) -> List[AdmissionTicket]:
+        """Admits tickets for as long as the best candidate fits.
+
+        Tickets over their tenant's quota are skipped, as only their own tenant can unblock
+        them. A best candidate that does not fit the runner's free capacity blocks the
+        tickets behind it, so large requests are not starved by a stream of small ones.
+        """
+        admitted = []
+        while True:
+            candidates = [ticket for ticket in self._tickets if within_quota(ticket)]
+            if not candidates:
+                break
+            ticket = min(candidates, key=lambda t: (t.rank, share(t.tenant), t.seq))
+            if not fits(ticket):
+                break
+            self._tickets.remove(ticket)
+            allocate(ticket)
+            waited = time.time() - ticket.enqueued_at
+            self.admitted += 1
+            self.total_wait_s += waited
+            self.max_wait_s = max(self.max_wait_s, waited)
+            ticket.admit()
+            admitted.append(ticket)
+            self.version += 1
+        return admitted
+
+    def queued_by_tenant(self) -> Dict[str, Dict[str, Any]]:
+        """Number of waiting tickets and the resources they ask for, per tenant."""
+        queued: Dict[str, Dict[str, Any]] = {}
+        for ticket in self._tickets:
+            entry = queued.setdefault(ticket.tenant, {"requests": 0, "resources": {}})
+            entry["requests"] += 1
+            for key, value in ticket.resources.items():
+                entry["resources"][key] = entry["resources"].get(key, 0) + value
+        return queued
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": len(self._tickets),
+            "oldest_wait_s": time.time() - min(t.enqueued_at for t in self._tickets) if self._tickets else 0.0,
+            "admitted_after_wait": self.admitted,
+            "timed_out": self.timed_out,
+            "avg_wait_s": self.total_wait_s / self.admitted if self.admitted else 0.0,
+            "max_wait_s": self.max_wait_s,
+        }
@@ -1,13 +1,132 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+import contextlib
+import logging
+import threading
+import time
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from runners.admission import DEFAULT_TENANT, PRIORITY_CLASSES, AdmissionQueue, AdmissionTicket, TenantConfig
+from runners.registry import InstanceRegistry
+from runners.store import InstanceStore
+from runners.workers import StartLimits, WorkerPools
+from environments.files import DEFAULT_READ_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+class InsufficientResourcesError(RuntimeError):
+    """Raised when an instance cannot be admitted because resources are exhausted."""
+
+
+class GroupStartError(RuntimeError):
+    """Raised when an instance of an all-or-nothing group fails to start; none of the group
+    is left running."""
+
+    def __init__(self, errors: Dict[str, str]):
+        super().__init__("; ".join(f"{run_id}: {error}" for run_id, error in errors.items()))
+        self.errors = errors
+        """Error message by run ID of the instances that failed to start."""
+
+
+class InstanceExistsError(ValueError):
+    """Raised when a start names a run ID that is already running or being started."""
+
+
+class Reservation:
+    """Resources admitted for starting instances, held until the instances are registered
+    (`commit`) or their start fails (`rollback`).
+
+    Rolling back is idempotent and does nothing once committed, so no failure path can
+    release the resources twice. Used as a context manager, the reservation is rolled back
+    when the block exits without committing it.
+    """
+
+    def __init__(self, runner: "BaseRunner", resources: Dict[str, Any], tenant: str, run_ids: Iterable[str] = ()):
+        self.runner = runner
+        self.resources = dict(resources)
+        self.tenant = tenant
+        self.run_ids = list(run_ids)
+        self.state = "held"
+        """`held`, `committed` or `released`."""
+
+    def split(self, run_id: str, resources: Dict[str, Any]) -> "Reservation":
+        """Moves the share of `run_id` out of a group reservation into a reservation of its own."""
+        with self.runner._resource_lock:
+            if self.state != "held" or run_id not in self.run_ids:
+                raise ValueError(f"Run ID {run_id} is not held by this reservation")
+            for key, value in resources.items():
+                self.resources[key] = self.resources.get(key, 0) - value
+            self.run_ids.remove(run_id)
+            return Reservation(self.runner, resources, self.tenant, [run_id])
+
+    def commit(self) -> None:
+        """Hands the resources over to the registered instances, which release them when closed."""
+        with self.runner._resource_lock:
+            if self.state != "held":
+                raise RuntimeError(f"Reservation of {self.run_ids} is already {self.state}")
+            self.state = "committed"
+            self.runner._starting.difference_update(self.run_ids)
+
+    def rollback(self) -> None:
+        """Releases the resources, unless they were committed or released already."""
+        with self.runner._resource_lock:
+            if self.state != "held":
+                return
+            self.state = "released"
+            self.runner._starting.difference_update(self.run_ids)
+            self.runner._release_resources(self.resources, self.tenant)
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.rollback()
+
 
 class BaseRunner(ABC):
     """Abstract base class for runners."""
 
-    def __init__(self, max_resources: Dict[str, Any]):
+    forwards_commands = False
+    """Whether the API relays command requests to `aforward_command` as-is instead of running
+    them through `aexecute_command` / `astream_command`."""
+
+    def __init__(
+        self,
+        max_resources: Dict[str, Any],
+        tenants: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_path: Optional[str] = None,
+        workers: Optional[WorkerPools] = None,
+        start_limits: Optional[StartLimits] = None,
+    ):
+        """
+        - **max_resources**: resources the runner admits in total
+        - **tenants**: per-tenant `TenantConfig` (quota, weight), keyed by run ID prefix
+        - **state_path**: SQLite database persisting the instance registry (see `recover`)
+        - **workers**: thread pools for blocking starts, commands and closes
+        - **start_limits**: adaptive limits on concurrent starts per container runtime
+        """
         self.max_resources = max_resources
         self.allocated_resources: Dict[str, Any] = {key: 0 for key in max_resources}
-        self.running_instances: Dict[str, Any] = {}
+        self.tenants = {prefix: TenantConfig(**config) for prefix, config in (tenants or {}).items()}
+        self.tenant_allocated: Dict[str, Dict[str, Any]] = {}
+        self.running_instances = InstanceRegistry()
+        self.admission_queue = AdmissionQueue()
+        # Guards allocated_resources, the admission queue and the run IDs being started, which are
+        # also touched from worker threads. Held for the counter arithmetic only, never across I/O.
+        self._resource_lock = threading.RLock()
+        # Changes whenever allocated_resources does (see `stats_version`)
+        self._resources_version = 0
+        # Run IDs with a `Reservation` that is neither committed nor rolled back
+        self._starting: Set[str] = set()
+        self.store = InstanceStore(state_path) if state_path else None
+        # Number of commands / transfers currently running per instance
+        self._busy: Dict[str, int] = {}
+        self.recovery: Dict[str, Any] = {}
+        """Outcome of the last `recover` call."""
+        self.warm_images: Set[str] = set()
+        """Images instances were started from, so their layers are likely cached here (see `GET /images`)."""
+        self.workers = workers or WorkerPools()
+        self.start_limits = start_limits or StartLimits()
 
     @abstractmethod
     def start_instance(self, request_params: Dict[str, Any]) -> str:
@@ -25,12 +144,21 @@ class BaseRunner(ABC):
         - container_timeout: str - Container timeout
         - pull_timeout: int - Image pull timeout
         - resources: Dict[str, Any] - Resource requirements
+        - queue_timeout: Optional[float] - Seconds to wait in the admission queue when
+          resources are exhausted (0: reject immediately, None: wait indefinitely). Only the
+          async path (`astart_instance`) queues.
+        - priority: str - Admission priority class: "high", "normal" or "low"
+        - idle_timeout: Optional[float] - Seconds without activity after which the idle reaper
+          closes the instance (None: the server default, 0: never)
         """
         pass
 
     @abstractmethod
-    def execute_command(self, run_id: str, cmd: str) -> Dict[str, Any]:
-        """Executes a command in the specified run ID."""
+    def execute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Executes a command in the specified run ID.
+
+        `timeout` overrides the environment's default command timeout when given.
+        """
         pass
 
     @abstractmethod
@@ -38,6 +166,154 @@ class BaseRunner(ABC):
         """Closes the specified run ID."""
         pass
 
+    async def astart_instance(
+        self, request_params: Dict[str, Any], on_state: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Async variant of `start_instance`.
+
+        `on_state` is called with `"pulling"` / `"starting"` as far as the runner can tell the
+        start phases apart; it may be called from a worker thread.
+
+        The default implementation runs `start_instance` in a worker thread; runners with a
+        native asyncio implementation override it.
+        """
+        return await self.workers.run(self.workers.start, self.start_instance, request_params)
+
+    async def _alaunch_instance(
+        self,
+        request_params: Dict[str, Any],
+        reservation: Reservation,
+        on_state: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Starts an instance on `reservation`, committing it once the instance is registered
+        and rolling it back if the start fails.
+
+        Runners implement this to support `astart_instances`.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support starting instances as a group")
+
+    async def astart_instances(
+        self,
+        requests: List[Dict[str, Any]],
+        queue_timeout: Optional[float] = 0,
+        priority: str = "normal",
+    ) -> List[str]:
+        """Starts a group of instances all-or-nothing, returning their run IDs.
+
+        The combined resources of the group are reserved in one step, waiting in the admission
+        queue for up to `queue_timeout` seconds, so the group is admitted as a whole or not at
+        all. The environments are then launched concurrently; if any fails to start, those that
+        did are closed again and `GroupStartError` is raised.
+        """
+        run_ids = [request_params["run_id"] for request_params in requests]
+        if len(set(run_ids)) != len(run_ids):
+            raise ValueError("Run IDs of a group must be unique")
+        tenants = {self.tenant_of(run_id) for run_id in run_ids}
+        if len(tenants) > 1:
+            raise ValueError(f"All instances of a group must belong to one tenant, got {sorted(tenants)}")
+        if not requests:
+            return []
+        combined: Dict[str, Any] = {}
+        for request_params in requests:
+            for key, value in request_params.get("resources", {"instances": 1}).items():
+                combined[key] = combined.get(key, 0) + value
+        group = await self._areserve_resources(
+            combined, queue_timeout, tenant=tenants.pop(), priority=priority, run_ids=run_ids
+        )
+
+        # Each launch commits or rolls back its own share of the reservation
+        with group:
+            shares = [
+                group.split(request_params["run_id"], request_params.get("resources", {"instances": 1}))
+                for request_params in requests
+            ]
+        launches = [
+            asyncio.ensure_future(self._alaunch_instance(request_params, share))
+            for request_params, share in zip(requests, shares)
+        ]
+        try:
+            await asyncio.wait(launches)
+        except asyncio.CancelledError:
+            for launch in launches:
+                launch.cancel()
+            await asyncio.shield(self._aclose_launched(launches, shares))
+            raise
+        errors = {
+            run_id: str(launch.exception())
+            for run_id, launch in zip(run_ids, launches)
+            if launch.exception() is not None
+        }
+        if errors:
+            await self._aclose_launched(launches, shares)
+            raise GroupStartError(errors)
+        return [launch.result() for launch in launches]
+
+    async def _aclose_launched(self, launches: List["asyncio.Future[str]"], shares: List[Reservation]) -> None:
+        """Closes the instances of a failed group start that did start."""
+        await asyncio.wait(launches)
+        # A launch cancelled before it ran never got to roll back its share
+        for share in shares:
+            share.rollback()
+        started = [
+            launch.result() for launch in launches if not launch.cancelled() and launch.exception() is None
+        ]
+        results = await asyncio.gather(*(self.aclose_instance(run_id) for run_id in started), return_exceptions=True)
+        for run_id, result in zip(started, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to close instance {run_id} of a failed group start: {result}")
+
+    async def aexecute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Async variant of `execute_command`."""
+        return await self.workers.run(self.workers.execute, self.execute_command, run_id, cmd, timeout)
+
+    async def astream_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Executes a command, yielding `{"output": ...}` chunks and a final `{"returncode": ...}`.
+
+        The default implementation yields the whole output of `aexecute_command` at once.
+        """
+        result = await self.aexecute_command(run_id, cmd, timeout=timeout)
+        if result.get("output"):
+            yield {"output": result["output"]}
+        yield {"returncode": result.get("returncode")}
+
+    async def akill_command(self, run_id: str, tag: str) -> None:
+        """Kills the processes of a command run with `tag_command(cmd, tag)`, wherever they run.
+
+        Cancelling a command only kills the local client process (`docker exec`, `srun`);
+        this reaches what it started inside the instance.
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot kill commands")
+
+    def aforward_command(
+        self, run_id: str, path: str, payload: Dict[str, Any], headers: Dict[str, str]
+    ) -> AsyncContextManager[Any]:
+        """Sends a command request (`/execute_command` or `/execute_command_stream`) to the
+        service running the instance, for runners that set `forwards_commands`.
+
+        The context yields the `httpx.Response` with its body unread; that service applies the
+        output limits and encodes the body. Raises `KeyError` if it does not know the instance.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not forward commands")
+
+    async def aclose_instance(self, run_id: str) -> None:
+        """Async variant of `close_instance`."""
+        await self.workers.run(self.workers.close, self.close_instance, run_id)
+
+    async def aupload(self, run_id: str, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Extracts a streamed tar archive into the directory `path` of the instance."""
+        raise NotImplementedError(f"{type(self).__name__} does not support file transfer")
+
+    async def adownload(self, run_id: str, path: str) -> AsyncIterator[bytes]:
+        """Yields a tar archive of `path` (a file or directory) in the instance."""
+        raise NotImplementedError(f"{type(self).__name__} does not support file transfer")
+        yield b""
+
+    async def aread_files(
+        self, run_id: str, paths: List[str], max_bytes: int = DEFAULT_READ_MAX_BYTES
+    ) -> Dict[str, Dict[str, Any]]:
+        """Reads up to `max_bytes` of each of `paths` in the instance (see `Environment.aread_files`)."""
+        raise NotImplementedError(f"{type(self).__name__} does not support file transfer")
+
     def get_available_resources(self) -> Dict[str, Any]:
         """Returns the available resources."""
         return {
@@ -45,22 +321,293 @@ class BaseRunner(ABC):
             for key in self.max_resources
         }
 
+    def tenant_of(self, run_id: str) -> str:
+        """Returns the tenant of a run: the longest configured tenant prefix of `run_id`."""
+        matches = [prefix for prefix in self.tenants if run_id.startswith(prefix)]
+        return max(matches, key=len) if matches else DEFAULT_TENANT
+
+    def get_tenant_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns allocated and queued resources, quota and weight per tenant."""
+        with self._resource_lock:
+            queued = self.admission_queue.queued_by_tenant()
+            tenants = set(self.tenants) | set(self.tenant_allocated) | set(queued)
+            return {
+                tenant: {
+                    "allocated": dict(self.tenant_allocated.get(tenant, {})),
+                    "queued": queued.get(tenant, {"requests": 0, "resources": {}}),
+                    "quota": self._tenant_config(tenant).quota,
+                    "weight": self._tenant_config(tenant).weight,
+                }
+                for tenant in sorted(tenants)
+            }
+
+    def _tenant_config(self, tenant: str) -> TenantConfig:
+        return self.tenants.get(tenant) or TenantConfig()
+
     def _check_resources(self, required_resources: Dict[str, Any]) -> bool:
         """Checks if enough resources are available."""
-        available = self.get_available_resources()
         for key, value in required_resources.items():
-            if key in self.max_resources and available.get(key, 0) < value:
+            if key in self.max_resources and self.allocated_resources.get(key, 0) + value > self.max_resources[key]:
                 return False
         return True
 
-    def _allocate_resources(self, resources: Dict[str, Any]):
+    def _within_quota(self, required_resources: Dict[str, Any], tenant: str) -> bool:
+        """Checks if the tenant can take `required_resources` without exceeding its quota."""
+        allocated = self.tenant_allocated.get(tenant, {})
+        for key, limit in self._tenant_config(tenant).quota.items():
+            if allocated.get(key, 0) + required_resources.get(key, 0) > limit:
+                return False
+        return True
+
+    def _can_ever_fit(self, required_resources: Dict[str, Any], tenant: str = DEFAULT_TENANT) -> bool:
+        """Checks if a request fits into `max_resources` and the tenant's quota at all."""
+        quota = self._tenant_config(tenant).quota
+        for key, value in required_resources.items():
+            if key in self.max_resources and self.max_resources[key] < value:
+                return False
+            if key in quota and quota[key] < value:
+                return False
+        return True
+
+    def _tenant_share(self, tenant: str) -> float:
+        """The tenant's dominant share of `max_resources`, divided by its weight."""
+        allocated = self.tenant_allocated.get(tenant, {})
+        shares = [allocated.get(key, 0) / limit for key, limit in self.max_resources.items() if limit > 0]
+        return max(shares, default=0.0) / self._tenant_config(tenant).weight
+
+    def _claim_run_ids(self, run_ids: Iterable[str]) -> None:
+        """Marks run IDs as being started, raising `InstanceExistsError` if one already is or runs."""
+        with self._resource_lock:
+            taken = [run_id for run_id in run_ids if run_id in self._starting or run_id in self.running_instances]
+            if taken:
+                raise InstanceExistsError(f"Run ID {', '.join(taken)} is already running or starting")
+            self._starting.update(run_ids)
+
+    def _reserve_resources(
+        self, resources: Dict[str, Any], tenant: str = DEFAULT_TENANT, run_ids: Iterable[str] = ()
+    ) -> Reservation:
+        """Reserves resources for starting `run_ids` right away or raises `InsufficientResourcesError`.
+
+        Requests already waiting in the admission queue go first.
+        """
+        run_ids = list(run_ids)
+        with self._resource_lock:
+            self._claim_run_ids(run_ids)
+            if not self.admission_queue and self._check_resources(resources) and self._within_quota(resources, tenant):
+                self._allocate_resources(resources, tenant)
+                return Reservation(self, resources, tenant, run_ids)
+            self._starting.difference_update(run_ids)
+        raise InsufficientResourcesError(f"Not enough resources. Available: {self.get_available_resources()}")
+
+    async def _areserve_resources(
+        self,
+        resources: Dict[str, Any],
+        queue_timeout: Optional[float] = 0,
+        tenant: str = DEFAULT_TENANT,
+        priority: str = "normal",
+        run_ids: Iterable[str] = (),
+    ) -> Reservation:
+        """Reserves resources for starting `run_ids`, waiting in the admission queue for up to
+        `queue_timeout` seconds.
+
+        Capacity freed by `_release_resources` is handed out immediately, by priority class,
+        weighted tenant share and arrival order (see `AdmissionQueue`).
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class {priority!r} (available: {list(PRIORITY_CLASSES)})")
+        run_ids = list(run_ids)
+        self._claim_run_ids(run_ids)
+        try:
+            await self._aadmit(resources, queue_timeout, tenant, priority)
+        except BaseException:
+            with self._resource_lock:
+                self._starting.difference_update(run_ids)
+            raise
+        return Reservation(self, resources, tenant, run_ids)
+
+    async def _aadmit(
+        self, resources: Dict[str, Any], queue_timeout: Optional[float], tenant: str, priority: str
+    ) -> None:
+        """Allocates resources, through the admission queue if others are waiting or they do not fit."""
+        with self._resource_lock:
+            if not self._can_ever_fit(resources, tenant):
+                raise InsufficientResourcesError(
+                    f"Request exceeds the maximum resources of tenant {tenant!r}: {resources}"
+                )
+            if not self.admission_queue and self._check_resources(resources) and self._within_quota(resources, tenant):
+                self._allocate_resources(resources, tenant)
+                return
+            # Others are waiting: queue up, but a higher priority or a smaller share may still go first
+            ticket = AdmissionTicket(resources, asyncio.get_running_loop(), tenant, priority)
+            self.admission_queue.push(ticket)
+            self._admit_waiting()
+            if ticket.admitted:
+                return
+            if queue_timeout == 0:
+                self.admission_queue.remove(ticket, timed_out=False)
+                raise InsufficientResourcesError(f"Not enough resources. Available: {self.get_available_resources()}")
+        try:
+            await asyncio.wait_for(ticket.event.wait(), queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._resource_lock:
+                if not ticket.admitted:
+                    self.admission_queue.remove(ticket)
+                    # The ticket may have been the only thing blocking the ones behind it
+                    self._admit_waiting()
+                elif isinstance(e, asyncio.CancelledError):
+                    self._release_resources(resources, tenant)
+                else:
+                    # Admitted just as the deadline passed
+                    return
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise InsufficientResourcesError(
+                f"Not enough resources after waiting {queue_timeout}s. Available: {self.get_available_resources()}"
+            )
+
+    def _admit_waiting(self) -> None:
+        with self._resource_lock:
+            self.admission_queue.admit_ready(
+                fits=lambda ticket: self._check_resources(ticket.resources),
+                within_quota=lambda ticket: self._within_quota(ticket.resources, ticket.tenant),
+                share=self._tenant_share,
+                allocate=lambda ticket: self._allocate_resources(ticket.resources, ticket.tenant),
+            )
+
+    def _allocate_resources(self, resources: Dict[str, Any], tenant: str = DEFAULT_TENANT):
         """Allocates resources."""
-        for key, value in resources.items():
-            if key in self.max_resources:
-                self.allocated_resources[key] = self.allocated_resources.get(key, 0) + value
-
-    def _release_resources(self, resources: Dict[str, Any]):
-        """Releases resources."""
-        for key, value in resources.items():
-            if key in self.max_resources:
-                self.allocated_resources[key] = max(0, self.allocated_resources.get(key, 0) - value)
+        with self._resource_lock:
+            tenant_allocated = self.tenant_allocated.setdefault(tenant, {})
+            for key, value in resources.items():
+                if key in self.max_resources:
+                    self.allocated_resources[key] = self.allocated_resources.get(key, 0) + value
+                tenant_allocated[key] = tenant_allocated.get(key, 0) + value
+            self._resources_version += 1
+
+    def _release_resources(self, resources: Dict[str, Any], tenant: str = DEFAULT_TENANT):
+        """Releases resources and admits queued requests that now fit."""
+        with self._resource_lock:
+            tenant_allocated = self.tenant_allocated.get(tenant, {})
+            for key, value in resources.items():
+                if key in self.max_resources:
+                    self.allocated_resources[key] = max(0, self.allocated_resources.get(key, 0) - value)
+                if key in tenant_allocated:
+                    tenant_allocated[key] = max(0, tenant_allocated[key] - value)
+            self._resources_version += 1
+            if tenant in self.tenant_allocated and not any(tenant_allocated.values()):
+                del self.tenant_allocated[tenant]
+            self._admit_waiting()
+
+    def touch_instance(self, run_id: str) -> Dict[str, Any]:
+        """Renews the idle lease of an instance (e.g. on a client heartbeat), raising `KeyError` if it is unknown."""
+        instance_data = self._get_instance(run_id)
+        instance_data["last_active_at"] = time.time()
+        self.running_instances.touch()
+        return instance_data
+
+    @contextlib.contextmanager
+    def activity(self, run_id: str) -> Iterator[None]:
+        """Marks the instance busy for the duration of the block, so it is not reaped as idle.
+
+        The time spent in the block is added to the instance's `busy_s`.
+        """
+        self._busy[run_id] = self._busy.get(run_id, 0) + 1
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._busy[run_id] -= 1
+            if not self._busy[run_id]:
+                del self._busy[run_id]
+            if run_id in self.running_instances:
+                instance_data = self.running_instances[run_id]
+                instance_data["last_active_at"] = now = time.time()
+                instance_data["busy_s"] = instance_data.get("busy_s", 0.0) + now - started
+
+    def is_busy(self, run_id: str) -> bool:
+        return run_id in self._busy
+
+    def _register_instance(self, run_id: str, instance_data: Dict[str, Any]) -> None:
+        """Adds a started instance to the registry and the durable store."""
+        instance_data.setdefault("last_active_at", instance_data.get("created_at", time.time()))
+        self.running_instances[run_id] = instance_data
+        self.warm_images.add(instance_data["container_image"])
+        if self.store is not None:
+            self.store.put(run_id, self._instance_record(instance_data))
+
+    def _instance_record(self, instance_data: Dict[str, Any]) -> Dict[str, Any]:
+        """The serializable part of the instance data that is persisted."""
+        return {key: value for key, value in instance_data.items() if key != "env"}
+
+    def _remove_instance(self, run_id: str) -> None:
+        """Drops an instance from the registry and releases its resources."""
+        instance_data = self.running_instances.pop(run_id, None)
+        if self.store is not None:
+            self.store.delete(run_id)
+        if instance_data is not None:
+            self._release_resources(instance_data["resources"], instance_data.get("tenant", DEFAULT_TENANT))
+
+    def recover(self, reap_orphans: bool = False) -> Dict[str, Any]:
+        """Re-adopts the instances recorded in the store that survived a restart of the service.
+
+        Records are reconciled against what actually exists (see `_reconcile`). Surviving
+        instances are registered again with their resources allocated. Records of instances
+        that are gone are dropped. With `reap_orphans`, instances the service started but never
+        recorded (it crashed in between) are removed where the runner can identify them.
+        """
+        if self.store is None:
+            return {}
+        records = self.store.load()
+        adopted = self._reconcile(records, reap_orphans) if records else {}
+        for run_id, instance_data in adopted.items():
+            # Clients could not reach the instance while the service was down
+            instance_data["last_active_at"] = time.time()
+            self.running_instances[run_id] = instance_data
+            self.warm_images.add(instance_data["container_image"])
+            self._allocate_resources(instance_data["resources"], instance_data.get("tenant", DEFAULT_TENANT))
+        dropped = sorted(set(records) - set(adopted))
+        for run_id in dropped:
+            self.store.delete(run_id)
+        self.recovery = {"recovered_at": time.time(), "adopted": len(adopted), "dropped": len(dropped)}
+        logger.info(f"Recovered {len(adopted)} instances from {self.store.path}, dropped {len(dropped)}: {dropped}")
+        return self.recovery
+
+    def extra_stats(self) -> Dict[str, Any]:
+        """Runner-specific sections of `/stats` (e.g. the nodes of a federation); none by default."""
+        return {}
+
+    def stats_version(self) -> Tuple[Any, ...]:
+        """Changes whenever what `/stats` reports about the runner does, time-derived fields
+        (e.g. how long the oldest start has been queued) aside. Cheap, unlike the stats."""
+        return (
+            self.running_instances.version,
+            self.admission_queue.version,
+            self._resources_version,
+            self.start_limits.version,
+        )
+
+    def detach(self) -> None:
+        """Called at a graceful shutdown of the service: leaves the instances recorded in the
+        store running, so that `recover` re-adopts them after the restart.
+
+        The default does nothing, for runners whose instances outlive the service anyway.
+        """
+
+    def _reconcile(self, records: Dict[str, Dict[str, Any]], reap_orphans: bool) -> Dict[str, Dict[str, Any]]:
+        """Returns the instance data of the recorded instances that still exist, by run ID.
+
+        The default re-adopts nothing.
+        """
+        return {}
+
+    def _get_instance(self, run_id: str) -> Dict[str, Any]:
+        """Returns the instance data for `run_id`, raising `KeyError` if it is unknown."""
+        if run_id not in self.running_instances:
+            raise KeyError(f"Run ID {run_id} not found.")
+        return self.running_instances[run_id]
+
+    def _record_command(self, instance_data: Dict[str, Any]) -> None:
+        """Updates per-instance command statistics after a command completed."""
+        instance_data["num_cmd"] = instance_data.get("num_cmd", 0) + 1
+        instance_data["updated_at"] = time.time()
+        self.running_instances.touch()
@@ -0,0 +1,462 @@
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, Union
+
+import httpx
+
+from client import AdmissionRejectedError, AsyncClient, Client, InstanceNotFoundError, RetryPolicy, ServiceError
+from environments.files import DEFAULT_READ_MAX_BYTES
+from environments.process import command_tag
+from runners.base import BaseRunner, InsufficientResourcesError, Reservation
+from runners.workers import StartLimits, WorkerPools
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 2.0
+"""Seconds a node's free resources and cached images are trusted before they are fetched again."""
+
+NODE_RETRY = RetryPolicy(retry_admission=False)
+"""A node without room is passed over for the next one instead of being retried."""
+DEFAULT_NODE_CONCURRENCY = 512
+"""Commands in flight to one node at once; its starts, heartbeats and closes have slots of their own."""
+
+
+class FederationNode:
+    """A downstream arservice endpoint and what the federation last learned about it."""
+
+    def __init__(
+        self,
+        url: str,
+        client: Optional[Client] = None,
+        aclient: Optional[AsyncClient] = None,
+        max_concurrency: int = DEFAULT_NODE_CONCURRENCY,
+    ):
+        """
+        - **client** / **aclient**: use these clients instead of creating them (e.g. in tests)
+        - **max_concurrency**: commands in flight to the node at once
+        """
+        self.url = url
+        self.client = client or Client(url, max_concurrency=max_concurrency, retry=NODE_RETRY)
+        self.aclient = aclient or AsyncClient(url, max_concurrency=max_concurrency, retry=NODE_RETRY)
+        self.max_resources: Dict[str, Any] = {}
+        self.available: Dict[str, Any] = {}
+        self.images: Set[str] = set()
+        self.healthy = False
+        self.refreshed_at = 0.0
+        """`time.monotonic()` of the last refresh; 0 forces the next placement to refresh."""
+        self.version = 0
+        """Changes whenever `stats` does."""
+
+    def update(self, max_resources: Optional[Dict[str, Any]], available: Dict[str, Any], images: List[str]) -> None:
+        if (max_resources or self.max_resources, available, set(images), True) != (
+            self.max_resources, self.available, self.images, self.healthy
+        ):
+            self.version += 1
+        if max_resources is not None:
+            self.max_resources = max_resources
+        self.available = available
+        self.images = set(images)
+        self.healthy = True
+        self.refreshed_at = time.monotonic()
+
+    def fail(self, error: Exception) -> None:
+        if self.healthy:
+            logger.warning(f"Federation node {self.url} is unreachable: {error}")
+            self.version += 1
+        self.healthy = False
+        self.refreshed_at = time.monotonic()
+
+    def fits(self, resources: Dict[str, Any]) -> bool:
+        return all(self.available.get(key, 0) >= value for key, value in resources.items() if key in self.available)
+
+    def load_after(self, resources: Dict[str, Any]) -> float:
+        """Largest fraction of any resource of the node in use once `resources` are placed on it."""
+        return max(
+            (
+                (limit - self.available.get(key, 0) + resources.get(key, 0)) / limit
+                for key, limit in self.max_resources.items()
+                if limit > 0
+            ),
+            default=0.0,
+        )
+
+    def take(self, resources: Dict[str, Any]) -> None:
+        """Books `resources` in the snapshot, so placements until the next refresh see them taken."""
+        for key, value in resources.items():
+            if key in self.available:
+                self.available[key] -= value
+        self.version += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "max_resources": self.max_resources,
+            "available_resources": self.available,
+            "images": sorted(self.images),
+        }
+
+
+class FederatedRunner(BaseRunner):
+    """Runner treating several downstream arservice endpoints as one pool of capacity.
+
+    Instances are placed on a node that already has the image cached whenever one has room,
+    and otherwise on the least loaded node; commands, heartbeats and closes are routed to
+    the node that owns the run ID.
+    """
+
+    def __init__(
+        self,
+        nodes: List[Union[str, FederationNode]],
+        max_resources: Optional[Dict[str, Any]] = None,
+        tenants: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_path: Optional[str] = None,
+        workers: Optional[WorkerPools] = None,
+        start_limits: Optional[StartLimits] = None,
+        refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+        node_concurrency: int = DEFAULT_NODE_CONCURRENCY,
+    ):
+        """
+        - **nodes**: URLs of the downstream services (or `FederationNode`s)
+        - **max_resources**: resources the federation admits in total (default: the sum of
+          what the reachable nodes offer, kept up to date as nodes come and go)
+        - **refresh_interval**: seconds between fetches of a node's free resources and images
+        - **node_concurrency**: commands in flight to each node given by URL at once
+        """
+        super().__init__(dict(max_resources or {}), tenants, state_path, workers, start_limits)
+        self.nodes = {
+            node.url: node
+            for node in (
+                node if isinstance(node, FederationNode) else FederationNode(node, max_concurrency=node_concurrency)
+                for node in nodes
+            )
+        }
+        self.pooled = max_resources is None
+        self.refresh_interval = refresh_interval
+        self._background: Set["asyncio.Task[None]"] = set()
+        self.refresh()
+
+    def _node_of(self, run_id: str) -> Tuple[Dict[str, Any], FederationNode]:
+        instance_data = self._get_instance(run_id)
+        return instance_data, self.nodes[instance_data["node"]]
+
+    def _stale(self, node: FederationNode) -> bool:
+        return time.monotonic() - node.refreshed_at >= self.refresh_interval
+
+    def refresh(self, stale_only: bool = False) -> None:
+        """Fetches the free resources and cached images of the nodes."""
+        for node in self.nodes.values():
+            if stale_only and not self._stale(node):
+                continue
+            try:
+                max_resources = None if node.max_resources else node.client.stats(limit=0).max_resources
+                node.update(max_resources, node.client.available_resources(), node.client.images())
+            except (httpx.HTTPError, ServiceError) as e:
+                node.fail(e)
+        self._update_capacity()
+
+    async def arefresh(self, stale_only: bool = False) -> None:
+        """Async variant of `refresh`, querying the nodes concurrently."""
+        async def refresh_node(node: FederationNode) -> None:
+            try:
+                max_resources = None if node.max_resources else (await node.aclient.stats(limit=0)).max_resources
+                available, images = await asyncio.gather(node.aclient.available_resources(), node.aclient.images())
+                node.update(max_resources, available, images)
+            except (httpx.HTTPError, ServiceError) as e:
+                node.fail(e)
+
+        await asyncio.gather(*(
+            refresh_node(node) for node in self.nodes.values() if not stale_only or self._stale(node)
+        ))
+        self._update_capacity()
+
+    def _update_capacity(self) -> None:
+        """Sets `max_resources` to what the reachable nodes offer, unless it was given explicitly."""
+        if not self.pooled:
+            return
+        with self._resource_lock:
+            totals: Dict[str, Any] = {}
+            for node in self.nodes.values():
+                if node.healthy:
+                    for key, value in node.max_resources.items():
+                        totals[key] = totals.get(key, 0) + value
+            for key in set(self.max_resources) | set(totals):
+                self.max_resources[key] = totals.get(key, 0)
+                self.allocated_resources.setdefault(key, 0)
+            # A node coming back may make room for queued requests
+            self._admit_waiting()
+
+    def place(self, request_params: Dict[str, Any], resources: Dict[str, Any]) -> List[FederationNode]:
+        """Nodes with room for `resources`, in order of preference: those with the requested image
+        cached first, so a cold pull only happens when no warm node has room, then the least
+        loaded."""
+        container_image = request_params["container_image"]
+        candidates = [node for node in self.nodes.values() if node.healthy and node.fits(resources)]
+        return sorted(candidates, key=lambda node: (container_image not in node.images, node.load_after(resources)))
+
+    @staticmethod
+    def _node_request(request_params: Dict[str, Any]) -> Tuple[str, str, str, Dict[str, Any]]:
+        """Arguments of `Client.start_instance` for a node; the federation did the queueing."""
+        config = {
+            key: value for key, value in request_params.items()
+            if key not in ("run_id", "container_image", "container_type") and value is not None
+        }
+        config["queue_timeout"] = 0
+        return request_params["run_id"], request_params["container_image"], request_params.get("container_type", ""), config
+
+    def start_instance(self, request_params: Dict[str, Any]) -> str:
+        """Starts an instance on the preferred node with room for it."""
+        run_id, container_image, container_type, config = self._node_request(request_params)
+        needed_resources = request_params.get("resources", {"instances": 1})
+        with self._reserve_resources(needed_resources, self.tenant_of(run_id), [run_id]) as reservation:
+            self.refresh(stale_only=True)
+            for node in self.place(request_params, needed_resources):
+                node.take(needed_resources)
+                try:
+                    node.client.start_instance(run_id, container_image, container_type, **config)
+                except AdmissionRejectedError:
+                    node.refreshed_at = 0.0
+                    continue
+                except httpx.TransportError as e:
+                    # The node may have started it before the connection failed
+                    with contextlib.suppress(Exception):
+                        node.client.close_instance(run_id)
+                    node.fail(e)
+                    continue
+                return self._add_instance(request_params, node, reservation)
+            raise InsufficientResourcesError(f"No node has room for {needed_resources}")
+
+    async def astart_instance(
+        self, request_params: Dict[str, Any], on_state: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Starts an instance on the preferred node with room for it, without blocking the event loop."""
+        run_id = request_params["run_id"]
+        reservation = await self._areserve_resources(
+            request_params.get("resources", {"instances": 1}),
+            request_params.get("queue_timeout", 0),
+            tenant=self.tenant_of(run_id),
+            priority=request_params.get("priority", "normal"),
+            run_ids=[run_id],
+        )
+        return await self._alaunch_instance(request_params, reservation, on_state)
+
+    async def _alaunch_instance(
+        self,
+        request_params: Dict[str, Any],
+        reservation: Reservation,
+        on_state: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Starts an instance on `reservation`, trying the nodes in `place` order until one admits it.
+
+        Nodes are asked not to queue: one that turned out to be full is passed over for the next.
+        """
+        run_id, container_image, container_type, config = self._node_request(request_params)
+        with reservation:
+            await self.arefresh(stale_only=True)
+            if on_state is not None:
+                on_state("starting")
+            for node in self.place(request_params, reservation.resources):
+                node.take(reservation.resources)
+                try:
+                    await node.aclient.start_instance(run_id, container_image, container_type, **config)
+                except AdmissionRejectedError:
+                    # Its snapshot was out of date
+                    node.refreshed_at = 0.0
+                    continue
+                except (httpx.TransportError, asyncio.CancelledError) as e:
+                    # The node may have started it before the connection failed
+                    with contextlib.suppress(Exception):
+                        await asyncio.shield(node.aclient.close_instance(run_id))
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    node.fail(e)
+                    continue
+                return self._add_instance(request_params, node, reservation)
+            raise InsufficientResourcesError(f"No node has room for {reservation.resources}")
+
+    def _add_instance(self, request_params: Dict[str, Any], node: FederationNode, reservation: Reservation) -> str:
+        """Registers an instance started on `node` and commits the reservation of its resources."""
+        run_id = request_params["run_id"]
+        node.images.add(request_params["container_image"])
+        self._register_instance(run_id, {
+            "node": node.url,
+            "container_image": request_params["container_image"],
+            "container_type": request_params.get("container_type", ""),
+            "config": request_params,
+            "resources": reservation.resources,
+            "tenant": reservation.tenant,
+            "idle_timeout": request_params.get("idle_timeout"),
+            "created_at": time.time(),
+            "updated_at": None,
+            "num_cmd": 0
+        })
+        reservation.commit()
+        logger.info(f"Started instance {run_id} on node {node.url}")
+        return run_id
+
+    def _reconcile(self, records: Dict[str, Dict[str, Any]], reap_orphans: bool) -> Dict[str, Dict[str, Any]]:
+        """Re-adopts the recorded instances that their node still runs.
+
+        Orphans are left to the nodes, which reap their own on restart.
+        """
+        adopted = {}
+        for run_id, record in records.items():
+            node = self.nodes.get(record.get("node", ""))
+            if node is None:
+                continue
+            try:
+                # The run ID sorts first among the IDs it prefixes; `run_id=` would match substrings
+                instances = node.client.stats(prefix=run_id, limit=1, fields="run_id").instances
+                if any(instance["run_id"] == run_id for instance in instances):
+                    adopted[run_id] = record
+            except (httpx.HTTPError, ServiceError) as e:
+                logger.error(f"Failed to look up instance {run_id} on node {node.url}: {e}")
+        return adopted
+
+    @staticmethod
+    def _command_result(result: Any) -> Dict[str, Any]:
+        # `cancelled` is set by the API of this service, which also did the cancelling
+        return result.model_dump(exclude_none=True, exclude={"cancelled"})
+
+    def _gone(self, run_id: str, node: FederationNode) -> KeyError:
+        """Drops an instance its node no longer knows (closed there, or reaped as idle)."""
+        self._remove_instance(run_id)
+        return KeyError(f"Run ID {run_id} no longer exists on node {node.url}.")
+
+    def execute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Executes a command on the node running the instance."""
+        instance_data, node = self._node_of(run_id)
+        try:
+            result = node.client.execute_command(run_id, cmd, timeout=timeout, command_id=command_tag(cmd))
+        except InstanceNotFoundError:
+            raise self._gone(run_id, node)
+        self._record_command(instance_data)
+        return self._command_result(result)
+
+    async def aexecute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Executes a command on the node running the instance, without blocking the event loop.
+
+        The command's tag doubles as its command ID on the node, so `akill_command` can cancel it there.
+        """
+        instance_data, node = self._node_of(run_id)
+        try:
+            result = await node.aclient.execute_command(run_id, cmd, timeout=timeout, command_id=command_tag(cmd))
+        except InstanceNotFoundError:
+            raise self._gone(run_id, node)
+        self._record_command(instance_data)
+        return self._command_result(result)
+
+    async def astream_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Streams a command from the node running the instance, chunk by chunk as the node sends them."""
+        instance_data, node = self._node_of(run_id)
+        try:
+            async for event in node.aclient.stream_command(run_id, cmd, timeout=timeout, command_id=command_tag(cmd)):
+                if "output" in event:
+                    yield {"output": event["output"]}
+                else:
+                    # As `_command_result`: `cancelled` is set by the API of this service
+                    yield {"returncode": event["returncode"]}
+        except InstanceNotFoundError:
+            raise self._gone(run_id, node)
+        self._record_command(instance_data)
+
+    def _transfer_failure(self, run_id: str, node: FederationNode, e: ServiceError) -> Exception:
+        """The error of a failed file transfer on a node, as the API maps it back to a status."""
+        if isinstance(e, InstanceNotFoundError):
+            return self._gone(run_id, node)
+        if e.status_code == 403:
+            return PermissionError(e.detail)
+        if e.status_code == 404:
+            return FileNotFoundError(e.detail)
+        if e.status_code == 501:
+            return NotImplementedError(e.detail)
+        return e
+
+    async def aupload(self, run_id: str, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Streams a tar archive to the node running the instance."""
+        _, node = self._node_of(run_id)
+        try:
+            await node.aclient.upload(run_id, path, archive)
+        except ServiceError as e:
+            raise self._transfer_failure(run_id, node, e)
+
+    async def adownload(self, run_id: str, path: str) -> AsyncIterator[bytes]:
+        """Relays a tar archive of `path` from the node running the instance."""
+        _, node = self._node_of(run_id)
+        try:
+            async for chunk in node.aclient.download(run_id, path):
+                yield chunk
+        except ServiceError as e:
+            raise self._transfer_failure(run_id, node, e)
+
+    async def aread_files(
+        self, run_id: str, paths: List[str], max_bytes: int = DEFAULT_READ_MAX_BYTES
+    ) -> Dict[str, Dict[str, Any]]:
+        """Reads many files on the node running the instance."""
+        _, node = self._node_of(run_id)
+        try:
+            return await node.aclient.read_files(run_id, paths, max_bytes)
+        except ServiceError as e:
+            raise self._transfer_failure(run_id, node, e)
+
+    async def akill_command(self, run_id: str, tag: str) -> None:
+        """Cancels a tagged command on the node running the instance."""
+        _, node = self._node_of(run_id)
+        try:
+            await node.aclient.cancel_command(tag)
+        except ServiceError as e:
+            # Already finished
+            if e.status_code != 404:
+                raise
+
+    def touch_instance(self, run_id: str) -> Dict[str, Any]:
+        """Renews the idle lease of an instance here and, in the background, on its node."""
+        instance_data = super().touch_instance(run_id)
+        node = self.nodes[instance_data["node"]]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            with contextlib.suppress(Exception):
+                node.client.heartbeat(run_id)
+            return instance_data
+        task = loop.create_task(self._aforward_heartbeat(node, run_id))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return instance_data
+
+    async def _aforward_heartbeat(self, node: FederationNode, run_id: str) -> None:
+        try:
+            await node.aclient.heartbeat(run_id)
+        except Exception as e:
+            logger.warning(f"Failed to forward heartbeat of {run_id} to node {node.url}: {e}")
+
+    def close_instance(self, run_id: str) -> None:
+        """Closes the instance on its node."""
+        _, node = self._node_of(run_id)
+        with contextlib.suppress(InstanceNotFoundError):
+            node.client.close_instance(run_id)
+        node.refreshed_at = 0.0
+        self._remove_instance(run_id)
+
+    async def aclose_instance(self, run_id: str) -> None:
+        """Closes the instance on its node without blocking the event loop."""
+        _, node = self._node_of(run_id)
+        with contextlib.suppress(InstanceNotFoundError):
+            await node.aclient.close_instance(run_id)
+        node.refreshed_at = 0.0
+        self._remove_instance(run_id)
+
+    def node_stats(self) -> List[Dict[str, Any]]:
+        """What the federation last learned about each node, with the number of instances placed on it."""
+        placed: Dict[str, int] = {}
+        for instance_data in self.running_instances.values():
+            placed[instance_data["node"]] = placed.get(instance_data["node"], 0) + 1
+        return [dict(node.stats(), instances=placed.get(url, 0)) for url, node in self.nodes.items()]
+
+    def extra_stats(self) -> Dict[str, Any]:
+        return {"nodes": self.node_stats()}
+
+    def stats_version(self) -> Tuple[Any, ...]:
+        return super().stats_version() + tuple(node.version for node in self.nodes.values())
@@ -1,80 +1,193 @@
 import logging
 import time
-from typing import Any, Dict
-from runners.base import BaseRunner
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from runners.base import BaseRunner, Reservation
+from runners.workers import StartLimits, WorkerPools
+from environments.base import Environment
+from environments.files import DEFAULT_READ_MAX_BYTES
 
 try:
-    from environments import get_environment
+    from environments import get_environment, get_environment_class, reattach_environment
 except ImportError:
     # For testing/when not running from root
     import sys
     import os
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from environments import get_environment
+    from environments import get_environment, get_environment_class, reattach_environment
 
 logger = logging.getLogger(__name__)
 
 class LocalRunner(BaseRunner):
     """Runner for local execution."""
 
-    def __init__(self, max_resources: Dict[str, Any]):
-        super().__init__(max_resources)
+    def __init__(
+        self,
+        max_resources: Dict[str, Any],
+        tenants: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_path: Optional[str] = None,
+        workers: Optional[WorkerPools] = None,
+        start_limits: Optional[StartLimits] = None,
+    ):
+        super().__init__(max_resources, tenants, state_path, workers, start_limits)
 
     def start_instance(self, request_params: Dict[str, Any]) -> str:
         """Starts a local environment instance."""
-        # Extract parameters
         run_id = request_params["run_id"]
-        container_image = request_params["container_image"]
         needed_resources = request_params.get("resources", {"instances": 1})
-        
-        # Check resources
-        if not self._check_resources(needed_resources):
-            raise RuntimeError(f"Not enough resources. Available: {self.get_available_resources()}")
-
-        try:
-            # Create environment with all request parameters
-            env = get_environment(request_params)
-            # Some environments might start automatically in __init__, others might need explicit start if added
-            # But based on docker.py, _start_container is called in __init__.
-            self.running_instances[run_id] = {
-                "container_image": container_image,
-                "env": env,
-                "resources": needed_resources,
-                "created_at": time.time(),
-                "updated_at": None,
-                "num_cmd": 0
-            }
-            self._allocate_resources(needed_resources)
-            return run_id
-        except Exception as e:
-            logger.error(f"Failed to start instance for container {container_image}, run {run_id}: {e}")
-            raise
-
-    def execute_command(self, run_id: str, cmd: str) -> Dict[str, Any]:
+        with self._reserve_resources(needed_resources, self.tenant_of(run_id), [run_id]) as reservation:
+            try:
+                # Create environment with all request parameters
+                # Some environments might start automatically in __init__, others might need explicit start if added
+                # But based on docker.py, _start_container is called in __init__.
+                env = get_environment(request_params)
+            except Exception as e:
+                logger.error(f"Failed to start instance for container {request_params['container_image']}, run {run_id}: {e}")
+                raise
+            return self._add_instance(request_params, env, reservation)
+
+    async def astart_instance(
+        self, request_params: Dict[str, Any], on_state: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Starts a local environment instance without blocking the event loop."""
+        run_id = request_params["run_id"]
+        reservation = await self._areserve_resources(
+            request_params.get("resources", {"instances": 1}),
+            request_params.get("queue_timeout", 0),
+            tenant=self.tenant_of(run_id),
+            priority=request_params.get("priority", "normal"),
+            run_ids=[run_id],
+        )
+        return await self._alaunch_instance(request_params, reservation, on_state)
+
+    async def _alaunch_instance(
+        self,
+        request_params: Dict[str, Any],
+        reservation: Reservation,
+        on_state: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Starts the environment of an instance on `reservation`.
+
+        Environments start their container in `__init__`, so construction runs in a start
+        worker thread while the instance bookkeeping stays on the event loop. Concurrent
+        constructions are limited per container type (see `StartLimits`).
+        """
+        kwargs = {} if on_state is None else {"state_callback": on_state}
+        with reservation:
+            try:
+                async with self.start_limits.slot(request_params.get("container_type", "")):
+                    env = await self.workers.run(self.workers.start, get_environment, request_params, **kwargs)
+            except BaseException as e:
+                logger.error(f"Failed to start instance for container {request_params['container_image']}, run {request_params['run_id']}: {e}")
+                raise
+            return self._add_instance(request_params, env, reservation)
+
+    def _add_instance(self, request_params: Dict[str, Any], env: Any, reservation: Reservation) -> str:
+        """Registers a started environment and commits the reservation of its resources."""
+        run_id = request_params["run_id"]
+        self._register_instance(run_id, {
+            "container_image": request_params["container_image"],
+            "container_type": request_params.get("container_type", ""),
+            "env": env,
+            "config": request_params,
+            "resources": reservation.resources,
+            "tenant": reservation.tenant,
+            "idle_timeout": request_params.get("idle_timeout"),
+            "created_at": time.time(),
+            "updated_at": None,
+            "num_cmd": 0
+        })
+        reservation.commit()
+        return run_id
+
+    def detach(self) -> None:
+        """Keeps the environments of persisted instances from cleaning up their containers when
+        they are garbage-collected at exit."""
+        if self.store is None:
+            return
+        for instance_data in self.running_instances.values():
+            instance_data["env"].detach()
+
+    def _reconcile(self, records: Dict[str, Dict[str, Any]], reap_orphans: bool) -> Dict[str, Dict[str, Any]]:
+        """Asks each environment type which of its recorded instances still exist, and re-attaches to them."""
+        by_type: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for run_id, record in records.items():
+            if "config" in record:
+                by_type.setdefault(record.get("container_type", ""), {})[run_id] = record
+        adopted = {}
+        for container_type, group in by_type.items():
+            try:
+                env_class = get_environment_class(container_type)
+                alive = env_class.reconcile({run_id: record["config"] for run_id, record in group.items()}, reap_orphans)
+            except Exception as e:
+                logger.error(f"Failed to reconcile {container_type} instances {sorted(group)}: {e}")
+                continue
+            for run_id in sorted(alive & group.keys()):
+                try:
+                    env = reattach_environment(group[run_id]["config"])
+                except Exception as e:
+                    logger.error(f"Failed to re-attach to instance {run_id}: {e}")
+                    continue
+                adopted[run_id] = group[run_id] | {"env": env}
+        return adopted
+
+    def execute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
         """Executes a command in the local instance."""
-        if run_id not in self.running_instances:
-            raise KeyError(f"Run ID {run_id} not found.")
-        
-        env = self.running_instances[run_id]["env"]
+        instance_data = self._get_instance(run_id)
         # Assuming env has an execute method as seen in docker.py
-        result = env.execute(cmd)
-        self.running_instances[run_id]["num_cmd"] += 1
-        self.running_instances[run_id]["updated_at"] = time.time()
+        result = instance_data["env"].execute(cmd, timeout=timeout)
+        self._record_command(instance_data)
         return result
 
+    async def aexecute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Executes a command in the local instance without blocking the event loop."""
+        instance_data = self._get_instance(run_id)
+        env = instance_data["env"]
+        if type(env).aexecute is Environment.aexecute:
+            # Blocking environment: run it on the execute pool rather than the default executor
+            result = await self.workers.run(self.workers.execute, env.execute, cmd, timeout=timeout)
+        else:
+            result = await env.aexecute(cmd, timeout=timeout)
+        self._record_command(instance_data)
+        return result
+
+    async def astream_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Executes a command in the local instance, yielding output as it is produced."""
+        instance_data = self._get_instance(run_id)
+        async for event in instance_data["env"].astream(cmd, timeout=timeout):
+            yield event
+        self._record_command(instance_data)
+
+    async def akill_command(self, run_id: str, tag: str) -> None:
+        """Kills the processes of a tagged command in the local instance."""
+        await self._get_instance(run_id)["env"].akill(tag)
+
+    async def aupload(self, run_id: str, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Extracts a streamed tar archive into the directory `path` of the local instance."""
+        await self._get_instance(run_id)["env"].aupload(path, archive)
+
+    async def adownload(self, run_id: str, path: str) -> AsyncIterator[bytes]:
+        """Yields a tar archive of `path` in the local instance."""
+        async for chunk in self._get_instance(run_id)["env"].adownload(path):
+            yield chunk
+
+    async def aread_files(
+        self, run_id: str, paths: List[str], max_bytes: int = DEFAULT_READ_MAX_BYTES
+    ) -> Dict[str, Dict[str, Any]]:
+        """Reads many files of the local instance at once."""
+        return await self._get_instance(run_id)["env"].aread_files(paths, max_bytes)
+
     def close_instance(self, run_id: str) -> None:
         """Closes the local instance."""
-        if run_id not in self.running_instances:
-            raise KeyError(f"Run ID {run_id} not found.")
+        self._close_env(self._get_instance(run_id)["env"])
+        self._remove_instance(run_id)
 
-        instance_data = self.running_instances[run_id]
-        env = instance_data["env"]
-        resources = instance_data["resources"]
-        
+    async def aclose_instance(self, run_id: str) -> None:
+        """Closes the local instance without blocking the event loop."""
+        await self.workers.run(self.workers.close, self._close_env, self._get_instance(run_id)["env"])
+        self._remove_instance(run_id)
+
+    def _close_env(self, env: Any) -> None:
         if hasattr(env, "cleanup"):
             env.cleanup()
         elif hasattr(env, "close"):
             env.close()
-            
-        self._release_resources(resources)
-        del self.running_instances[run_id]
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from runners.base import BaseRunner
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REAP_INTERVAL_S = 30.0
+"""Longest pause between two reaper passes."""
+
+
+class IdleReaper:
+    """Closes instances that have been idle for longer than their TTL.
+
+    An instance is idle while no command or file transfer is running in it; commands and
+    client heartbeats (`BaseRunner.touch_instance`) renew its lease. Its TTL is the
+    `idle_timeout` it was started with, or `default_ttl`; a TTL of 0 never expires.
+    """
+
+    def __init__(
+        self,
+        runner: BaseRunner,
+        close: Callable[[str], Awaitable[None]],
+        default_ttl: Optional[float] = None,
+        interval: Optional[float] = None,
+    ):
+        """
+        - **close**: closes an instance through the runner (e.g. recording metrics)
+        - **interval**: seconds between passes (default: a quarter of `default_ttl`, at most 30s)
+        """
+        self.runner = runner
+        self.close = close
+        self.default_ttl = default_ttl
+        if interval is None:
+            interval = min(default_ttl / 4, DEFAULT_REAP_INTERVAL_S) if default_ttl else DEFAULT_REAP_INTERVAL_S
+        self.interval = interval
+        self.reaped = 0
+        self.failed = 0
+        self.last_run_at: Optional[float] = None
+
+    def ttl_of(self, instance_data: Dict[str, Any]) -> Optional[float]:
+        ttl = instance_data.get("idle_timeout")
+        if ttl is None:
+            ttl = self.default_ttl
+        return ttl or None
+
+    def expires_at(self, instance_data: Dict[str, Any]) -> Optional[float]:
+        """When the instance expires if it stays idle, or None if it never does."""
+        ttl = self.ttl_of(instance_data)
+        if ttl is None:
+            return None
+        return instance_data.get("last_active_at", instance_data.get("created_at", 0)) + ttl
+
+    def expired(self, now: Optional[float] = None) -> List[str]:
+        """Run IDs of idle instances whose lease has run out."""
+        now = time.time() if now is None else now
+        return [
+            run_id
+            for run_id, instance_data in list(self.runner.running_instances.items())
+            if not self.runner.is_busy(run_id)
+            and (expires_at := self.expires_at(instance_data)) is not None
+            and expires_at <= now
+        ]
+
+    async def reap_once(self) -> List[str]:
+        """Closes all expired instances, returning their run IDs."""
+        self.last_run_at = time.time()
+        reaped = []
+        for run_id in self.expired(self.last_run_at):
+            logger.info(f"Reaping idle instance {run_id}")
+            try:
+                await self.close(run_id)
+            except KeyError:
+                # Closed by its client in the meantime
+                continue
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to reap idle instance {run_id}: {e}")
+                continue
+            self.reaped += 1
+            reaped.append(run_id)
+        return reaped
+
+    async def run(self) -> None:
+        """Reaps expired instances every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap_once()
+            except Exception as e:
+                logger.error(f"Idle reaper pass failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default_idle_ttl_s": self.default_ttl,
+            "interval_s": self.interval,
+            "reaped": self.reaped,
+            "failed": self.failed,
+            "last_run_at": self.last_run_at,
+        }
@@ -0,0 +1,85 @@
+import bisect
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+
+class InstanceRegistry(MutableMapping):
+    """Mapping of run ID -> instance data with incrementally maintained indexes.
+
+    Behaves like the plain dict runners used to keep in `running_instances`, but every
+    insertion and removal also updates:
+    - a sorted run ID index, used for prefix lookups and cursor pagination,
+    - per-image run ID sets and counts,
+    - a version counter that changes whenever the registry content changes.
+    """
+
+    def __init__(self):
+        self._instances: Dict[str, Dict[str, Any]] = {}
+        self._sorted_ids: List[str] = []
+        self._by_image: Dict[str, Set[str]] = {}
+        self.version = 0
+
+    def __getitem__(self, run_id: str) -> Dict[str, Any]:
+        return self._instances[run_id]
+
+    def __setitem__(self, run_id: str, instance_data: Dict[str, Any]) -> None:
+        if run_id in self._instances:
+            self._unindex(run_id)
+        self._instances[run_id] = instance_data
+        bisect.insort(self._sorted_ids, run_id)
+        self._by_image.setdefault(self._image(instance_data), set()).add(run_id)
+        self.version += 1
+
+    def __delitem__(self, run_id: str) -> None:
+        self._unindex(run_id)
+        del self._instances[run_id]
+        self.version += 1
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._instances)
+
+    def __len__(self) -> int:
+        return len(self._instances)
+
+    def __contains__(self, run_id: object) -> bool:
+        return run_id in self._instances
+
+    def touch(self) -> None:
+        """Marks the registry as changed after an in-place update of instance data."""
+        self.version += 1
+
+    def _unindex(self, run_id: str) -> None:
+        del self._sorted_ids[bisect.bisect_left(self._sorted_ids, run_id)]
+        image = self._image(self._instances[run_id])
+        run_ids = self._by_image[image]
+        run_ids.discard(run_id)
+        if not run_ids:
+            del self._by_image[image]
+
+    @staticmethod
+    def _image(instance_data: Dict[str, Any]) -> str:
+        return instance_data.get("container_image", "unknown")
+
+    def container_counts(self) -> Dict[str, int]:
+        """Number of instances per container image."""
+        return {image: len(run_ids) for image, run_ids in self._by_image.items()}
+
+    def run_ids(self, prefix: str = "", after: Optional[str] = None, container_image: Optional[str] = None) -> Iterator[str]:
+        """Yields run IDs in sorted order.
+
+        - **prefix**: only run IDs starting with this prefix
+        - **after**: only run IDs sorting strictly after this one (pagination cursor)
+        - **container_image**: only instances of this exact image
+        """
+        if container_image is None:
+            candidates = self._sorted_ids
+        else:
+            candidates = sorted(self._by_image.get(container_image, ()))
+        if after is not None and after >= prefix:
+            index = bisect.bisect_right(candidates, after)
+        else:
+            index = bisect.bisect_left(candidates, prefix)
+        for i in range(index, len(candidates)):
+            if not candidates[i].startswith(prefix):
+                break
+            yield candidates[i]
@@ -0,0 +1,176 @@
+import atexit
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from client import AsyncClient, Client, RetryPolicy
+from runners.federated import DEFAULT_NODE_CONCURRENCY, NODE_RETRY, FederatedRunner, FederationNode
+from runners.workers import StartLimits, WorkerPools
+
+logger = logging.getLogger(__name__)
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cli.py")
+SHARD_START_TIMEOUT = 60.0
+"""Seconds to wait for a shard process to serve requests."""
+
+
+def shard_state_path(state_path: str, index: int) -> str:
+    """The database of shard `index` next to the front process's `state_path`."""
+    root, ext = os.path.splitext(state_path)
+    return f"{root}.shard{index}{ext}"
+
+
+class ShardedRunner(FederatedRunner):
+    """`LocalRunner` spread over `shards` worker processes, so busy hosts use more than one core.
+
+    Each shard is an arservice process serving a `LocalRunner` on a Unix domain socket; an
+    instance lives on the shard its run ID hashes to. This process keeps the admission queue,
+    tenants and resource accounting for the whole host and only routes requests, while
+    spawning commands, limiting and encoding their output happens in the shards: command
+    responses are relayed to the client byte for byte (see `aforward_command`).
+    """
+
+    forwards_commands = True
+
+    def __init__(
+        self,
+        max_resources: Dict[str, Any],
+        shards: int,
+        tenants: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_path: Optional[str] = None,
+        workers: Optional[WorkerPools] = None,
+        start_limits: Optional[StartLimits] = None,
+        max_output_bytes: int = 0,
+        output_dir: Optional[str] = None,
+        compress_min_bytes: int = 0,
+        keep_instances: bool = False,
+        node_concurrency: int = DEFAULT_NODE_CONCURRENCY,
+    ):
+        """
+        - **shards**: number of worker processes
+        - **workers** / **start_limits**: also configure the pools and start limits of each shard
+        - **max_output_bytes** / **compress_min_bytes**: output limit and response compression
+          of the shards (0: none), which encode the command responses
+        - **output_dir**: where the shards spill truncated outputs; share it with this process's
+          `OutputStore` so it serves them at `/output`
+        - **keep_instances**: shards leave their instances running when they stop (see `shutdown`)
+        - **node_concurrency**: commands in flight to each shard at once
+
+        Shards admit up to `max_resources` each; the limits hold because this process admits
+        every start first. Shards persist their instances next to `state_path`.
+        """
+        workers = workers or WorkerPools()
+        start_limits = start_limits or StartLimits()
+        self.runtime_dir = tempfile.mkdtemp(prefix="arservice-shards-")
+        self.processes: List[subprocess.Popen] = []
+        atexit.register(self.shutdown)
+        nodes = []
+        for index in range(shards):
+            uds = os.path.join(self.runtime_dir, f"shard{index}.sock")
+            shard_state = shard_state_path(state_path, index) if state_path else None
+            self.processes.append(self._spawn(
+                uds, max_resources, shard_state, workers, start_limits, max_output_bytes, output_dir, compress_min_bytes,
+                keep_instances,
+            ))
+            # The URL names the shard, so recorded instances map to the same shard after a restart
+            url = f"http://shard{index}"
+            clients = dict(uds=uds, max_concurrency=node_concurrency, retry=NODE_RETRY)
+            nodes.append(FederationNode(url, Client(url, **clients), AsyncClient(url, **clients)))
+        for index, process in enumerate(self.processes):
+            self._wait_until_up(nodes[index].url, os.path.join(self.runtime_dir, f"shard{index}.sock"), process)
+        logger.info(f"Started {shards} shard processes serving on {self.runtime_dir}")
+        self.shards = nodes
+        super().__init__(nodes, max_resources, tenants, state_path, workers, start_limits)
+
+    def _spawn(
+        self,
+        uds: str,
+        max_resources: Dict[str, Any],
+        state_path: Optional[str],
+        workers: WorkerPools,
+        start_limits: StartLimits,
+        max_output_bytes: int,
+        output_dir: Optional[str],
+        compress_min_bytes: int,
+        keep_instances: bool,
+    ) -> subprocess.Popen:
+        cmd = [
+            sys.executable, CLI_PATH,
+            "--runner", "local",
+            "--no-tcp", "--uds", uds,
+            "--resources", json.dumps(max_resources),
+            "--state-db", state_path or "",
+            "--max-output-bytes", str(max_output_bytes),
+            "--compress-min-bytes", str(compress_min_bytes),
+            # Idle reaping is applied by the front process
+            "--idle-ttl", "0",
+            "--start-workers", str(workers.sizes["start"]),
+            "--execute-workers", str(workers.sizes["execute"]),
+            "--close-workers", str(workers.sizes["close"]),
+            "--max-concurrent-starts", str(start_limits.maximum),
+        ]
+        if output_dir:
+            cmd += ["--output-dir", output_dir]
+        if keep_instances:
+            cmd.append("--keep-instances-on-exit")
+        return subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+
+    @staticmethod
+    def _wait_until_up(url: str, uds: str, process: subprocess.Popen) -> None:
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        with Client(url, uds=uds, retry=RetryPolicy(attempts=1)) as probe:
+            while True:
+                try:
+                    probe.available_resources()
+                    return
+                except httpx.TransportError:
+                    if process.poll() is not None:
+                        raise RuntimeError(f"Shard {url} exited with code {process.returncode}")
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"Shard {url} did not come up within {SHARD_START_TIMEOUT}s")
+                    time.sleep(0.05)
+
+    def shard_of(self, run_id: str) -> FederationNode:
+        """The shard `run_id` hashes to (stable across restarts, unlike `hash`)."""
+        digest = hashlib.blake2b(run_id.encode(), digest_size=8).digest()
+        return self.shards[int.from_bytes(digest, "big") % len(self.shards)]
+
+    def place(self, request_params: Dict[str, Any], resources: Dict[str, Any]) -> List[FederationNode]:
+        node = self.shard_of(request_params["run_id"])
+        return [node] if node.healthy else []
+
+    @contextlib.asynccontextmanager
+    async def aforward_command(
+        self, run_id: str, path: str, payload: Dict[str, Any], headers: Dict[str, str]
+    ) -> AsyncIterator[httpx.Response]:
+        """Sends a command request to the instance's shard; its response is relayed unread."""
+        instance_data, node = self._node_of(run_id)
+        async with node.aclient.forward("POST", path, json=payload, headers=headers) as response:
+            if response.status_code == 404:
+                raise self._gone(run_id, node)
+            self._record_command(instance_data)
+            yield response
+
+    def shutdown(self) -> None:
+        """Stops the shard processes, which close their instances. With `keep_instances`, the
+        instances keep running instead, to be re-adopted by the next start with the same
+        `state_path` and number of shards."""
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(self.runtime_dir, ignore_errors=True)
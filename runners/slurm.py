@@ -1,98 +1,691 @@
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import getpass
+import posixpath
+import shlex
 import subprocess
 import logging
-from runners.base import BaseRunner
+import os
+import time
+import uuid
+from runners.admission import DEFAULT_TENANT
+from runners.base import BaseRunner, Reservation
+from runners.workers import StartLimits, WorkerPools
+from environments.files import DEFAULT_READ_MAX_BYTES, read_archived_files
+from environments.process import (
+    collect_output,
+    kill_tagged_script,
+    pipe_process,
+    stream_process,
+    tag_command,
+)
+from runners.slurm_agent import (
+    AgentAddress,
+    AgentUnavailableError,
+    agent_path,
+    agent_script,
+    read_address,
+    run_command,
+    stream_command,
+)
 
 logger = logging.getLogger(__name__)
 
+# Script to run (sleep forever so we can connect)
+SLEEPER_SCRIPT = "#!/bin/bash\nsleep infinity"
+
+JOB_NAME_PREFIX = "arservice-"
+"""Prefix of the Slurm job names of sleeper jobs, used to find orphans after a restart."""
+
+DEFAULT_AGENT_DIR = os.path.expanduser("~/.arservice/agents")
+"""Where exec agents publish their address by default; must be shared with the compute nodes."""
+
+SLOT_TAG_VAR = "ARSERVICE_SLOT"
+"""Environment variable marking the processes of a packed instance (see `tag_command`)."""
+
+ALLOCATIONS = "allocations"
+"""Resource key counting the sleeper jobs of packed instances; cap it in `max_resources` to
+stay within per-user job limits."""
+
+
+class SlurmAllocation:
+    """A sleeper job hosting up to `slots` packed instances."""
+
+    def __init__(self, job_id: str, slots: int, key: Tuple[str, ...], tenant: str = DEFAULT_TENANT):
+        self.job_id = job_id
+        self.slots = slots
+        self.key = key
+        """The `sbatch_args` of the instances it hosts."""
+        self.tenant = tenant
+        """Holds the `allocations` resource (the tenant of the start that submitted it)."""
+        self.occupants: Dict[str, str] = {}
+        """Slot tag by run ID of the instances in the allocation."""
+        self.releasing = False
+
+    @property
+    def free(self) -> int:
+        return 0 if self.releasing else self.slots - len(self.occupants)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"job_id": self.job_id, "slots": self.slots, "occupied": len(self.occupants), "sbatch_args": list(self.key)}
+
+
 class SlurmRunner(BaseRunner):
-    """Runner for Slurm execution."""
+    """Runner for Slurm execution.
 
-    def __init__(self, max_resources: Dict[str, Any]):
-        super().__init__(max_resources)
+    By default each instance is a sleeper job of its own. With `slots_per_allocation` > 1,
+    instances are packed into shared sleeper jobs instead: a start takes a free slot of a
+    running allocation without involving the scheduler, and an allocation is cancelled as
+    soon as its last instance closes.
+
+    With `agent_dir`, sleeper jobs run an exec agent (see `runners.slurm_agent`) and commands
+    are sent to it over TCP instead of each starting an `srun` step. Until a job's agent is up,
+    or if it cannot be reached, commands still run as `srun` steps.
+    """
+
+    def __init__(
+        self,
+        max_resources: Dict[str, Any],
+        tenants: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_path: Optional[str] = None,
+        workers: Optional[WorkerPools] = None,
+        start_limits: Optional[StartLimits] = None,
+        slots_per_allocation: int = 1,
+        allocation_args: Optional[List[str]] = None,
+        agent_dir: Optional[str] = None,
+    ):
+        """
+        - **slots_per_allocation**: instances packed into one sleeper job (1: a job per instance)
+        - **allocation_args**: `sbatch` arguments of packed allocations, sized for all their
+          slots (e.g. `["--nodes=1", "--exclusive"]`); an instance's `sbatch_args` are added,
+          and only instances with equal `sbatch_args` share an allocation
+        - **agent_dir**: directory on a filesystem shared with the compute nodes where the exec
+          agents of sleeper jobs publish their address (None: run every command with `srun`)
+        """
+        super().__init__(max_resources, tenants, state_path, workers, start_limits)
+        self.slots_per_allocation = slots_per_allocation
+        self.allocation_args = list(allocation_args or [])
+        self.allocations: Dict[str, SlurmAllocation] = {}
+        """Packed allocations by job ID."""
+        self._pending_allocations: Dict[Tuple[str, ...], "asyncio.Future[Optional[SlurmAllocation]]"] = {}
+        self._slot_waiters: Dict[Tuple[str, ...], List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]]] = {}
+        """Starts waiting for a free slot, by allocation key."""
+        self._queued_allocations: Set[Tuple[str, ...]] = set()
+        """Keys of pending allocations still waiting in the admission queue."""
+        self.agent_dir = agent_dir
+        if agent_dir is not None:
+            os.makedirs(agent_dir, mode=0o700, exist_ok=True)
+        self._agents: Dict[str, AgentAddress] = {}
+        """Exec agent addresses by job ID, read from `agent_dir` on first use."""
+
+    @property
+    def packed(self) -> bool:
+        return self.slots_per_allocation > 1
 
     def start_instance(self, request_params: Dict[str, Any]) -> str:
         """Starts a Slurm job instance."""
-        # Extract parameters
         run_id = request_params["run_id"]
-        container_image = request_params["container_image"]
         needed_resources = request_params.get("resources", {"instances": 1})
-        
-        # Check resources
-        if not self._check_resources(needed_resources):
-            raise RuntimeError(f"Not enough resources. Available: {self.get_available_resources()}")
+        with self._reserve_resources(needed_resources, self.tenant_of(run_id), [run_id]) as reservation:
+            if self.packed:
+                key = tuple(request_params.get("sbatch_args", []))
+                allocation = self._claim_slot(key, run_id)
+                if allocation is None:
+                    allocation = self._submit_allocation(key, reservation.tenant)
+                    allocation = self._claim_slot(key, run_id, allocation)
+                return self._add_instance(request_params, allocation.job_id, reservation, allocation.occupants[run_id])
+            cmd = self._sbatch_cmd(request_params)
+            try:
+                result = subprocess.run(
+                    cmd,
+                    input=self._sleeper_script(),
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to submit Slurm job for container {request_params['container_image']}, run {run_id}: {e.stderr}")
+                raise
+            return self._add_instance(request_params, self._parse_job_id(result.stdout), reservation)
+
+    async def astart_instance(
+        self, request_params: Dict[str, Any], on_state: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Starts a Slurm job instance without blocking the event loop."""
+        run_id = request_params["run_id"]
+        reservation = await self._areserve_resources(
+            request_params.get("resources", {"instances": 1}),
+            request_params.get("queue_timeout", 0),
+            tenant=self.tenant_of(run_id),
+            priority=request_params.get("priority", "normal"),
+            run_ids=[run_id],
+        )
+        return await self._alaunch_instance(request_params, reservation, on_state)
+
+    async def _alaunch_instance(
+        self,
+        request_params: Dict[str, Any],
+        reservation: Reservation,
+        on_state: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Submits the sleeper job of an instance on `reservation`, or packs it into an allocation."""
+        if self.packed:
+            return await self._alaunch_packed(request_params, reservation, on_state)
+        cmd = self._sbatch_cmd(request_params)
+        if on_state is not None:
+            on_state("starting")
+        with reservation:
+            # Bursts of `sbatch` calls are limited like container starts, to spare slurmctld
+            async with self.start_limits.slot("slurm"):
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                stdout, stderr = await proc.communicate(self._sleeper_script().encode())
+                if proc.returncode != 0:
+                    logger.error(f"Failed to submit Slurm job for container {request_params['container_image']}, run {request_params['run_id']}: {stderr.decode()}")
+                    raise subprocess.CalledProcessError(proc.returncode, cmd, stdout.decode(), stderr.decode())
+            return self._add_instance(request_params, self._parse_job_id(stdout.decode()), reservation)
+
+    async def _alaunch_packed(
+        self,
+        request_params: Dict[str, Any],
+        reservation: Reservation,
+        on_state: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Places an instance in a free slot, submitting a new allocation only if there is none.
+
+        Starts that find no free slot while an allocation is being submitted wait for it, or
+        for a slot freed in the meantime, rather than submitting one each.
+        """
+        run_id = request_params["run_id"]
+        key = tuple(request_params.get("sbatch_args", []))
+        with reservation:
+            try:
+                return await self._await_slot(request_params, reservation, key, run_id, on_state)
+            except BaseException:
+                # An allocation emptied while this start waited was kept for it
+                for allocation in self._abandoned_allocations(key):
+                    await asyncio.shield(self._acancel_allocation(allocation))
+                raise
+
+    async def _await_slot(
+        self,
+        request_params: Dict[str, Any],
+        reservation: Reservation,
+        key: Tuple[str, ...],
+        run_id: str,
+        on_state: Optional[Callable[[str], None]],
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        while True:
+            allocation = self._claim_slot(key, run_id)
+            if allocation is not None:
+                return self._add_instance(request_params, allocation.job_id, reservation, allocation.occupants[run_id])
+            pending = self._pending_allocations.get(key)
+            if pending is None:
+                if on_state is not None:
+                    on_state("starting")
+                pending = self._pending_allocations[key] = asyncio.ensure_future(self._asubmit_allocation(
+                    key,
+                    request_params.get("queue_timeout", 0),
+                    reservation.tenant,
+                    request_params.get("priority", "normal"),
+                ))
+                pending.add_done_callback(lambda done: self._forget_pending(key, done))
+            freed = loop.create_future()
+            with self._resource_lock:
+                self._slot_waiters.setdefault(key, []).append((loop, freed))
+            try:
+                # `asyncio.wait` does not cancel the submission with this start: it serves every start waiting for it
+                await asyncio.wait({pending, freed}, return_when=asyncio.FIRST_COMPLETED)
+            except BaseException:
+                # No longer counted as waiting by `_vacate_slot`
+                freed.cancel()
+                raise
+            finally:
+                with self._resource_lock:
+                    waiters = self._slot_waiters.get(key, [])
+                    if (loop, freed) in waiters:
+                        waiters.remove((loop, freed))
+                    if not waiters:
+                        self._slot_waiters.pop(key, None)
+                        if key in self._queued_allocations:
+                            # Nobody needs it any more; do not hold up the admission queue, nor
+                            # have the starts coming next wait for a submission being cancelled
+                            pending.cancel()
+                            if self._pending_allocations.get(key) is pending:
+                                del self._pending_allocations[key]
+            if pending.cancelled():
+                continue
+            if pending.done() and pending.exception() is not None:
+                raise pending.exception()
 
+    def _forget_pending(self, key: Tuple[str, ...], pending: "asyncio.Future[Optional[SlurmAllocation]]") -> None:
+        if self._pending_allocations.get(key) is pending:
+            del self._pending_allocations[key]
+        if not pending.cancelled():
+            # Retrieved by the waiters, if any are left
+            pending.exception()
+
+    def _claim_slot(
+        self, key: Tuple[str, ...], run_id: str, allocation: Optional[SlurmAllocation] = None
+    ) -> Optional[SlurmAllocation]:
+        """Gives `run_id` a slot in `allocation` or, by default, in the fullest allocation for
+        `key` that has one free, so that emptied allocations can be released."""
+        with self._resource_lock:
+            if allocation is None:
+                candidates = [a for a in self.allocations.values() if a.key == key and a.free > 0]
+                if not candidates:
+                    return None
+                allocation = min(candidates, key=lambda a: a.free)
+            allocation.occupants[run_id] = uuid.uuid4().hex
+            return allocation
+
+    def _has_free_slot(self, key: Tuple[str, ...]) -> bool:
+        with self._resource_lock:
+            return any(a.key == key and a.free > 0 for a in self.allocations.values())
+
+    def _vacate_slot(self, allocation: SlurmAllocation, run_id: str) -> bool:
+        """Frees the slot of `run_id`; returns True if the allocation is now empty and has to be cancelled.
+
+        An emptied allocation is kept for starts waiting for a slot, which are woken up. Should
+        they be cancelled instead of taking it, the last one cancels it (see `_abandoned_allocations`).
+        """
+        with self._resource_lock:
+            allocation.occupants.pop(run_id, None)
+            waiters = [(loop, freed) for loop, freed in self._slot_waiters.pop(allocation.key, []) if not freed.cancelled()]
+            for loop, freed in waiters:
+                loop.call_soon_threadsafe(lambda freed=freed: freed.done() or freed.set_result(None))
+            if allocation.occupants or allocation.releasing or waiters:
+                return False
+            allocation.releasing = True
+            return True
+
+    def _abandoned_allocations(self, key: Tuple[str, ...]) -> List[SlurmAllocation]:
+        """Marks for release the empty allocations for `key` that were kept for starts waiting for a
+        slot, once none is left waiting, and returns them."""
+        with self._resource_lock:
+            if self._slot_waiters.get(key):
+                return []
+            abandoned = [a for a in self.allocations.values() if a.key == key and not a.occupants and not a.releasing]
+            for allocation in abandoned:
+                allocation.releasing = True
+            return abandoned
+
+    def _drop_allocation(self, allocation: SlurmAllocation) -> None:
+        """Forgets a cancelled allocation and releases its `allocations` resource."""
+        with self._resource_lock:
+            self.allocations.pop(allocation.job_id, None)
+            self._release_resources({ALLOCATIONS: 1}, allocation.tenant)
+        self._forget_agent(allocation.job_id)
+
+    def _allocation_cmd(self, key: Tuple[str, ...]) -> List[str]:
+        name = f"{JOB_NAME_PREFIX}pack-{uuid.uuid4().hex[:12]}"
+        return ["sbatch", "--parsable", f"--job-name={name}"] + self.allocation_args + list(key)
+
+    def _new_allocation(self, sbatch_stdout: str, key: Tuple[str, ...], reservation: Reservation) -> SlurmAllocation:
+        allocation = SlurmAllocation(self._parse_job_id(sbatch_stdout), self.slots_per_allocation, key, reservation.tenant)
+        with self._resource_lock:
+            self.allocations[allocation.job_id] = allocation
+            reservation.commit()
+        logger.info(f"Started Slurm allocation {allocation.job_id} with {allocation.slots} slots")
+        return allocation
+
+    def _submit_allocation(self, key: Tuple[str, ...], tenant: str) -> SlurmAllocation:
+        """Submits the sleeper job of a new allocation, raising `InsufficientResourcesError`
+        if `allocations` are exhausted."""
+        with self._reserve_resources({ALLOCATIONS: 1}, tenant) as reservation:
+            try:
+                result = subprocess.run(self._allocation_cmd(key), input=self._sleeper_script(), capture_output=True, text=True, check=True)
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to submit Slurm allocation: {e.stderr}")
+                raise
+            return self._new_allocation(result.stdout, key, reservation)
+
+    async def _asubmit_allocation(
+        self, key: Tuple[str, ...], queue_timeout: Optional[float], tenant: str, priority: str
+    ) -> Optional[SlurmAllocation]:
+        """Async variant of `_submit_allocation`, waiting in the admission queue for `allocations`
+        like any other start. Returns None if a slot was freed while it waited."""
+        self._queued_allocations.add(key)
+        try:
+            reservation = await self._areserve_resources({ALLOCATIONS: 1}, queue_timeout, tenant, priority)
+        finally:
+            self._queued_allocations.discard(key)
+        with reservation:
+            if self._has_free_slot(key):
+                return None
+            cmd = self._allocation_cmd(key)
+            async with self.start_limits.slot("slurm"):
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                stdout, stderr = await proc.communicate(self._sleeper_script().encode())
+                if proc.returncode != 0:
+                    logger.error(f"Failed to submit Slurm allocation: {stderr.decode()}")
+                    raise subprocess.CalledProcessError(proc.returncode, cmd, stdout.decode(), stderr.decode())
+            allocation = self._new_allocation(stdout.decode(), key, reservation)
+        # Every start it was submitted for may have been cancelled in the meantime
+        for abandoned in self._abandoned_allocations(key):
+            await self._acancel_allocation(abandoned)
+        return allocation
+
+    def _sleeper_script(self) -> str:
+        return SLEEPER_SCRIPT if self.agent_dir is None else agent_script(self.agent_dir)
+
+    def _sbatch_cmd(self, request_params: Dict[str, Any]) -> List[str]:
+        """Builds the `sbatch` command for a sleeper job."""
         # Extract sbatch options from config
         sbatch_args = request_params.get("sbatch_args", [])
-        
+
         # We start a sleeper job so we can execute commands in it
-        # Construct sbatch command
-        cmd = ["sbatch", "--parsable"] + sbatch_args
-        
-        # Script to run (sleep forever so we can connect)
-        script = "#!/bin/bash\nsleep infinity"
-        
+        return ["sbatch", "--parsable", f"--job-name={JOB_NAME_PREFIX}{request_params['run_id']}"] + sbatch_args
+
+    @staticmethod
+    def _parse_job_id(sbatch_stdout: str) -> str:
+        job_id = sbatch_stdout.strip()
+        # If job_id has ; (cluster name), take first part
+        if ";" in job_id:
+            job_id = job_id.split(";")[0]
+        return job_id
+
+    def _add_instance(
+        self, request_params: Dict[str, Any], job_id: str, reservation: Reservation, slot_tag: Optional[str] = None
+    ) -> str:
+        """Registers an instance in job `job_id` (in the slot tagged `slot_tag` if packed) and
+        commits the reservation of its resources."""
+        run_id = request_params["run_id"]
+        container_image = request_params["container_image"]
+        instance_data = {
+            "container_image": container_image,
+            "container_type": request_params.get("container_type", ""),
+            "job_id": job_id,
+            "resources": reservation.resources,
+            "tenant": reservation.tenant,
+            "idle_timeout": request_params.get("idle_timeout"),
+            "created_at": time.time(),
+            "updated_at": None,
+            "num_cmd": 0
+        }
+        if slot_tag is not None:
+            instance_data.update(slot_tag=slot_tag, slots=self.allocations[job_id].slots, sbatch_args=request_params.get("sbatch_args", []))
+        try:
+            self._register_instance(run_id, instance_data)
+        except BaseException:
+            if slot_tag is not None:
+                with self._resource_lock:
+                    self.allocations[job_id].occupants.pop(run_id, None)
+            raise
+        reservation.commit()
+        logger.info(f"Started Slurm {'slot in job' if slot_tag else 'job'} {job_id} for container {container_image}, run {run_id}")
+        return run_id
+
+    def _reconcile(self, records: Dict[str, Dict[str, Any]], reap_orphans: bool) -> Dict[str, Dict[str, Any]]:
+        """Re-adopts the recorded jobs that `squeue` still lists."""
         try:
             result = subprocess.run(
-                cmd,
-                input=script,
+                ["squeue", "-h", "-u", getpass.getuser(), "-o", "%i %j"],
                 capture_output=True,
                 text=True,
-                check=True
+                timeout=60,
+                check=True,
             )
-            job_id = result.stdout.strip()
-            # If job_id has ; (cluster name), take first part
-            if ";" in job_id:
-                job_id = job_id.split(";")[0]
-
-            self.running_instances[run_id] = {
-                "container_image": container_image,
-                "job_id": job_id,
-                "resources": needed_resources
-            }
-            self._allocate_resources(needed_resources)
-            logger.info(f"Started Slurm job {job_id} for container {container_image}, run {run_id}")
-            return run_id
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to submit Slurm job for container {container_image}, run {run_id}: {e.stderr}")
-            raise
+        except (OSError, subprocess.SubprocessError) as e:
+            # Dropping the records would leak every job; keep them and let closes clean up
+            logger.error(f"squeue failed, re-adopting all {len(records)} recorded jobs unverified: {e}")
+            self._readopt_allocations(records)
+            return dict(records)
+        jobs = dict(line.split(" ", 1) for line in result.stdout.splitlines() if " " in line)
+        adopted = {run_id: record for run_id, record in records.items() if record.get("job_id") in jobs}
+        self._readopt_allocations(adopted)
+        if reap_orphans:
+            known = {record["job_id"] for record in adopted.values()}
+            for job_id, name in jobs.items():
+                if name.startswith(JOB_NAME_PREFIX) and job_id not in known:
+                    logger.warning(f"Cancelling orphaned job {job_id} ({name})")
+                    subprocess.run(["scancel", job_id], capture_output=True)
+        return adopted
 
-    def execute_command(self, run_id: str, cmd: str) -> Dict[str, Any]:
-        """Executes a command in the Slurm job."""
-        if run_id not in self.running_instances:
-            raise KeyError(f"Run ID {run_id} not found.")
+    def _readopt_allocations(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Rebuilds the packed allocations from the records of their instances."""
+        for run_id, record in records.items():
+            if "slot_tag" not in record:
+                continue
+            allocation = self.allocations.get(record["job_id"])
+            if allocation is None:
+                allocation = SlurmAllocation(
+                    record["job_id"],
+                    record.get("slots", self.slots_per_allocation),
+                    tuple(record.get("sbatch_args", [])),
+                    record.get("tenant", DEFAULT_TENANT),
+                )
+                self.allocations[allocation.job_id] = allocation
+                self._allocate_resources({ALLOCATIONS: 1}, allocation.tenant)
+            allocation.occupants[run_id] = record["slot_tag"]
 
-        job_id = self.running_instances[run_id]["job_id"]
-        
+    def _srun_cmd(self, job_id: str, cmd: str) -> List[str]:
         # Use srun to execute within the allocation
         # --overlap allows sharing the allocation
-        full_cmd = ["srun", "--jobid", job_id, "--overlap", "bash", "-c", cmd]
-        
+        return ["srun", "--jobid", job_id, "--overlap", "bash", "-c", cmd]
+
+    def _instance_script(self, instance_data: Dict[str, Any], cmd: str) -> str:
+        """`cmd` tagged with the slot of the instance if it is packed."""
+        if "slot_tag" in instance_data:
+            return tag_command(cmd, instance_data["slot_tag"], SLOT_TAG_VAR)
+        return cmd
+
+    def _instance_cmd(self, instance_data: Dict[str, Any], cmd: str) -> List[str]:
+        """`srun` command running `cmd` in the job of an instance."""
+        return self._srun_cmd(instance_data["job_id"], self._instance_script(instance_data, cmd))
+
+    def _agent(self, job_id: str) -> Optional[AgentAddress]:
+        """The exec agent of job `job_id`, if it has published its address."""
+        if self.agent_dir is None:
+            return None
+        address = self._agents.get(job_id)
+        if address is None:
+            address = read_address(agent_path(self.agent_dir, job_id))
+            if address is not None:
+                self._agents[job_id] = address
+        return address
+
+    def _agent_unavailable(self, job_id: str, error: AgentUnavailableError) -> None:
+        # Re-read next time: the agent may have been restarted elsewhere, or never come up
+        self._agents.pop(job_id, None)
+        logger.warning(f"{error}; running the command in job {job_id} with srun")
+
+    def _forget_agent(self, job_id: str) -> None:
+        """Drops the address of the agent of a cancelled job."""
+        self._agents.pop(job_id, None)
+        if self.agent_dir is not None:
+            try:
+                os.remove(agent_path(self.agent_dir, job_id))
+            except OSError:
+                pass
+
+    def _run_script(self, job_id: str, script: str, timeout: Optional[float]) -> Dict[str, Any]:
+        """Runs `script` in job `job_id` through its exec agent, or as an `srun` step."""
+        address = self._agent(job_id)
+        if address is not None:
+            try:
+                return run_command(address, script, timeout)
+            except AgentUnavailableError as e:
+                self._agent_unavailable(job_id, e)
+        result = subprocess.run(self._srun_cmd(job_id, script), capture_output=True, text=True, timeout=timeout, check=False)
+        return {"output": result.stdout + result.stderr, "returncode": result.returncode}
+
+    async def _astream_script(self, job_id: str, script: str, timeout: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
+        """Async, streaming variant of `_run_script`."""
+        address = self._agent(job_id)
+        if address is not None:
+            try:
+                async for event in stream_command(address, script, timeout):
+                    yield event
+                return
+            except AgentUnavailableError as e:
+                # Raised before the command was sent, so it has not run
+                self._agent_unavailable(job_id, e)
+        async for event in stream_process(self._srun_cmd(job_id, script), timeout=timeout):
+            yield event
+
+    def execute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Executes a command in the Slurm job."""
+        instance_data = self._get_instance(run_id)
+        job_id = instance_data["job_id"]
         try:
-            result = subprocess.run(
-                full_cmd,
-                capture_output=True,
-                text=True,
-                check=False # Don't raise, return returncode
-            )
-            return {"output": result.stdout + result.stderr, "returncode": result.returncode}
+            result = self._run_script(job_id, self._instance_script(instance_data, cmd), timeout)
         except Exception as e:
             logger.error(f"Failed to execute command in job {job_id} for run {run_id}: {e}")
             raise
+        self._record_command(instance_data)
+        return result
+
+    async def aexecute_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """Executes a command in the Slurm job without blocking the event loop."""
+        instance_data = self._get_instance(run_id)
+        job_id = instance_data["job_id"]
+        script = self._instance_script(instance_data, cmd)
+        try:
+            result = await collect_output(self._astream_script(job_id, script, timeout))
+        except Exception as e:
+            logger.error(f"Failed to execute command in job {job_id} for run {run_id}: {e}")
+            raise
+        self._record_command(instance_data)
+        return result
+
+    async def astream_command(self, run_id: str, cmd: str, timeout: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Executes a command in the Slurm job, yielding output as it is produced."""
+        instance_data = self._get_instance(run_id)
+        script = self._instance_script(instance_data, cmd)
+        async for event in self._astream_script(instance_data["job_id"], script, timeout):
+            yield event
+        self._record_command(instance_data)
+
+    async def akill_command(self, run_id: str, tag: str) -> None:
+        """Kills the processes of a tagged command with another command in the Slurm job."""
+        instance_data = self._get_instance(run_id)
+        script = self._instance_script(instance_data, kill_tagged_script(tag))
+        await collect_output(self._astream_script(instance_data["job_id"], script, 60))
+
+    async def aupload(self, run_id: str, path: str, archive: AsyncIterator[bytes]) -> None:
+        """Extracts a streamed tar archive into the directory `path`, piping it through `srun tar`."""
+        instance_data = self._get_instance(run_id)
+        cmd = f"mkdir -p {shlex.quote(path)} && tar -xf - -C {shlex.quote(path)}"
+        async for _ in pipe_process(self._instance_cmd(instance_data, cmd), stdin=archive):
+            pass
+
+    async def adownload(self, run_id: str, path: str) -> AsyncIterator[bytes]:
+        """Yields a tar archive of `path` created by `srun tar`."""
+        instance_data = self._get_instance(run_id)
+        path = posixpath.normpath(path)
+        parent, name = posixpath.split(path)
+        cmd = f"tar -cf - -C {shlex.quote(parent or '.')} {shlex.quote(name or '.')}"
+        async for chunk in pipe_process(self._instance_cmd(instance_data, cmd)):
+            yield chunk
+
+    async def aread_files(
+        self, run_id: str, paths: List[str], max_bytes: int = DEFAULT_READ_MAX_BYTES
+    ) -> Dict[str, Dict[str, Any]]:
+        """Reads many files through concurrent `srun tar` archive streams."""
+        self._get_instance(run_id)
+        return await read_archived_files(lambda path: self.adownload(run_id, path), paths, max_bytes)
 
     def close_instance(self, run_id: str) -> None:
         """Closes the Slurm instance (cancels job)."""
         if run_id not in self.running_instances:
             return
 
-        job_id = self.running_instances[run_id]["job_id"]
-        resources = self.running_instances[run_id]["resources"]
-        
+        instance_data = self.running_instances[run_id]
+        job_id = instance_data["job_id"]
+        if "slot_tag" in instance_data:
+            self._close_slot(run_id, instance_data)
+            return
+
         try:
             subprocess.run(["scancel", job_id], check=True, capture_output=True)
         except subprocess.CalledProcessError as e:
             logger.error(f"Failed to cancel job {job_id} for run {run_id}: {e}")
             # We still remove it from our list as it's likely gone or we lost control
-        
-        self._release_resources(resources)
-        del self.running_instances[run_id]
+
+        self._forget_agent(job_id)
+        self._remove_instance(run_id)
+
+    async def aclose_instance(self, run_id: str) -> None:
+        """Closes the Slurm instance (cancels job) without blocking the event loop."""
+        if run_id not in self.running_instances:
+            return
+
+        instance_data = self.running_instances[run_id]
+        job_id = instance_data["job_id"]
+        if "slot_tag" in instance_data:
+            await self._aclose_slot(run_id, instance_data)
+            return
+        proc = await asyncio.create_subprocess_exec(
+            "scancel", job_id, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            # We still remove it from our list as it's likely gone or we lost control
+            logger.error(f"Failed to cancel job {job_id} for run {run_id}: {stderr.decode()}")
+
+        self._forget_agent(job_id)
+        self._remove_instance(run_id)
+
+    def _close_slot(self, run_id: str, instance_data: Dict[str, Any]) -> None:
+        """Kills what a packed instance left running and cancels its allocation if it was the last."""
+        job_id = instance_data["job_id"]
+        try:
+            self._run_script(job_id, kill_tagged_script(instance_data["slot_tag"], SLOT_TAG_VAR), 60)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f"Failed to kill the processes of run {run_id} in job {job_id}: {e}")
+        self._remove_instance(run_id)
+        allocation = self.allocations.get(job_id)
+        if allocation is not None and self._vacate_slot(allocation, run_id):
+            try:
+                subprocess.run(["scancel", job_id], check=True, capture_output=True)
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to cancel allocation {job_id}: {e}")
+            self._drop_allocation(allocation)
+            logger.info(f"Released empty Slurm allocation {job_id}")
+
+    async def _aclose_slot(self, run_id: str, instance_data: Dict[str, Any]) -> None:
+        """Async variant of `_close_slot`."""
+        job_id = instance_data["job_id"]
+        try:
+            await collect_output(self._astream_script(job_id, kill_tagged_script(instance_data["slot_tag"], SLOT_TAG_VAR), 60))
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f"Failed to kill the processes of run {run_id} in job {job_id}: {e}")
+        self._remove_instance(run_id)
+        allocation = self.allocations.get(job_id)
+        if allocation is not None and self._vacate_slot(allocation, run_id):
+            await self._acancel_allocation(allocation)
+
+    async def _acancel_allocation(self, allocation: SlurmAllocation) -> None:
+        """Cancels the sleeper job of an allocation marked `releasing` and drops it."""
+        proc = await asyncio.create_subprocess_exec(
+            "scancel", allocation.job_id, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            logger.error(f"Failed to cancel allocation {allocation.job_id}: {stderr.decode()}")
+        self._drop_allocation(allocation)
+        logger.info(f"Released empty Slurm allocation {allocation.job_id}")
+
+    def allocation_stats(self) -> List[Dict[str, Any]]:
+        with self._resource_lock:
+            return [allocation.stats() for allocation in self.allocations.values()]
+
+    def extra_stats(self) -> Dict[str, Any]:
+        return {"allocations": self.allocation_stats()} if self.packed else {}
+
+    def stats_version(self) -> Tuple[Any, ...]:
+        with self._resource_lock:
+            # Few allocations, each of which changes with its occupants
+            allocations = tuple((job_id, len(allocation.occupants)) for job_id, allocation in self.allocations.items())
+        return super().stats_version() + allocations
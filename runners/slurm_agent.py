@@ -0,0 +1,273 @@
+"""Exec agent run by Slurm sleeper jobs, and the runner's client for it.
+
+Starting an `srun` step costs a round trip to slurmctld for every command. With the exec
+agent, the sleeper job instead runs this module: it listens on a TCP port of its node and
+publishes the address and a random token in a file on a shared filesystem. The runner then
+sends each command over a connection of its own and reads the output as it is produced.
+
+A connection per command, rather than one long-lived channel per job, costs a TCP handshake
+inside the cluster (well under a millisecond, against the slurmctld round trip of an `srun`
+step). In exchange, concurrent commands of a packed allocation need no multiplexing, closing
+the connection is how a command is cancelled, and a dropped connection fails one command only.
+
+The agent half runs on compute nodes, where only the Python standard library can be relied
+on; this module must not import anything else.
+"""
+
+import asyncio
+import codecs
+import hmac
+import json
+import os
+import secrets
+import shlex
+import signal
+import socket
+import subprocess
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional
+
+AGENT_FILE_VAR = "ARSERVICE_AGENT_FILE"
+"""Environment variable with the path the agent publishes its address at."""
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+"""Largest command the agent accepts; larger ones run with `srun`."""
+CONNECT_TIMEOUT = 5.0
+TIMEOUT_GRACE = 30.0
+"""Seconds the runner waits beyond a command's timeout for the agent to report it."""
+
+
+class AgentAddress(NamedTuple):
+    host: str
+    port: int
+    token: str
+
+
+class AgentUnavailableError(OSError):
+    """The agent could not be reached or refused the command; the command has not run."""
+
+
+# Agent side
+
+
+async def _run(request: Dict[str, Any], reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    loop = asyncio.get_running_loop()
+    timeout = request.get("timeout")
+    deadline = None if timeout is None else loop.time() + timeout
+    proc = await asyncio.create_subprocess_exec(
+        "bash", "-c", request["cmd"],
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        start_new_session=True,
+    )
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # The runner closes its end to cancel the command
+    hangup = asyncio.ensure_future(reader.read())
+
+    def send(event: Dict[str, Any]) -> None:
+        writer.write(json.dumps(event).encode() + b"\n")
+
+    try:
+        while True:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            read = asyncio.ensure_future(proc.stdout.read(READ_CHUNK_SIZE))
+            done, _ = await asyncio.wait({read, hangup}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if read not in done:
+                read.cancel()
+                if hangup not in done:
+                    send({"timeout": timeout})
+                return
+            chunk = read.result()
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if text:
+                send({"output": text})
+                await writer.drain()
+        text = decoder.decode(b"", final=True)
+        if text:
+            send({"output": text})
+        send({"returncode": await proc.wait()})
+    finally:
+        hangup.cancel()
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            await proc.wait()
+
+
+def _handler(token: str):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                request = json.loads(await reader.readline())
+                if not hmac.compare_digest(str(request.get("token", "")), token):
+                    raise ValueError("bad token")
+                if not isinstance(request.get("cmd"), str):
+                    raise ValueError("no command")
+            except (ValueError, AttributeError, TypeError) as e:
+                # Oversized (over the reader's limit) or malformed: refused before running anything
+                writer.write(json.dumps({"error": f"Invalid request: {e}"}).encode() + b"\n")
+            else:
+                await _run(request, reader, writer)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+def _publish(path: str, address: AgentAddress) -> None:
+    """Writes `address` to `path`, readable by the user only and atomically."""
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(address._asdict(), f)
+    os.replace(tmp, path)
+
+
+async def serve(path: str) -> None:
+    """Serves commands until the job is cancelled, published at `path`."""
+    token = secrets.token_hex(32)
+    # The request is one line, so the reader's limit bounds the size of commands
+    server = await asyncio.start_server(_handler(token), host="0.0.0.0", port=0, limit=MAX_REQUEST_BYTES)
+    port = server.sockets[0].getsockname()[1]
+    _publish(path, AgentAddress(socket.getfqdn(), port, token))
+    stop = asyncio.get_running_loop().create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+    try:
+        await stop
+    finally:
+        server.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def agent_path(directory: str, job_id: str) -> str:
+    """Where the agent of job `job_id` publishes its address."""
+    return os.path.join(directory, f"{job_id}.json")
+
+
+def agent_script(directory: str) -> str:
+    """`sbatch` script of a sleeper job running the agent, published in `directory`.
+
+    Should the agent not start (e.g. no `python3` on the node), the job keeps sleeping and
+    commands fall back to `srun`.
+    """
+    with open(__file__) as f:
+        source = f.read()
+    return (
+        "#!/bin/bash\n"
+        f'export {AGENT_FILE_VAR}={shlex.quote(directory)}/"$SLURM_JOB_ID".json\n'
+        "python3 - <<'ARSERVICE_AGENT_SOURCE'\n"
+        f"{source}\n"
+        "ARSERVICE_AGENT_SOURCE\n"
+        "exec sleep infinity\n"
+    )
+
+
+# Runner side
+
+
+def read_address(path: str) -> Optional[AgentAddress]:
+    """The address an agent published at `path`, or None if it has not (yet)."""
+    try:
+        with open(path) as f:
+            return AgentAddress(**json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _request(address: AgentAddress, cmd: str, timeout: Optional[float]) -> bytes:
+    request = json.dumps({"token": address.token, "cmd": cmd, "timeout": timeout}).encode() + b"\n"
+    if len(request) > MAX_REQUEST_BYTES:
+        raise AgentUnavailableError(f"Command of {len(request)} bytes is too large for the exec agent")
+    return request
+
+
+def _unreachable(address: AgentAddress, error: BaseException) -> AgentUnavailableError:
+    return AgentUnavailableError(f"Exec agent at {address.host}:{address.port} is unreachable: {error}")
+
+
+def _event(line: bytes, cmd: str) -> Dict[str, Any]:
+    if not line:
+        raise ConnectionResetError("The exec agent closed the connection before the command finished")
+    event = json.loads(line)
+    if "error" in event:
+        raise AgentUnavailableError(f"Exec agent refused the command: {event['error']}")
+    if "timeout" in event:
+        raise subprocess.TimeoutExpired(cmd, event["timeout"])
+    return event
+
+
+def run_command(address: AgentAddress, cmd: str, timeout: Optional[float]) -> Dict[str, Any]:
+    """Runs `cmd` through the agent, returning the environment result dict."""
+    request = _request(address, cmd, timeout)
+    try:
+        sock = socket.create_connection((address.host, address.port), timeout=CONNECT_TIMEOUT)
+    except OSError as e:
+        raise _unreachable(address, e) from e
+    with sock:
+        sock.settimeout(None if timeout is None else timeout + TIMEOUT_GRACE)
+        try:
+            sock.sendall(request)
+        except OSError as e:
+            # The agent only runs complete requests
+            raise _unreachable(address, e) from e
+        output = []
+        with sock.makefile("rb") as lines:
+            while True:
+                try:
+                    line = lines.readline()
+                except socket.timeout:
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+                event = _event(line, cmd)
+                if "returncode" in event:
+                    return {"output": "".join(output), "returncode": event["returncode"]}
+                output.append(event["output"])
+
+
+async def stream_command(address: AgentAddress, cmd: str, timeout: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
+    """Runs `cmd` through the agent, yielding `{"output": str}` chunks and then `{"returncode": int}`
+    like `stream_process`. The command is killed if the consumer stops iterating early."""
+    loop = asyncio.get_running_loop()
+    request = _request(address, cmd, timeout)
+    try:
+        reader, writer = await asyncio.wait_for(
+            # Room for a chunk of output with every byte escaped
+            asyncio.open_connection(address.host, address.port, limit=8 * READ_CHUNK_SIZE), CONNECT_TIMEOUT
+        )
+    except (OSError, asyncio.TimeoutError) as e:
+        raise _unreachable(address, e) from e
+    deadline = None if timeout is None else loop.time() + timeout + TIMEOUT_GRACE
+    try:
+        try:
+            writer.write(request)
+            await writer.drain()
+        except OSError as e:
+            # The agent only runs complete requests
+            raise _unreachable(address, e) from e
+        while True:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            try:
+                event = _event(await asyncio.wait_for(reader.readline(), remaining), cmd)
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            yield event
+            if "returncode" in event:
+                return
+    finally:
+        # Closing the connection early makes the agent kill the command
+        writer.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(os.environ[AGENT_FILE_VAR]))
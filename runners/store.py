@@ -0,0 +1,52 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict
+
+
+class InstanceStore:
+    """Durable copy of the instance registry, kept in an SQLite database in WAL mode.
+
+    Every `put` / `delete` is a single committed transaction appended to the write-ahead
+    log, so the store reflects all instances started or closed before a crash of the
+    service. `BaseRunner.recover` reads it back after a restart.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Accessed from the event loop and from worker threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only risks the last commits on power loss, not on a process crash
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS instances (run_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def put(self, run_id: str, record: Dict[str, Any]) -> None:
+        """Inserts or replaces the record of an instance."""
+        data = json.dumps(record, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO instances (run_id, record, updated_at) VALUES (?, ?, ?)",
+                (run_id, data, time.time()),
+            )
+
+    def delete(self, run_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM instances WHERE run_id = ?", (run_id,))
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """Returns all records by run ID."""
+        with self._lock:
+            rows = self._conn.execute("SELECT run_id, record FROM instances ORDER BY run_id").fetchall()
+        return {run_id: json.loads(record) for run_id, record in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_START_WORKERS = 32
+DEFAULT_EXECUTE_WORKERS = 64
+DEFAULT_CLOSE_WORKERS = 16
+DEFAULT_MAX_CONCURRENT_STARTS = 16
+"""Upper bound of the adaptive start limit of each container runtime."""
+
+
+class WorkerPools:
+    """Bounded thread pools for the blocking parts of starting, running and closing instances.
+
+    Starts can hold a thread for minutes (image pulls, sandbox builds, `enroot import`) while
+    commands take milliseconds; with a pool each, a burst of cold starts cannot leave running
+    instances waiting for a thread.
+    """
+
+    def __init__(
+        self,
+        start: int = DEFAULT_START_WORKERS,
+        execute: int = DEFAULT_EXECUTE_WORKERS,
+        close: int = DEFAULT_CLOSE_WORKERS,
+    ):
+        self.sizes = {"start": start, "execute": execute, "close": close}
+        self.start = ThreadPoolExecutor(start, thread_name_prefix="arservice-start")
+        self.execute = ThreadPoolExecutor(execute, thread_name_prefix="arservice-execute")
+        self.close = ThreadPoolExecutor(close, thread_name_prefix="arservice-close")
+
+    @staticmethod
+    async def run(pool: ThreadPoolExecutor, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """`asyncio.to_thread` on `pool` instead of the loop's default executor."""
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+
+
+class AdaptiveLimit:
+    """Limit on concurrent starts of one container runtime, adapted to how it copes.
+
+    Additive increase, multiplicative decrease: while starts are held back by the limit, each
+    successful one raises it by `1 / limit` (about one per round of starts). A failed start,
+    or one taking more than `tolerance` times the usual duration, cuts it by `backoff`, so a
+    thundering herd of `docker run`s backs off before it overloads the daemon.
+
+    Not thread-safe; used from the event loop only.
+    """
+
+    def __init__(
+        self,
+        maximum: int = DEFAULT_MAX_CONCURRENT_STARTS,
+        initial: Optional[int] = None,
+        minimum: int = 1,
+        backoff: float = 0.5,
+        tolerance: float = 3.0,
+    ):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = float(min(initial if initial is not None else max(maximum // 4, 1), maximum))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.typical_s: Optional[float] = None
+        """Moving average of successful start durations."""
+        self.started = 0
+        self.failed = 0
+        self._waiters: Deque["asyncio.Future[None]"] = collections.deque()
+        self.version = 0
+        """Changes whenever `stats` does."""
+
+    def _has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self) -> None:
+        self.version += 1
+        if self._has_room() and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            self.version += 1
+            if waiter.done() and not waiter.cancelled():
+                # Granted a slot just as it was cancelled: pass it on
+                self.in_flight -= 1
+                self._wake()
+            else:
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(waiter)
+            raise
+
+    def release(self, seconds: float, ok: Optional[bool]) -> None:
+        """Frees a slot; `ok` is None if the start was abandoned, which says nothing about the runtime."""
+        self.version += 1
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        if ok is False:
+            self.failed += 1
+            self._decrease()
+        elif ok:
+            self.started += 1
+            if self.typical_s is not None and seconds > self.tolerance * self.typical_s:
+                self._decrease()
+            elif saturated or self._waiters:
+                self.limit = min(self.limit + 1 / self.limit, float(self.maximum))
+            self.typical_s = seconds if self.typical_s is None else 0.8 * self.typical_s + 0.2 * seconds
+        self._wake()
+
+    def _decrease(self) -> None:
+        self.limit = max(self.limit * self.backoff, float(self.minimum))
+
+    def _wake(self) -> None:
+        while self._waiters and self._has_room():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        started = time.monotonic()
+        ok: Optional[bool] = None
+        try:
+            yield
+            ok = True
+        except Exception:
+            ok = False
+            raise
+        finally:
+            self.release(time.monotonic() - started, ok)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "typical_s": self.typical_s,
+            "started": self.started,
+            "failed": self.failed,
+        }
+
+
+class StartLimits:
+    """An `AdaptiveLimit` per container runtime (`container_type`, or `"slurm"`)."""
+
+    def __init__(self, maximum: int = DEFAULT_MAX_CONCURRENT_STARTS, **kwargs: Any):
+        self.maximum = maximum
+        self.kwargs = kwargs
+        self.limits: Dict[str, AdaptiveLimit] = {}
+
+    def slot(self, runtime: str) -> "contextlib.AbstractAsyncContextManager[None]":
+        """Holds a start slot of `runtime` for the duration of an `async with` block."""
+        limit = self.limits.get(runtime)
+        if limit is None:
+            limit = self.limits[runtime] = AdaptiveLimit(self.maximum, **self.kwargs)
+        return limit.slot()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {runtime: limit.stats() for runtime, limit in self.limits.items()}
+
+    @property
+    def version(self) -> int:
+        """Changes whenever `stats` does."""
+        return sum(limit.version for limit in self.limits.values())
@@ -1,26 +1,29 @@
 from fastapi.testclient import TestClient
+import codec
 from api import create_app
 from runners.local import LocalRunner
-from unittest.mock import MagicMock, patch
+from environments.base import Environment
+from unittest.mock import patch
 import pytest
 
+class MockEnv(Environment):
+    def execute(self, command, cwd="", *, timeout=None):
+        return {"output": "api mocked", "returncode": 0}
+
 # We need to mock get_environment to avoid actual environment creation during import/runtime in LocalRunner
 @pytest.fixture
 def app():
     with patch("runners.local.get_environment") as mock_env:
         # Define what the mock environment returns
-        env_instance = MagicMock()
-        env_instance.execute.return_value = {"output": "api mocked", "returncode": 0}
-        mock_env.return_value = env_instance
+        mock_env.side_effect = lambda params, **kwargs: MockEnv()
         
         runner = LocalRunner({"instances": 2})
-        # Define some pre-existing environments config if needed, or pass empty
-        flask_app = create_app(runner, environments={"test-env": {"container_type": "local"}})
+        flask_app = create_app(runner)
         yield flask_app
 
 def test_start_instance(app):
     client = TestClient(app)
-    resp = client.post("/start_instance", json={"container_name": "test-env", "run_id": "run-1"})
+    resp = client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
     assert resp.status_code == 200
     assert resp.json()["status"] == "success"
     assert resp.json()["instance_id"] == "run-1"
@@ -28,7 +31,7 @@ def test_start_instance(app):
 def test_execute_command(app):
     client = TestClient(app)
     # Must start first to record in runner
-    client.post("/start_instance", json={"container_name": "test-env", "run_id": "run-1"})
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
     
     resp = client.post("/execute_command", json={"run_id": "run-1", "cmd": "whoami"})
     assert resp.status_code == 200
@@ -38,8 +41,8 @@ def test_execute_command(app):
 def test_multiple_instances_same_container(app):
     client = TestClient(app)
     # Start two instances of same container with different run_ids
-    resp1 = client.post("/start_instance", json={"container_name": "test-env", "run_id": "run-1"})
-    resp2 = client.post("/start_instance", json={"container_name": "test-env", "run_id": "run-2"})
+    resp1 = client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+    resp2 = client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-2"})
     
     assert resp1.status_code == 200
     assert resp2.status_code == 200
@@ -59,22 +62,462 @@ def test_multiple_instances_same_container(app):
 def test_resource_limits_api(app):
     client = TestClient(app)
     # available: 2. Start 1.
-    client.post("/start_instance", json={"container_name": "test-env", "run_id": "run-1"})
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
     
     resp = client.get("/get_available_resources")
     assert resp.json()["instances"] == 1
     
     # Start 2nd
-    client.post("/start_instance", json={"container_name": "test-env-2", "run_id": "run-2", "environment_config": {"container_type": "local"}})
+    client.post("/start_instance", json={"container_image": "test-env-2", "container_type": "local", "run_id": "run-2"})
     
     resp = client.get("/get_available_resources")
     assert resp.json()["instances"] == 0
     
-    # Start 3rd -> Should fail 500
-    resp = client.post("/start_instance", json={"container_name": "test-env-3", "run_id": "run-3", "environment_config": {"container_type": "local"}})
-    assert resp.status_code == 500 
+    # Start 3rd -> Should be rejected with 503
+    resp = client.post("/start_instance", json={"container_image": "test-env-3", "container_type": "local", "run_id": "run-3"})
+    assert resp.status_code == 503
     
     # Close one
     client.post("/close_instance", json={"run_id": "run-1"})
     resp = client.get("/get_available_resources")
     assert resp.json()["instances"] == 1
+
+def test_execute_batch(app):
+    client = TestClient(app)
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-2"})
+
+    resp = client.post("/execute_batch", json={
+        "commands": [
+            {"run_id": "run-1", "cmd": "ls"},
+            {"run_id": "missing", "cmd": "ls"},
+            {"run_id": "run-2", "cmd": "ls", "timeout": 5},
+        ],
+        "max_concurrency": 2,
+    })
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert [r["run_id"] for r in results] == ["run-1", "missing", "run-2"]
+    assert results[0]["status"] == "success"
+    assert results[0]["result"]["output"] == "api mocked"
+    assert results[1] == {"run_id": "missing", "status": "error", "error": "Instance not found"}
+    assert results[2]["status"] == "success"
+
+def test_execute_command_stream(app):
+    client = TestClient(app)
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+
+    with client.stream("POST", "/execute_command_stream", json={"run_id": "run-1", "cmd": "ls"}) as resp:
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/event-stream")
+        body = "".join(resp.iter_text())
+
+    frames = [frame for frame in body.split("\n\n") if frame]
+    assert frames[0] == 'event: output\ndata: {"output": "api mocked"}'
+    assert frames[-1].startswith("event: result\n")
+    assert '"returncode": 0' in frames[-1]
+
+    resp = client.post("/execute_command_stream", json={"run_id": "missing", "cmd": "ls"})
+    assert resp.status_code == 404
+
+def test_websocket_channel(app):
+    client = TestClient(app)
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+
+    with client.websocket_connect("/ws/run-1") as ws:
+        ws.send_json({"id": "a", "cmd": "ls"})
+        ws.send_json({"id": "b", "cmd": "pwd", "stream": True})
+        ws.send_json({"id": "c"})
+        messages = [ws.receive_json() for _ in range(4)]
+
+    by_id = {}
+    for message in messages:
+        by_id.setdefault(message["id"], []).append(message)
+    assert by_id["a"] == [{"id": "a", "status": "success", "result": {"output": "api mocked", "returncode": 0}}]
+    assert by_id["b"] == [
+        {"id": "b", "output": "api mocked"},
+        {"id": "b", "status": "success", "result": {"returncode": 0}},
+    ]
+    assert by_id["c"][0]["status"] == "error"
+
+def test_websocket_unknown_instance(app):
+    from starlette.websockets import WebSocketDisconnect
+    client = TestClient(app)
+    with client.websocket_connect("/ws/missing") as ws:
+        with pytest.raises(WebSocketDisconnect) as exc:
+            ws.receive_json()
+    assert exc.value.code == 4404
+
+def test_stats_pagination_and_etag():
+    with patch("runners.local.get_environment", side_effect=lambda params, **kwargs: MockEnv()):
+        runner = LocalRunner({"instances": 10})
+        client = TestClient(create_app(runner))
+        for i in range(5):
+            client.post("/start_instance", json={"container_image": f"img-{i % 2}", "container_type": "local", "run_id": f"run-{i}"})
+
+        resp = client.get("/stats", params={"limit": 2, "fields": "num_cmd"})
+        body = resp.json()
+        assert body["active_instances"] == 5
+        assert body["container_counts"] == {"img-0": 3, "img-1": 2}
+        assert body["instances"] == [{"run_id": "run-0", "num_cmd": 0}, {"run_id": "run-1", "num_cmd": 0}]
+        assert body["next_cursor"] == "run-1"
+        assert body["tenants"]["default"]["allocated"] == {"instances": 5}
+
+        body = client.get("/stats", params={"limit": 2, "cursor": "run-3"}).json()
+        assert [i["run_id"] for i in body["instances"]] == ["run-4"]
+        assert body["next_cursor"] is None
+
+        body = client.get("/stats", params={"container_image": "img-1"}).json()
+        assert [i["run_id"] for i in body["instances"]] == ["run-1", "run-3"]
+
+        etag = resp.headers["etag"]
+        assert client.get("/stats", params={"limit": 2, "fields": "num_cmd"}, headers={"If-None-Match": etag}).status_code == 304
+        client.post("/execute_command", json={"run_id": "run-0", "cmd": "ls"})
+        assert client.get("/stats", params={"limit": 2, "fields": "num_cmd"}, headers={"If-None-Match": etag}).status_code == 200
+        # Counters change the tag too, although the registry did not change
+        etag = client.get("/stats", params={"limit": 0}).headers["etag"]
+        with patch.object(MockEnv, "execute", side_effect=RuntimeError("boom")):
+            assert client.post("/execute_command", json={"run_id": "run-0", "cmd": "ls"}).status_code == 500
+        resp = client.get("/stats", params={"limit": 0}, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        # An unchanged snapshot is answered from the counters, without building it
+        with patch.object(runner, "get_tenant_stats", side_effect=AssertionError):
+            assert client.get("/stats", params={"limit": 0}, headers={"If-None-Match": resp.headers["etag"]}).status_code == 304
+
+        client.post("/close_instance", json={"run_id": "run-4"})
+        body = client.get("/stats", params={"limit": 1, "fields": "busy_s"}).json()
+        assert body["totals"] == {"starts": 5, "closes": 1, "commands": 2}
+        assert body["instances"][0]["busy_s"] > 0
+
+def test_metrics_endpoint(app):
+    client = TestClient(app)
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+    client.post("/execute_command", json={"run_id": "run-1", "cmd": "ls"})
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-2"})
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-3"})
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    lines = resp.text.splitlines()
+    labels = '{container_type="local",image="test-env"}'
+    assert f"arservice_instance_start_seconds_count{labels} 2" in lines
+    assert f"arservice_admission_rejections_total{labels} 1" in lines
+    assert f"arservice_command_seconds_count{labels} 1" in lines
+    assert f"arservice_command_output_chars_total{labels} 10" in lines
+    assert 'arservice_resources_allocated{resource="instances"} 2' in lines
+    assert 'arservice_resources_max{resource="instances"} 2' in lines
+
+def test_background_start_and_wait(app):
+    client = TestClient(app)
+    resp = client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1", "wait": False})
+    assert resp.status_code == 202
+    assert resp.json()["state"] == "pending"
+
+    resp = client.get("/wait_instance", params={"run_id": "run-1", "timeout": 5})
+    assert resp.status_code == 200
+    assert resp.json()["state"] == "ready"
+    assert "run-1" in client.get("/stats").json()["instances"][0]["run_id"]
+
+    # Retrying the start of a started instance does not start it again
+    resp = client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1", "wait": False})
+    assert resp.json()["state"] == "ready"
+
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-2"})
+    resp = client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-3", "wait": False})
+    assert resp.status_code == 202
+    resp = client.get("/wait_instance", params={"run_id": "run-3", "timeout": 5})
+    assert resp.json()["state"] == "failed"
+    assert "Not enough resources" in resp.json()["error"]
+
+    assert client.get("/wait_instance", params={"run_id": "missing", "timeout": 0}).status_code == 404
+
+def test_output_limits_and_ranged_fetch(app):
+    client = TestClient(app)
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+
+    resp = client.post("/execute_command", json={"run_id": "run-1", "cmd": "cat log", "output": {"max_bytes": 4}})
+    result = resp.json()["result"]
+    assert result["truncated"] and result["output_bytes"] == 10
+    assert result["output"] == "ap\n[... 6 bytes omitted ...]\ned"
+
+    url = f"/output/{result['spill_id']}"
+    assert client.get(url).text == "api mocked"
+    resp = client.get(url, headers={"Range": "bytes=4-"})
+    assert resp.status_code == 206
+    assert resp.headers["content-range"] == "bytes 4-9/10"
+    assert resp.text == "mocked"
+    assert client.get(url, headers={"Range": "bytes=10-"}).status_code == 416
+    assert client.get("/output/" + "0" * 32).status_code == 404
+
+def test_file_transfer_endpoints(tmp_path):
+    import io
+    import tarfile
+    from environments.local import LocalEnvironment
+    with patch("runners.local.get_environment", side_effect=lambda params, **kwargs: LocalEnvironment(cwd=str(tmp_path))):
+        client = TestClient(create_app(LocalRunner({"instances": 2})))
+        client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            data = b"\x00\xff binary"
+            info = tarfile.TarInfo("pkg/blob.bin")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        resp = client.post("/upload", params={"run_id": "run-1", "path": "in"}, content=buf.getvalue())
+        assert resp.status_code == 200
+        assert (tmp_path / "in" / "pkg" / "blob.bin").read_bytes() == data
+
+        resp = client.get("/download", params={"run_id": "run-1", "path": "in/pkg"})
+        assert resp.headers["content-type"] == "application/x-tar"
+        with tarfile.open(fileobj=io.BytesIO(resp.content)) as tar:
+            assert tar.extractfile("pkg/blob.bin").read() == data
+
+        files = client.post("/read_files", json={"run_id": "run-1", "paths": ["in/pkg/blob.bin", "nope"]}).json()["files"]
+        assert files["in/pkg/blob.bin"]["encoding"] == "base64"
+        assert "error" in files["nope"]
+
+        assert client.get("/download", params={"run_id": "run-1", "path": "nope"}).status_code == 404
+        assert client.get("/download", params={"run_id": "missing", "path": "x"}).status_code == 404
+
+def test_file_transfer_unsupported(app):
+    client = TestClient(app)
+    client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "run-1"})
+    assert client.post("/read_files", json={"run_id": "run-1", "paths": ["a"]}).status_code == 501
+
+def test_sharded_front_relays_file_transfers(tmp_path):
+    import asyncio
+    import io
+    import tarfile
+    import httpx
+    from runners.sharded import ShardedRunner
+
+    runner = ShardedRunner({"instances": 1}, shards=1)
+    app = create_app(runner)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        data = b"\x00\xff binary"
+        info = tarfile.TarInfo("pkg/blob.bin")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+            await client.post("/start_instance", json={"container_image": "none", "container_type": "local", "run_id": "run-1"})
+            params = {"run_id": "run-1", "path": str(tmp_path / "in")}
+            uploaded = await client.post("/upload", params=params, content=buf.getvalue())
+            downloaded = await client.get("/download", params={"run_id": "run-1", "path": str(tmp_path / "in" / "pkg")})
+            files = await client.post(
+                "/read_files", json={"run_id": "run-1", "paths": [str(tmp_path / "in" / "pkg" / "blob.bin")]}
+            )
+            missing = await client.get("/download", params={"run_id": "run-1", "path": str(tmp_path / "nope")})
+            await client.post("/close_instance", json={"run_id": "run-1"})
+            return uploaded, downloaded, files.json()["files"], missing
+
+    try:
+        uploaded, downloaded, files, missing = asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+
+    assert uploaded.status_code == 200
+    assert (tmp_path / "in" / "pkg" / "blob.bin").read_bytes() == data
+    with tarfile.open(fileobj=io.BytesIO(downloaded.content)) as tar:
+        assert tar.extractfile("pkg/blob.bin").read() == data
+    assert files[str(tmp_path / "in" / "pkg" / "blob.bin")]["encoding"] == "base64"
+    assert missing.status_code == 404
+
+def test_idle_reaper_and_heartbeat():
+    import time
+    with patch("runners.local.get_environment", side_effect=lambda params, **kwargs: MockEnv()):
+        with TestClient(create_app(LocalRunner({"instances": 2}), idle_ttl=0.5)) as client:
+            client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "idle"})
+            client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": "kept", "idle_timeout": 0})
+            resp = client.post("/heartbeat", json={"run_id": "idle"})
+            assert resp.json()["expires_at"] > time.time()
+            assert client.post("/heartbeat", json={"run_id": "missing"}).status_code == 404
+
+            time.sleep(1)
+            body = client.get("/stats").json()
+            assert [i["run_id"] for i in body["instances"]] == ["kept"]
+            assert body["reaper"]["reaped"] == 1
+            assert body["available_resources"] == {"instances": 1}
+
+def test_response_compression():
+    with patch("runners.local.get_environment", side_effect=lambda params, **kwargs: MockEnv()):
+        client = TestClient(create_app(LocalRunner({"instances": 50}), compress_min_bytes=512))
+        for i in range(20):
+            client.post("/start_instance", json={"container_image": "test-env", "container_type": "local", "run_id": f"run-{i}"})
+
+        resp = client.get("/stats", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["content-encoding"] == "gzip"
+        assert "Accept-Encoding" in resp.headers["vary"]
+        assert len(resp.json()["instances"]) == 20
+
+        # Small bodies and clients without compression get plain JSON
+        resp = client.get("/get_available_resources", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in resp.headers
+        resp = client.get("/stats", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in resp.headers
+        assert resp.headers["content-type"] == "application/json"
+
+        if codec.zstandard is not None:
+            resp = client.get("/stats", headers={"Accept-Encoding": "gzip, zstd"})
+            assert resp.headers["content-encoding"] == "zstd"
+
+def test_msgpack_bodies(app):
+    msgpack = pytest.importorskip("msgpack")
+    client = TestClient(app)
+    headers = {"Content-Type": "application/msgpack", "Accept": "application/msgpack"}
+    resp = client.post(
+        "/start_instance",
+        content=msgpack.packb({"container_image": "test-env", "container_type": "local", "run_id": "run-1"}),
+        headers=headers,
+    )
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(resp.content)["instance_id"] == "run-1"
+
+    resp = client.post("/execute_command", content=msgpack.packb({"run_id": "run-1", "cmd": "ls"}), headers=headers)
+    assert msgpack.unpackb(resp.content)["result"]["output"] == "api mocked"
+
+    # JSON clients are unaffected; errors stay JSON
+    assert client.post("/execute_command", json={"run_id": "run-1", "cmd": "ls"}).json()["result"]["output"] == "api mocked"
+    resp = client.post("/close_instance", content=msgpack.packb({"run_id": "nope"}), headers=headers)
+    assert resp.status_code == 404
+    assert resp.json()["detail"] == "Instance not found"
+    resp = client.post("/close_instance", content=b"\xc1", headers=headers)
+    assert resp.status_code == 400
+
+def test_cancel_command_and_timeout(tmp_path):
+    import asyncio
+    import time
+    import httpx
+
+    app = create_app(LocalRunner({"instances": 1}))
+    survivor = tmp_path / "survivor"
+    # A detached child escapes a kill of the shell's process group, but not of its tag
+    cmd = f"setsid sh -c 'sleep 1; touch {survivor}' & sleep 30"
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+            await client.post("/start_instance", json={"container_image": "none", "container_type": "local", "run_id": "run-1"})
+            started = time.monotonic()
+            execution = asyncio.create_task(client.post(
+                "/execute_command", json={"run_id": "run-1", "cmd": cmd, "command_id": "c1", "timeout": 60}
+            ))
+            await asyncio.sleep(0.3)
+            duplicate = await client.post("/execute_command", json={"run_id": "run-1", "cmd": "true", "command_id": "c1"})
+            cancelled = await client.post("/cancel_command", json={"command_id": "c1"})
+            result = (await execution).json()["result"]
+            elapsed = time.monotonic() - started
+            unknown = await client.post("/cancel_command", json={"command_id": "c1"})
+            timed_out = await client.post("/execute_command", json={"run_id": "run-1", "cmd": "sleep 30", "timeout": 1})
+            return duplicate, cancelled.json(), result, elapsed, unknown, timed_out
+
+    duplicate, cancelled, result, elapsed, unknown, timed_out = asyncio.run(scenario())
+    assert duplicate.status_code == 409
+    assert cancelled == {"status": "success", "run_id": "run-1", "command_id": "c1", "finished": True}
+    assert result["cancelled"] is True
+    assert elapsed < 5
+    assert unknown.status_code == 404
+    assert timed_out.status_code == 500
+    assert "timed out" in timed_out.json()["detail"]
+    time.sleep(1.5)
+    assert not survivor.exists()
+
+def test_sharded_front_relays_command_responses(tmp_path):
+    import asyncio
+    import json
+    import httpx
+    from output import OutputStore
+    from runners.sharded import ShardedRunner
+
+    runner = ShardedRunner(
+        {"instances": 1}, shards=1, max_output_bytes=64, output_dir=str(tmp_path), compress_min_bytes=100
+    )
+    # The front compresses nothing itself, so compressed bodies come from the shard as they are
+    app = create_app(runner, output_store=OutputStore(str(tmp_path)), compress_min_bytes=None)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+            await client.post("/start_instance", json={"container_image": "none", "container_type": "local", "run_id": "run-1"})
+            big = await client.post(
+                "/execute_command",
+                json={"run_id": "run-1", "cmd": "head -c 1000 /dev/zero | tr '\\0' a"},
+                headers={"Accept-Encoding": "gzip"},
+            )
+            spilled = await client.get(f"/output/{big.json()['result']['spill_id']}")
+            small = await client.post(
+                "/execute_command", json={"run_id": "run-1", "cmd": "echo hi"}, headers={"Accept-Encoding": "identity"}
+            )
+            stream = await client.post("/execute_command_stream", json={"run_id": "run-1", "cmd": "echo a; echo b"})
+            execution = asyncio.create_task(client.post(
+                "/execute_command", json={"run_id": "run-1", "cmd": "sleep 30", "command_id": "c1"}
+            ))
+            await asyncio.sleep(0.5)
+            cancelled = await client.post("/cancel_command", json={"command_id": "c1"})
+            result = (await execution).json()["result"]
+            unknown = await client.post("/execute_command", json={"run_id": "nope", "cmd": "true"})
+            await client.post("/close_instance", json={"run_id": "run-1"})
+            return big, spilled, small, stream, cancelled.json(), result, unknown
+
+    # The front only relays bytes: it neither runs commands through the runner nor limits their output
+    try:
+        with patch("api.collect_limited", side_effect=AssertionError), \
+                patch.object(runner, "aexecute_command", side_effect=AssertionError), \
+                patch.object(runner, "astream_command", side_effect=AssertionError):
+            big, spilled, small, stream, cancelled, result, unknown = asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+
+    # Limited, spilled and compressed by the shard; the spill is served by the front
+    assert big.headers["content-encoding"] == "gzip"
+    assert big.headers["x-output-chars"] == str(len(big.json()["result"]["output"]))
+    assert big.json()["result"]["truncated"] and big.json()["result"]["output_bytes"] == 1000
+    assert spilled.text == "a" * 1000
+    assert "content-encoding" not in small.headers
+    assert small.json()["result"] == {"output": "hi\n", "returncode": 0}
+    assert stream.headers["content-type"].startswith("text/event-stream")
+    events = [json.loads(line[len("data: "):]) for line in stream.text.splitlines() if line.startswith("data: ")]
+    assert "".join(event.get("output", "") for event in events) == "a\nb\n"
+    assert events[-1]["returncode"] == 0
+    assert cancelled["finished"] is True
+    assert result["cancelled"] is True
+    assert unknown.status_code == 404
+
+def test_group_start_and_close():
+    def get_environment(params, **kwargs):
+        if params["run_id"] == "bad":
+            raise RuntimeError("image not found")
+        return MockEnv()
+
+    with patch("runners.local.get_environment", side_effect=get_environment):
+        client = TestClient(create_app(LocalRunner({"instances": 2})))
+        group = lambda *run_ids: [{"container_image": "test-env", "container_type": "local", "run_id": r} for r in run_ids]
+
+        # Three do not fit: none is started
+        resp = client.post("/start_instances", json={"instances": group("a", "b", "c"), "all_or_nothing": True})
+        assert resp.status_code == 503
+        assert client.get("/stats").json()["total_instances"] == 0
+
+        # One fails to start: the other is closed again
+        resp = client.post("/start_instances", json={"instances": group("a", "bad"), "all_or_nothing": True})
+        assert resp.status_code == 500
+        assert "bad: image not found" in resp.json()["detail"]
+        assert client.get("/stats").json()["total_instances"] == 0
+        assert client.get("/get_available_resources").json()["instances"] == 2
+
+        resp = client.post("/start_instances", json={"instances": group("a", "b"), "all_or_nothing": True})
+        assert [r["status"] for r in resp.json()["results"]] == ["success", "success"]
+        assert client.post("/start_instances", json={"instances": group("c", "c"), "all_or_nothing": True}).status_code == 400
+
+        resp = client.post("/close_instances", json={"run_ids": ["a", "b", "missing"]})
+        assert [r["status"] for r in resp.json()["results"]] == ["success", "success", "error"]
+
+        # Without all_or_nothing, each start succeeds or fails on its own
+        resp = client.post("/start_instances", json={"instances": group("a", "b", "c")})
+        assert [r["status"] for r in resp.json()["results"]] == ["success", "success", "error"]
+        assert client.get("/stats").json()["active_instances"] == 2
@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import httpx
+import pytest
+import uvicorn
+from fastapi.testclient import TestClient
+
+from api import create_app
+from cli import bind_unix_socket
+from client import AdmissionRejectedError, AsyncClient, Client, InstanceNotFoundError, RetryPolicy, ServiceError
+from runners.local import LocalRunner
+from tests.test_api import MockEnv
+
+NO_WAIT = RetryPolicy(attempts=3, multiplier=0)
+
+
+@pytest.fixture
+def app():
+    with patch("runners.local.get_environment") as mock_env:
+        mock_env.side_effect = lambda params, **kwargs: MockEnv()
+        yield create_app(LocalRunner({"instances": 1}))
+
+
+def test_client_instance_context_manager(app):
+    service = Client(http_client=TestClient(app), retry=NO_WAIT)
+    with service.instance("run-1", "test-env", "local") as instance:
+        result = instance.execute("whoami")
+        assert result.output == "api mocked"
+        assert result.returncode == 0
+        assert service.stats().active_instances == 1
+    assert service.stats().active_instances == 0
+
+    # Closed even when the block fails
+    with pytest.raises(RuntimeError):
+        with service.instance("run-2", "test-env", "local"):
+            raise RuntimeError("boom")
+    assert service.stats().total_instances == 0
+
+    with pytest.raises(InstanceNotFoundError):
+        service.execute_command("run-2", "whoami")
+
+
+def test_client_retries_admission_rejections(app):
+    service = Client(http_client=TestClient(app), retry=NO_WAIT)
+    service.start_instance("run-1", "test-env", "local")
+    # The only slot is taken: rejected with 503 on every attempt
+    with pytest.raises(AdmissionRejectedError) as excinfo:
+        service.start_instance("run-2", "test-env", "local")
+    assert excinfo.value.status_code == 503
+
+    no_retry = Client(http_client=TestClient(app), retry=RetryPolicy(retry_admission=False))
+    with pytest.raises(AdmissionRejectedError):
+        no_retry.start_instance("run-2", "test-env", "local")
+
+
+def test_client_group_start(app):
+    service = Client(http_client=TestClient(app), retry=NO_WAIT)
+    instances = [{"run_id": f"run-{i}", "container_image": "test-env", "container_type": "local"} for i in range(2)]
+    # The service has room for one instance only
+    with pytest.raises(AdmissionRejectedError):
+        service.start_instances(instances, all_or_nothing=True)
+    assert service.stats().total_instances == 0
+    results = service.start_instances(instances[:1], all_or_nothing=True)
+    assert [result["status"] for result in results] == ["success"]
+    assert [result["status"] for result in service.close_instances(["run-0"])] == ["success"]
+
+
+def test_client_retry_policy():
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        if request.url.path == "/start_instance" and calls.count("/start_instance") < 3:
+            return httpx.Response(503, json={"detail": "Not enough resources"})
+        if request.url.path == "/execute_command":
+            raise httpx.ReadError("connection reset", request=request)
+        if request.url.path == "/heartbeat" and calls.count("/heartbeat") < 2:
+            raise httpx.ReadError("connection reset", request=request)
+        if request.url.path == "/heartbeat":
+            return httpx.Response(200, json={"status": "success", "expires_at": 1.0})
+        return httpx.Response(200, json={"status": "success", "instance_id": "run-1"})
+
+    http = httpx.Client(base_url="http://service", transport=httpx.MockTransport(handler))
+    service = Client(http_client=http, retry=NO_WAIT)
+
+    # Rejected twice, admitted on the third attempt
+    assert service.start_instance("run-1", "img", "docker") == "run-1"
+    assert calls.count("/start_instance") == 3
+
+    # The command may have run: not retried
+    with pytest.raises(httpx.ReadError):
+        service.execute_command("run-1", "rm -rf build")
+    assert calls.count("/execute_command") == 1
+
+    # Heartbeats are idempotent: retried
+    assert service.heartbeat("run-1") == 1.0
+    assert calls.count("/heartbeat") == 2
+
+    with pytest.raises(ServiceError):
+        Client(http_client=httpx.Client(base_url="http://service", transport=httpx.MockTransport(
+            lambda request: httpx.Response(500, json={"detail": "boom"})
+        )), retry=NO_WAIT).close_instance("run-1")
+
+
+def test_async_client_instance(app):
+    async def scenario():
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver")
+        async with AsyncClient(http_client=http, retry=NO_WAIT, max_concurrency=4) as service:
+            async with service.instance("run-1", "test-env", "local") as instance:
+                results = await asyncio.gather(*(instance.execute(f"echo {i}") for i in range(20)))
+                stats = await service.stats(limit=0)
+            assert (await service.stats()).total_instances == 0
+        return results, stats
+
+    results, stats = asyncio.run(scenario())
+    assert [result.output for result in results] == ["api mocked"] * 20
+    assert stats.active_instances == 1
+    assert stats.instances == []
+
+
+def test_async_client_control_calls_skip_command_slots():
+    app = create_app(LocalRunner({"instances": 1}))
+
+    async def scenario():
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver", timeout=30)
+        async with AsyncClient(http_client=http, retry=NO_WAIT, max_concurrency=1) as service:
+            await service.start_instance("run-1", "none", "local")
+            command = asyncio.create_task(service.execute_command("run-1", "sleep 2"))
+            await asyncio.sleep(0.3)
+            # The only command slot is taken, which holds up neither heartbeats nor stats
+            started = time.monotonic()
+            await service.heartbeat("run-1")
+            await service.stats(limit=0)
+            elapsed = time.monotonic() - started
+            finished_early = command.done()
+            await command
+            await service.close_instance("run-1")
+        return elapsed, finished_early
+
+    elapsed, finished_early = asyncio.run(scenario())
+    assert not finished_early
+    assert elapsed < 1
+
+
+def test_client_msgpack(app):
+    pytest.importorskip("msgpack")
+    service = Client(http_client=TestClient(app), retry=NO_WAIT, use_msgpack=True)
+    with service.instance("run-1", "test-env", "local") as instance:
+        assert instance.execute("whoami").output == "api mocked"
+        assert service.stats().active_instances == 1
+
+
+def test_client_over_unix_socket(app, tmp_path):
+    path = str(tmp_path / "arservice.sock")
+    # A socket file left behind by a dead server is replaced
+    bind_unix_socket(path).close()
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [bind_unix_socket(path)]})
+    thread.start()
+    try:
+        with Client("http://localhost", uds=path, retry=NO_WAIT) as service:
+            while not server.started:
+                time.sleep(0.01)
+            with service.instance("run-1", "test-env", "local") as instance:
+                assert instance.execute("whoami").output == "api mocked"
+            # A socket in use is not taken over
+            with pytest.raises(OSError):
+                bind_unix_socket(path)
+    finally:
+        server.should_exit = True
+        thread.join()
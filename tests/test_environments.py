@@ -0,0 +1,116 @@
+import asyncio
+import subprocess
+import pytest
+from environments.local import LocalEnvironment
+from environments.process import stream_process
+
+def test_local_environment_aexecute():
+    env = LocalEnvironment()
+    res = asyncio.run(env.aexecute("echo hello; echo oops >&2; exit 3"))
+    assert res["output"] == "hello\noops\n"
+    assert res["returncode"] == 3
+
+def test_local_environment_aexecute_timeout():
+    env = LocalEnvironment()
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(env.aexecute("sleep 5", timeout=0.2))
+
+def test_local_environment_aexecute_concurrent():
+    env = LocalEnvironment()
+
+    async def scenario():
+        return await asyncio.gather(*(env.aexecute(f"sleep 0.2; echo {i}") for i in range(20)))
+
+    results = asyncio.run(scenario())
+    assert [r["output"] for r in results] == [f"{i}\n" for i in range(20)]
+
+def test_local_environment_astream():
+    env = LocalEnvironment()
+
+    async def scenario():
+        return [event async for event in env.astream("echo one; sleep 0.1; echo two")]
+
+    events = asyncio.run(scenario())
+    assert "".join(e.get("output", "") for e in events) == "one\ntwo\n"
+    assert len(events) >= 3
+    assert events[-1] == {"returncode": 0}
+
+def test_stream_process_early_exit_kills_process(tmp_path):
+    marker = tmp_path / "marker"
+
+    async def scenario():
+        events = stream_process(["/bin/sh", "-c", f"echo start; sleep 1; touch {marker}"], timeout=10)
+        async for event in events:
+            assert event == {"output": "start\n"}
+            break
+        await events.aclose()
+        await asyncio.sleep(1.5)
+
+    asyncio.run(scenario())
+    assert not marker.exists()
+
+def make_archive(files):
+    import io
+    import tarfile
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+async def chunks_of(data, size=7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+def test_local_environment_file_transfer(tmp_path):
+    import io
+    import tarfile
+    env = LocalEnvironment(cwd=str(tmp_path))
+    binary = bytes(range(255, -1, -1)) * 4
+
+    async def scenario():
+        await env.aupload("dst", chunks_of(make_archive({"bin.dat": binary, "src/a.py": "print('é')\n".encode()})))
+        archive = b"".join([chunk async for chunk in env.adownload("dst/src")])
+        files = await env.aread_files(["dst/bin.dat", "dst/src/a.py", "missing", "/etc/../../etc/hostname"], max_bytes=5)
+        return archive, files
+
+    archive, files = asyncio.run(scenario())
+    assert (tmp_path / "dst" / "bin.dat").read_bytes() == binary
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        assert sorted(tar.getnames()) == ["src", "src/a.py"]
+    assert files["dst/bin.dat"]["encoding"] == "base64" and files["dst/bin.dat"]["size"] == 1024
+    # The cut falls into the two-byte "é"
+    assert files["dst/src/a.py"] == {"content": "print", "encoding": "utf-8", "size": 12, "truncated": True}
+    assert "error" in files["missing"]
+
+def test_file_transfer_rejects_escapes(tmp_path):
+    from environments.files import resolve_path
+    (tmp_path / "link").symlink_to("/etc")
+    assert resolve_path(tmp_path, "a/../b", cwd="/work") == tmp_path / "work" / "b"
+    with pytest.raises(PermissionError):
+        resolve_path(tmp_path, "/link/passwd")
+    with pytest.raises(PermissionError):
+        resolve_path(tmp_path, "/other", mount=str(tmp_path))
+
+    env = LocalEnvironment(cwd=str(tmp_path))
+    with pytest.raises(Exception):
+        asyncio.run(env.aupload("dst", chunks_of(make_archive({"../evil": b"x"}))))
+    assert not (tmp_path / "evil").exists()
+
+def test_pipe_process_is_binary_safe():
+    from environments.process import pipe_process
+    data = bytes(range(256)) * 1000
+
+    async def scenario():
+        return b"".join([chunk async for chunk in pipe_process(["cat"], stdin=chunks_of(data, 4096))])
+
+    async def failing():
+        async for _ in pipe_process(["sh", "-c", "echo bad >&2; exit 2"]):
+            pass
+
+    assert asyncio.run(scenario()) == data
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        asyncio.run(failing())
+    assert e.value.stderr == "bad\n"
@@ -0,0 +1,22 @@
+from metrics import Counter, Histogram
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "Latency.", ("op",), buckets=(0.1, 1))
+    histogram.observe(0.05, op="exec")
+    histogram.observe(0.5, op="exec")
+    histogram.observe(5, op="exec")
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{op="exec",le="0.1"} 1',
+        'latency_seconds_bucket{op="exec",le="1"} 2',
+        'latency_seconds_bucket{op="exec",le="+Inf"} 3',
+        'latency_seconds_sum{op="exec"} 5.55',
+        'latency_seconds_count{op="exec"} 3',
+    ]
+
+def test_counter_label_escaping():
+    counter = Counter("events_total", "Events.", ("image",))
+    counter.inc(image='repo/"img"')
+    counter.inc(2, image='repo/"img"')
+    assert counter.render()[-1] == 'events_total{image="repo/\\"img\\""} 3'
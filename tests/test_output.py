@@ -0,0 +1,58 @@
+import asyncio
+from output import OutputCollector, OutputPolicy, OutputStore, collect_limited, parse_byte_range
+
+
+def feed_all(collector, chunks):
+    for chunk in chunks:
+        collector.feed(chunk)
+    collector.close()
+    return collector.result(0)
+
+
+def test_output_within_limits_is_unchanged():
+    result = feed_all(OutputCollector(OutputPolicy(max_bytes=10, max_lines=2)), ["ab\n", "cd"])
+    assert result == {"output": "ab\ncd", "returncode": 0}
+
+
+def test_head_tail_bytes_with_spill(tmp_path):
+    store = OutputStore(str(tmp_path))
+    chunks = [f"{i:04d}\n" for i in range(1000)]
+    result = feed_all(OutputCollector(OutputPolicy(max_bytes=20), store), chunks)
+    assert result["truncated"]
+    assert result["output"] == "0000\n0001\n\n[... 4980 bytes omitted ...]\n0998\n0999\n"
+    assert result["output_bytes"] == 5000
+    assert result["output_lines"] == 1000
+    with open(store.path(result["spill_id"])) as f:
+        assert f.read() == "".join(chunks)
+
+
+def test_line_limits():
+    chunks = ["a\nb\nc\n", "d\ne\nf"]
+    tail = feed_all(OutputCollector(OutputPolicy(max_lines=2, keep="tail", spill=False)), chunks)
+    assert tail["output"] == "\n[... 8 bytes omitted ...]\ne\nf"
+    assert tail["spill_id"] is None
+    head = feed_all(OutputCollector(OutputPolicy(max_lines=2, keep="head", spill=False)), chunks)
+    assert head["output"].startswith("a\nb\n\n[...")
+
+
+def test_failed_command_discards_spill(tmp_path):
+    store = OutputStore(str(tmp_path))
+
+    async def events():
+        yield {"output": "x" * 100}
+        raise TimeoutError()
+
+    try:
+        asyncio.run(collect_limited(events(), OutputPolicy(max_bytes=10), store))
+    except TimeoutError:
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_parse_byte_range():
+    assert parse_byte_range("bytes=0-9", 100) == (0, 10)
+    assert parse_byte_range("bytes=90-", 100) == (90, 100)
+    assert parse_byte_range("bytes=-10", 100) == (90, 100)
+    assert parse_byte_range("bytes=95-200", 100) == (95, 100)
+    assert parse_byte_range("bytes=100-", 100) is None
+    assert parse_byte_range("items=0-1", 100) is None
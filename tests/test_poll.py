@@ -0,0 +1,33 @@
+from poll import Dashboard, NodeSample
+
+def test_dashboard_rates():
+    def snapshot(server_time, commands, starts, num_cmd):
+        return {
+            "server_time": server_time,
+            "uptime_s": server_time - 1000.0,
+            "active_instances": 1,
+            "max_resources": {"instances": 4},
+            "allocated_resources": {"instances": 1},
+            "available_resources": {"instances": 3},
+            "admission_queue": {"depth": 2},
+            "totals": {"commands": commands, "starts": starts, "closes": 0},
+            "instances": [{"run_id": "run-1", "container_image": "img", "num_cmd": num_cmd, "busy_s": 1.0, "last_active_at": server_time - 5}],
+        }
+
+    dashboard = Dashboard()
+    first = dashboard.render([NodeSample("http://a", snapshot(1100.0, 10, 1, 10)), NodeSample("http://b", error="refused")])
+    assert first[:2] == ["Nodes: 1/2 up   Active instances: 1   Queued starts: 2", "Rates: - commands/s   - starts/s   - closes/s"]
+    assert "  instances: 1/4 allocated, 3 available" in first
+
+    # Rates are the change of the totals over the server's clock between the two polls
+    second = dashboard.render([NodeSample("http://a", snapshot(1110.0, 60, 3, 30)), NodeSample("http://b", error="refused")])
+    assert second[1] == "Rates: 5.00 commands/s   0.20 starts/s   0.00 closes/s"
+    node_row = next(line for line in second if line.startswith("http://a"))
+    assert node_row.split()[-3:] == ["5.00", "0.20", "0.00"]
+    assert any(line.startswith("http://b") and "DOWN" in line for line in second)
+    instance_row = second[second.index("Slowest instances:") + 2]
+    assert instance_row.split()[1:] == ["run-1", "img", "0.03", "30", "2.00"]
+
+    # After a restart of the server there is no previous poll to compare against
+    third = dashboard.render([NodeSample("http://a", snapshot(1005.0, 1, 1, 1))])
+    assert third[1] == "Rates: - commands/s   - starts/s   - closes/s"
@@ -1,7 +1,14 @@
+import asyncio
+import os
+import signal
+import subprocess
+import time
 import pytest
 from unittest.mock import MagicMock, patch
 from runners.local import LocalRunner
 from runners.slurm import SlurmRunner
+from runners.slurm_agent import AgentUnavailableError, run_command
+from runners.base import InsufficientResourcesError
 from environments.base import Environment
 
 class MockEnv(Environment):
@@ -22,16 +29,16 @@ def test_local_runner_resource_allocation(mock_get_environment):
     runner = LocalRunner({"instances": 2})
     
     # Start one instance
-    runner.start_instance("inst-1", {"resources": {"instances": 1}})
+    runner.start_instance({"run_id": "inst-1", "container_image": "img", "resources": {"instances": 1}})
     assert runner.get_available_resources()["instances"] == 1
     
     # Start second instance
-    runner.start_instance("inst-2", {"resources": {"instances": 1}})
+    runner.start_instance({"run_id": "inst-2", "container_image": "img", "resources": {"instances": 1}})
     assert runner.get_available_resources()["instances"] == 0
     
     # Fail starting third instance
     with pytest.raises(RuntimeError):
-        runner.start_instance("inst-3", {"resources": {"instances": 1}})
+        runner.start_instance({"run_id": "inst-3", "container_image": "img", "resources": {"instances": 1}})
         
     # Close one and check resources
     runner.close_instance("inst-1")
@@ -43,7 +50,7 @@ def test_local_runner_resource_allocation(mock_get_environment):
 
 def test_local_runner_execution(mock_get_environment):
     runner = LocalRunner({"instances": 1})
-    runner.start_instance("inst-1", {}) # Default 1 instance
+    runner.start_instance({"run_id": "inst-1", "container_image": "img"}) # Default 1 instance
     
     res = runner.execute_command("inst-1", "echo hello")
     assert res["output"] == "mocked output"
@@ -59,7 +66,7 @@ def test_slurm_runner(mock_run):
     mock_run.return_value.returncode = 0
     
     runner = SlurmRunner({"jobs": 5})
-    runner.start_instance("slurm-1", {"resources": {"jobs": 1}})
+    runner.start_instance({"run_id": "slurm-1", "container_image": "img", "resources": {"jobs": 1}})
     
     assert runner.get_available_resources()["jobs"] == 4
     
@@ -71,3 +78,584 @@ def test_slurm_runner(mock_run):
     # Close (scancel)
     runner.close_instance("slurm-1")
     assert runner.get_available_resources()["jobs"] == 5
+
+def test_local_runner_async_lifecycle(mock_get_environment):
+    runner = LocalRunner({"instances": 1})
+
+    async def scenario():
+        await runner.astart_instance({"run_id": "inst-1", "container_image": "img"})
+        assert runner.get_available_resources()["instances"] == 0
+        res = await runner.aexecute_command("inst-1", "echo hello")
+        assert runner.running_instances["inst-1"]["num_cmd"] == 1
+        await runner.aclose_instance("inst-1")
+        return res
+
+    res = asyncio.run(scenario())
+    assert res["output"] == "mocked output"
+    assert runner.get_available_resources()["instances"] == 1
+
+def test_instance_registry_indexes():
+    from runners.registry import InstanceRegistry
+    registry = InstanceRegistry()
+    for run_id, image in [("b-2", "img-b"), ("a-1", "img-a"), ("b-1", "img-a"), ("c-1", "img-b")]:
+        registry[run_id] = {"container_image": image}
+
+    assert list(registry.run_ids()) == ["a-1", "b-1", "b-2", "c-1"]
+    assert list(registry.run_ids("b-")) == ["b-1", "b-2"]
+    assert list(registry.run_ids(after="b-1")) == ["b-2", "c-1"]
+    assert list(registry.run_ids(container_image="img-a")) == ["a-1", "b-1"]
+    assert registry.container_counts() == {"img-a": 2, "img-b": 2}
+
+    version = registry.version
+    del registry["b-1"]
+    registry.pop("a-1")
+    assert registry.version > version
+    assert list(registry.run_ids()) == ["b-2", "c-1"]
+    assert registry.container_counts() == {"img-b": 2}
+
+def test_admission_queue_fifo(mock_get_environment):
+    runner = LocalRunner({"instances": 1})
+
+    async def scenario():
+        await runner.astart_instance({"run_id": "inst-1", "container_image": "img"})
+        admitted = []
+
+        async def start(run_id):
+            await runner.astart_instance({"run_id": run_id, "container_image": "img", "queue_timeout": 5})
+            admitted.append(run_id)
+
+        waiters = [asyncio.create_task(start("inst-2")), asyncio.create_task(start("inst-3"))]
+        await asyncio.sleep(0.05)
+        assert runner.admission_queue.stats()["depth"] == 2
+        assert admitted == []
+
+        await runner.aclose_instance("inst-1")
+        await asyncio.sleep(0.05)
+        assert admitted == ["inst-2"]
+
+        await runner.aclose_instance("inst-2")
+        await asyncio.gather(*waiters)
+        assert admitted == ["inst-2", "inst-3"]
+
+    asyncio.run(scenario())
+    stats = runner.admission_queue.stats()
+    assert stats["depth"] == 0
+    assert stats["admitted_after_wait"] == 2
+    assert runner.get_available_resources()["instances"] == 0
+
+def test_admission_queue_timeout(mock_get_environment):
+    from runners.base import InsufficientResourcesError
+    runner = LocalRunner({"instances": 1})
+
+    async def scenario():
+        await runner.astart_instance({"run_id": "inst-1", "container_image": "img"})
+        with pytest.raises(InsufficientResourcesError):
+            await runner.astart_instance({"run_id": "inst-2", "container_image": "img", "queue_timeout": 0.05})
+        # Requests that can never fit are rejected without queueing
+        with pytest.raises(InsufficientResourcesError):
+            await runner.astart_instance({"run_id": "inst-3", "container_image": "img", "queue_timeout": None, "resources": {"instances": 2}})
+
+    asyncio.run(scenario())
+    assert runner.admission_queue.stats()["timed_out"] == 1
+    assert len(runner.admission_queue) == 0
+    assert runner.get_available_resources()["instances"] == 0
+
+def test_tenant_quota_priority_and_fair_share(mock_get_environment):
+    runner = LocalRunner({"instances": 4}, tenants={"sweep-": {"quota": {"instances": 3}}})
+    assert runner.tenant_of("sweep-001") == "sweep-"
+    assert runner.tenant_of("other-001") == "default"
+
+    async def scenario():
+        for i in range(3):
+            await runner.astart_instance({"run_id": f"sweep-{i}", "container_image": "img"})
+        # Over the sweep- quota although the runner still has capacity
+        with pytest.raises(InsufficientResourcesError):
+            await runner.astart_instance({"run_id": "sweep-3", "container_image": "img"})
+        await runner.astart_instance({"run_id": "other-0", "container_image": "img"})
+
+        admitted = []
+
+        async def start(run_id, priority="normal"):
+            params = {"run_id": run_id, "container_image": "img", "queue_timeout": 5, "priority": priority}
+            await runner.astart_instance(params)
+            admitted.append(run_id)
+
+        waiters = []
+        for run_id, priority in [("sweep-4", "normal"), ("other-1", "normal"), ("other-2", "high")]:
+            waiters.append(asyncio.create_task(start(run_id, priority)))
+            await asyncio.sleep(0.01)
+
+        stats = runner.get_tenant_stats()
+        assert stats["sweep-"]["allocated"] == {"instances": 3}
+        assert stats["sweep-"]["quota"] == {"instances": 3}
+        assert stats["default"]["queued"] == {"requests": 2, "resources": {"instances": 2}}
+
+        # The high priority request goes first despite arriving last
+        await runner.aclose_instance("sweep-0")
+        await asyncio.sleep(0.05)
+        assert admitted == ["other-2"]
+
+        # sweep- then holds 1/4 and default 2/4: sweep-4 has the lower share
+        await runner.aclose_instance("sweep-1")
+        await asyncio.sleep(0.05)
+        assert admitted == ["other-2", "sweep-4"]
+
+        await runner.aclose_instance("sweep-2")
+        await asyncio.gather(*waiters)
+        assert admitted == ["other-2", "sweep-4", "other-1"]
+
+        with pytest.raises(ValueError):
+            await runner.astart_instance({"run_id": "x", "container_image": "img", "priority": "urgent"})
+
+    asyncio.run(scenario())
+
+def test_registry_recovery(tmp_path):
+    state_path = str(tmp_path / "state.db")
+    runner = LocalRunner({"instances": 4}, state_path=state_path)
+    for run_id in ["a", "b"]:
+        runner.start_instance({"run_id": run_id, "container_image": "img", "container_type": "local"})
+    runner.close_instance("b")
+    runner.start_instance({"run_id": "c", "container_image": "img", "container_type": "local", "resources": {"instances": 2}})
+    # A sandbox that disappeared while the service was down
+    runner.store.put("arservice-test-gone", {"container_type": "singularity", "config": {"run_id": "arservice-test-gone", "container_image": "img"}, "resources": {"instances": 1}})
+
+    # Simulate a restart: a fresh runner on the same state database
+    restarted = LocalRunner({"instances": 4}, state_path=state_path)
+    assert restarted.recover() == {"recovered_at": restarted.recovery["recovered_at"], "adopted": 2, "dropped": 1}
+    assert sorted(restarted.running_instances) == ["a", "c"]
+    assert restarted.get_available_resources() == {"instances": 1}
+    assert restarted.execute_command("a", "echo hi")["output"] == "hi\n"
+
+    restarted.close_instance("a")
+    assert sorted(restarted.store.load()) == ["c"]
+
+def test_clean_shutdown_keeps_persisted_instances(tmp_path):
+    import shutil
+    from fastapi.testclient import TestClient
+    from api import create_app
+    from environments.singularity import SingularityEnvironment
+
+    state_path = str(tmp_path / "state.db")
+    run_id = "arservice-test-detach"
+    config = {"run_id": run_id, "container_image": "img", "container_type": "singularity"}
+    sandbox = SingularityEnvironment._sandbox_path(run_id)
+    sandbox.mkdir(parents=True, exist_ok=True)
+    try:
+        runner = LocalRunner({"instances": 1}, state_path=state_path)
+        runner.store.put(run_id, {"container_image": "img", "container_type": "singularity", "config": config, "resources": {"instances": 1}})
+        assert runner.recover()["adopted"] == 1
+        env = runner.running_instances[run_id]["env"]
+        # A graceful shutdown runs the lifespan, then the environments are garbage-collected
+        with TestClient(create_app(runner, keep_instances=True)):
+            pass
+        env.__del__()
+        assert sandbox.is_dir()
+
+        # Without `keep_instances`, a shutdown tears the instances down as usual
+        restarted = LocalRunner({"instances": 1}, state_path=state_path)
+        assert restarted.recover()["adopted"] == 1
+        env = restarted.running_instances[run_id]["env"]
+        with TestClient(create_app(restarted)):
+            pass
+        env.__del__()
+        assert not sandbox.exists()
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+def test_idle_reaper(mock_get_environment):
+    from runners.reaper import IdleReaper
+    runner = LocalRunner({"instances": 3})
+
+    async def scenario():
+        reaper = IdleReaper(runner, runner.aclose_instance, default_ttl=60)
+        for run_id, idle_timeout in [("default", None), ("short", 1), ("never", 0)]:
+            await runner.astart_instance({"run_id": run_id, "container_image": "img", "idle_timeout": idle_timeout})
+        now = runner.running_instances["default"]["last_active_at"]
+        assert reaper.expired(now + 30) == ["short"]
+        assert sorted(reaper.expired(now + 61)) == ["default", "short"]
+
+        # Running commands and heartbeats keep instances alive
+        with runner.activity("short"):
+            assert reaper.expired(now + 30) == []
+        runner.running_instances["default"]["last_active_at"] -= 120
+        runner.touch_instance("default")
+        assert reaper.expired(time.time() + 30) == ["short"]
+
+        runner.running_instances["short"]["last_active_at"] -= 10
+        assert await reaper.reap_once() == ["short"]
+        assert reaper.stats()["reaped"] == 1
+        assert sorted(runner.running_instances) == ["default", "never"]
+        assert runner.get_available_resources() == {"instances": 1}
+
+    asyncio.run(scenario())
+
+def test_separate_worker_pools_and_start_limit():
+    import threading
+    from runners.workers import AdaptiveLimit, StartLimits, WorkerPools
+
+    threads = {}
+    release = threading.Event()
+
+    def slow_start(params, **kwargs):
+        threads["start"] = threading.current_thread().name
+        release.wait(5)
+        return MockEnv()
+
+    class RecordingEnv(MockEnv):
+        def execute(self, cmd, cwd="", timeout=None):
+            threads["execute"] = threading.current_thread().name
+            return super().execute(cmd, cwd, timeout)
+
+    runner = LocalRunner({"instances": 10}, workers=WorkerPools(start=2, execute=2, close=1), start_limits=StartLimits(2))
+
+    async def scenario():
+        with patch("runners.local.get_environment", return_value=RecordingEnv()):
+            await runner.astart_instance({"run_id": "warm", "container_image": "img", "container_type": "docker"})
+        with patch("runners.local.get_environment", side_effect=slow_start):
+            # Cold starts hold every start worker and the docker start limit...
+            starts = [asyncio.create_task(runner.astart_instance(
+                {"run_id": f"cold-{i}", "container_image": "img", "container_type": "docker"}
+            )) for i in range(3)]
+            await asyncio.sleep(0.1)
+            assert runner.start_limits.stats()["docker"]["waiting"] >= 1
+            # ...while commands still get a thread right away
+            result = await asyncio.wait_for(runner.aexecute_command("warm", "ls"), 1)
+            release.set()
+            await asyncio.gather(*starts)
+        return result
+
+    assert asyncio.run(scenario())["output"] == "mocked output"
+    assert threads["start"].startswith("arservice-start")
+    assert threads["execute"].startswith("arservice-execute")
+
+    # Additive increase while saturated, multiplicative decrease on failure or a slow start
+    limit = AdaptiveLimit(maximum=8, initial=2)
+    for _ in range(4):
+        limit.in_flight = 2
+        limit.release(1.0, True)
+    assert 3 <= limit.limit < 4
+    limit.in_flight = 1
+    limit.release(1.0, False)
+    assert 1.5 <= limit.limit < 2
+    limit.in_flight = 1
+    limit.release(10.0, True)
+    assert limit.limit == 1.0
+    assert limit.stats()["failed"] == 1
+
+
+def test_reservations_are_atomic_and_idempotent():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from runners.base import InstanceExistsError
+
+    runner = LocalRunner({"instances": 5, "cpus": 12})
+    barrier = threading.Barrier(50)
+
+    def reserve(i):
+        barrier.wait()
+        try:
+            return runner._reserve_resources({"instances": 1, "cpus": 2}, run_ids=[f"inst-{i}"])
+        except InsufficientResourcesError:
+            return None
+
+    # Many concurrent reservations never overcommit either resource
+    with ThreadPoolExecutor(50) as pool:
+        reservations = [r for r in pool.map(reserve, range(50)) if r is not None]
+    assert len(reservations) == 5
+    assert runner.allocated_resources == {"instances": 5, "cpus": 10}
+
+    # A run ID being started cannot be reserved twice
+    with pytest.raises(InstanceExistsError):
+        runner._reserve_resources({"instances": 0}, run_ids=reservations[0].run_ids)
+
+    # Rolling back twice, or after a commit, releases nothing more
+    reservations[0].rollback()
+    reservations[0].rollback()
+    reservations[1].commit()
+    reservations[1].rollback()
+    assert runner.allocated_resources == {"instances": 4, "cpus": 8}
+
+    # A failed start rolls back its reservation
+    with patch("runners.local.get_environment", side_effect=RuntimeError("boom")):
+        with pytest.raises(RuntimeError):
+            runner.start_instance({"run_id": "inst-0", "container_image": "img", "resources": {"instances": 1}})
+    assert runner.allocated_resources == {"instances": 4, "cpus": 8}
+    assert "inst-0" not in runner._starting
+
+
+def test_federated_runner_placement(mock_get_environment):
+    import httpx
+    from fastapi.testclient import TestClient
+    from api import create_app
+    from client import AsyncClient, Client
+    from runners.federated import NODE_RETRY, FederatedRunner, FederationNode
+
+    downstream = {"http://a": LocalRunner({"instances": 2}), "http://b": LocalRunner({"instances": 4})}
+
+    def node(url):
+        app = create_app(downstream[url])
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url=url)
+        return FederationNode(url, Client(http_client=TestClient(app), retry=NODE_RETRY), AsyncClient(http_client=http, retry=NODE_RETRY))
+
+    # Node a has img-warm cached
+    downstream["http://a"].start_instance({"run_id": "local", "container_image": "img-warm"})
+    runner = FederatedRunner([node("http://a"), node("http://b")], refresh_interval=0)
+    assert runner.max_resources == {"instances": 6}
+    assert runner.get_available_resources() == {"instances": 6}
+
+    async def scenario():
+        # The warm node wins although it is busier...
+        await runner.astart_instance({"run_id": "fed-1", "container_image": "img-warm", "container_type": "local"})
+        # ...a cold image goes to the least loaded node...
+        await runner.astart_instance({"run_id": "fed-2", "container_image": "img-cold", "container_type": "local"})
+        # ...and a full warm node is passed over
+        await runner.astart_instance({"run_id": "fed-3", "container_image": "img-warm", "container_type": "local"})
+        placed = {run_id: data["node"] for run_id, data in runner.running_instances.items()}
+        result = await runner.aexecute_command("fed-3", "whoami")
+        # Not through `aexecute_command`, as the default `astream_command` does
+        with patch.object(runner, "aexecute_command", side_effect=AssertionError):
+            streamed = [event async for event in runner.astream_command("fed-3", "whoami")]
+        await runner.aclose_instance("fed-1")
+        return placed, result, streamed
+
+    placed, result, streamed = asyncio.run(scenario())
+    assert placed == {"fed-1": "http://a", "fed-2": "http://b", "fed-3": "http://b"}
+    assert result["output"] == "mocked output"
+    # Streams are relayed event by event
+    assert streamed == [{"output": "mocked output"}, {"returncode": 0}]
+    assert set(downstream["http://a"].running_instances) == {"local"}
+    assert set(downstream["http://b"].running_instances) == {"fed-2", "fed-3"}
+    assert downstream["http://b"].running_instances["fed-3"]["num_cmd"] == 2
+    assert [stats["instances"] for stats in runner.node_stats()] == [0, 2]
+    assert "img-warm" in runner.node_stats()[1]["images"]
+
+    # Instances the node no longer knows are dropped
+    downstream["http://b"].close_instance("fed-2")
+    with pytest.raises(KeyError):
+        runner.execute_command("fed-2", "whoami")
+    assert "fed-2" not in runner.running_instances
+
+    # Re-adoption after a restart matches run IDs exactly, not by substring or prefix
+    records = {run_id: {"node": "http://b"} for run_id in ["fed-3", "fed-", "ed-3"]}
+    assert set(runner._reconcile(records, reap_orphans=False)) == {"fed-3"}
+
+
+def test_sharded_runner():
+    from runners.sharded import ShardedRunner
+
+    runner = ShardedRunner({"instances": 3}, shards=2)
+    try:
+        run_ids = [f"shard-run-{i}" for i in range(3)]
+
+        async def scenario():
+            await asyncio.gather(*(
+                runner.astart_instance({"run_id": run_id, "container_image": "none", "container_type": "local"})
+                for run_id in run_ids
+            ))
+            # The front process admits for the whole host, although each shard could take 3
+            with pytest.raises(InsufficientResourcesError):
+                await runner.astart_instance({"run_id": "extra", "container_image": "none", "container_type": "local"})
+            results = await asyncio.gather(*(runner.aexecute_command(run_id, "echo $PPID") for run_id in run_ids))
+            await asyncio.gather(*(runner.aclose_instance(run_id) for run_id in run_ids))
+            return results
+
+        results = asyncio.run(scenario())
+        assert all(result["returncode"] == 0 for result in results)
+        # Each instance lives on the shard its run ID hashes to, whose process ran the command
+        shards = {run_id: runner.shard_of(run_id) for run_id in run_ids}
+        pids = {shard.url: process.pid for shard, process in zip(runner.shards, runner.processes)}
+        assert [int(result["output"]) for result in results] == [pids[shards[run_id].url] for run_id in run_ids]
+        assert runner.get_available_resources() == {"instances": 3}
+    finally:
+        runner.shutdown()
+    assert all(process.poll() is not None for process in runner.processes)
+
+def test_slurm_runner_packs_instances():
+    submitted, cancelled, steps = [], [], []
+
+    class Proc:
+        def __init__(self, args):
+            self.args = args
+            self.returncode = 0
+
+        async def communicate(self, input=None):
+            if self.args[0] == "sbatch":
+                # Slow enough for every start to find the submission in flight
+                await asyncio.sleep(0.05)
+                submitted.append(self.args)
+                return f"{1000 + len(submitted)}\n".encode(), b""
+            cancelled.append(self.args[1])
+            return b"", b""
+
+    async def create_subprocess_exec(*args, **kwargs):
+        return Proc(args)
+
+    async def stream_process(cmd, timeout=None):
+        steps.append(cmd)
+        yield {"returncode": 0}
+
+    runner = SlurmRunner({"instances": 6, "allocations": 2}, slots_per_allocation=3)
+
+    async def scenario():
+        run_ids = [f"pack-{i}" for i in range(5)]
+        await asyncio.gather(*(runner.astart_instance({"run_id": run_id, "container_image": "img"}) for run_id in run_ids))
+        assert len(submitted) == 2
+        assert sorted(a.stats()["occupied"] for a in runner.allocations.values()) == [2, 3]
+        assert runner.allocated_resources == {"instances": 5, "allocations": 2}
+
+        await runner.aexecute_command("pack-0", "echo hi")
+        job_id = runner.running_instances["pack-0"]["job_id"]
+        assert steps[-1][:3] == ["srun", "--jobid", job_id]
+        assert runner.running_instances["pack-0"]["slot_tag"] in steps[-1][-1]
+
+        # The next start fills the free slot instead of submitting a third allocation
+        await runner.astart_instance({"run_id": "pack-5", "container_image": "img"})
+        assert len(submitted) == 2
+        # An allocation is cancelled only once its last instance closes
+        for run_id in sorted(runner.running_instances):
+            job_id = runner.running_instances[run_id]["job_id"]
+            last = len(runner.allocations[job_id].occupants) == 1
+            await runner.aclose_instance(run_id)
+            assert (job_id in cancelled) == last
+            assert (job_id in runner.allocations) != last
+
+    with patch("runners.slurm.asyncio.create_subprocess_exec", create_subprocess_exec), patch("runners.slurm.stream_process", stream_process):
+        asyncio.run(scenario())
+    assert len(cancelled) == 2
+    assert runner.allocations == {}
+    assert runner.allocated_resources == {"instances": 0, "allocations": 0}
+
+    # Allocations are only accounted for when they are capped
+    assert "allocations" not in SlurmRunner({"instances": 6}, slots_per_allocation=3).allocated_resources
+
+    # At the cap, starts that need a new allocation wait in the admission queue
+    runner = SlurmRunner({"instances": 8, "allocations": 2}, slots_per_allocation=3)
+    submitted.clear()
+
+    async def capped():
+        await asyncio.gather(*(runner.astart_instance({"run_id": f"cap-{i}", "container_image": "img"}) for i in range(6)))
+        with pytest.raises(InsufficientResourcesError):
+            await runner.astart_instance({"run_id": "cap-6", "container_image": "img"})
+        waiting = asyncio.ensure_future(runner.astart_instance({"run_id": "cap-6", "container_image": "img", "queue_timeout": 5}))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        assert runner.get_tenant_stats()["default"]["queued"]["resources"] == {"allocations": 1}
+        # A closing instance frees a slot for it, without a third allocation
+        await runner.aclose_instance("cap-0")
+        await waiting
+        assert len(submitted) == 2
+        assert runner.allocated_resources == {"instances": 6, "allocations": 2}
+        # The submission it no longer needs leaves the queue
+        await asyncio.sleep(0.01)
+        assert not runner.admission_queue
+
+    with patch("runners.slurm.asyncio.create_subprocess_exec", create_subprocess_exec), patch("runners.slurm.stream_process", stream_process):
+        asyncio.run(capped())
+
+def test_slurm_runner_cancelled_slot_waiters():
+    submitted, cancelled = [], []
+
+    class Proc:
+        def __init__(self, args):
+            self.args = args
+            self.returncode = 0
+
+        async def communicate(self, input=None):
+            if self.args[0] == "sbatch":
+                submitted.append(self.args)
+                return f"{1000 + len(submitted)}\n".encode(), b""
+            cancelled.append(self.args[1])
+            return b"", b""
+
+    async def create_subprocess_exec(*args, **kwargs):
+        return Proc(args)
+
+    async def stream_process(cmd, timeout=None):
+        yield {"returncode": 0}
+
+    runner = SlurmRunner({"instances": 4, "allocations": 1}, slots_per_allocation=2)
+
+    async def scenario():
+        await asyncio.gather(*(runner.astart_instance({"run_id": run_id, "container_image": "img"}) for run_id in "ab"))
+        allocation, = runner.allocations.values()
+
+        # A start cancelled while its allocation is queued takes the submission with it; the
+        # next start submits one of its own rather than failing on the cancelled one
+        waiting = asyncio.ensure_future(runner.astart_instance({"run_id": "c", "container_image": "img", "queue_timeout": 5}))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        waiting = asyncio.ensure_future(runner.astart_instance({"run_id": "d", "container_image": "img", "queue_timeout": 5}))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        # Both instances leave before the waiting start is woken up (as when closed by worker
+        # threads): the emptied allocation is kept for it, and released once it is cancelled
+        for run_id in "ab":
+            runner._remove_instance(run_id)
+        allocation.occupants.pop("b")
+        assert runner._vacate_slot(allocation, "a") is False
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert cancelled == [allocation.job_id]
+        assert runner.allocations == {}
+        await asyncio.sleep(0.01)
+        assert not runner.admission_queue
+        assert runner.allocated_resources == {"instances": 0, "allocations": 0}
+
+    with patch("runners.slurm.asyncio.create_subprocess_exec", create_subprocess_exec), patch("runners.slurm.stream_process", stream_process):
+        asyncio.run(scenario())
+    assert len(submitted) == 1
+
+def test_slurm_runner_exec_agent(tmp_path):
+    runner = SlurmRunner({"instances": 1}, agent_dir=str(tmp_path))
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.stdout = "42"
+        mock_run.return_value.stderr = ""
+        mock_run.return_value.returncode = 0
+        runner.start_instance({"run_id": "agent-1", "container_image": "img"})
+        script = mock_run.call_args.kwargs["input"]
+        # Until the agent is up, commands run as srun steps
+        runner.execute_command("agent-1", "whoami")
+        assert mock_run.call_args.args[0][:3] == ["srun", "--jobid", "42"]
+
+    # Run the sleeper job's script here, as Slurm would on the compute node
+    job = subprocess.Popen(["bash", "-c", script], env={**os.environ, "SLURM_JOB_ID": "42"}, start_new_session=True)
+    try:
+        deadline = time.monotonic() + 10
+        while not (tmp_path / "42.json").exists():
+            assert time.monotonic() < deadline and job.poll() is None
+            time.sleep(0.02)
+        assert runner.execute_command("agent-1", "echo $((6 * 7)); exit 3") == {"output": "42\n", "returncode": 3}
+        # Commands beyond the default 64 KiB line limit of asyncio streams, e.g. file writes
+        content = "x" * (70 * 1024)
+        assert runner.execute_command("agent-1", f"printf %s '{content}' | wc -c")["output"].strip() == str(len(content))
+
+        # A refused command has not run and falls back to srun
+        address = runner._agent("42")
+        with pytest.raises(AgentUnavailableError):
+            run_command(address._replace(token="stale"), "echo hi", 10)
+        runner._agents["42"] = address._replace(token="stale")
+        with patch("subprocess.run") as mock_run:
+            mock_run.return_value.stdout = "srun output"
+            mock_run.return_value.stderr = ""
+            mock_run.return_value.returncode = 0
+            assert runner.execute_command("agent-1", "echo hi")["output"] == "srun output"
+
+        async def scenario():
+            events = [event async for event in runner.astream_command("agent-1", "echo a; sleep 0.1; echo b", timeout=10)]
+            assert events == [{"output": "a\n"}, {"output": "b\n"}, {"returncode": 0}]
+            with pytest.raises(subprocess.TimeoutExpired):
+                await runner.aexecute_command("agent-1", "sleep 10", timeout=0.2)
+
+        asyncio.run(scenario())
+        assert runner.running_instances["agent-1"]["num_cmd"] == 5
+    finally:
+        os.killpg(job.pid, signal.SIGKILL)
+        job.wait()
+
+    with patch("subprocess.run"):
+        runner.close_instance("agent-1")
+    assert not (tmp_path / "42.json").exists()